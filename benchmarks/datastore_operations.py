@@ -0,0 +1,279 @@
+"""
+Times the datastore operations against synthetic guilds, so changes can be compared between commits.
+
+Guild sizes follow a power law: guild i gets max_members / (i + 1) ** skew members, and a share of
+every guild's members is in VC so the reads have unsaved time to merge. Each operation's latency
+distribution and ops/sec go to stdout as JSON; a table goes to stderr.
+
+Runs against the in-process memory backend by default, or a local valkey-server / SQLite file.
+Only the benchmark's own guilds are written and they get deleted afterwards. On valkey-server they go in
+db 15 (see --db), away from the bot's db 0, and nothing outside them is read or written. Needs config.py like
+the bot does, but the backend and journal are picked here.
+
+Run from the repository root:
+    python -m benchmarks.datastore_operations [--backend memory|valkey|sqlite] [--guilds 200] [--max-members 20000]
+        [--db 15] [--skew 1.0] [--in-vc 0.05] [--runs 500] [--seed 0] [--output results.json] [--compare old.json]
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import datastore
+
+from typing import Awaitable, Callable, Dict, List, Optional
+from datastore import Datastore
+from objects.session_journal import ShardedSessionJournal
+from storage.backend import StorageBackend
+
+# Far away from any real guild ID, so they can't collide with one even in the same db
+FIRST_GUILD_ID = 10**15
+SEED_BATCH_SIZE = 1000
+
+
+def make_backend(options: argparse.Namespace, directory: str) -> StorageBackend:
+    if options.backend == "valkey":
+        from storage.valkey_backend import ValkeyBackend
+        return ValkeyBackend([(options.host, options.port)], db=options.db)
+
+    if options.backend == "sqlite":
+        from storage.sqlite_backend import SqliteBackend
+        return SqliteBackend(os.path.join(directory, "benchmark.sqlite3"))
+
+    from storage.memory_backend import MemoryBackend
+    return MemoryBackend()
+
+
+def guild_sizes(options: argparse.Namespace) -> Dict[int, int]:
+    return {
+        FIRST_GUILD_ID + i: max(1, int(options.max_members / (i + 1) ** options.skew))
+        for i in range(options.guilds)
+    }
+
+
+async def seed(backend: StorageBackend, sizes: Dict[int, int]) -> List[tuple[int, int]]:
+    """Gives every member some saved time and returns all (guild_id, user_id)"""
+    members: List[tuple[int, int]] = []
+    batch: List[tuple[int, int, int]] = []
+
+    for guild_id, size in sizes.items():
+        for user_id in range(1, size + 1):
+            members.append((guild_id, user_id))
+            # Most members have a little time, a few have a lot
+            batch.append((guild_id, user_id, int(random.expovariate(1 / 36000)) + 1))
+
+            if len(batch) >= SEED_BATCH_SIZE:
+                await backend.increment(batch)
+                batch = []
+
+    if batch:
+        await backend.increment(batch)
+
+    return members
+
+
+async def time_runs(runs: int, prepare: Optional[Callable[[int], Awaitable[None]]], func: Callable[[int], Awaitable[object]]) -> List[float]:
+    """Times func(run) for each run. prepare(run) runs first and isn't timed"""
+    timings: List[float] = []
+
+    for run in range(runs):
+        if prepare is not None:
+            await prepare(run)
+
+        start = time.perf_counter()
+        await func(run)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return timings
+
+
+def summarize(timings: List[float]) -> Dict[str, float]:
+    ordered = sorted(timings)
+
+    def percentile(percent: float) -> float:
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+    total_ms = sum(ordered)
+    return {
+        "runs": len(ordered),
+        "ops_per_second": len(ordered) / (total_ms / 1000) if total_ms > 0 else 0.0,
+        "mean_ms": total_ms / len(ordered),
+        "p50_ms": percentile(50),
+        "p90_ms": percentile(90),
+        "p99_ms": percentile(99),
+        "max_ms": ordered[-1],
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def print_table(results: Dict[str, Dict[str, float]], baseline: Optional[Dict[str, Dict[str, float]]]) -> None:
+    header = f"{'operation':<36}{'ops/s':>12}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    if baseline is not None:
+        header += f"{'p50 vs old':>12}"
+    print(header, file=sys.stderr)
+
+    for operation, stats in results.items():
+        line = (
+            f"{operation:<36}{stats['ops_per_second']:>12.1f}{stats['p50_ms']:>10.3f}"
+            f"{stats['p90_ms']:>10.3f}{stats['p99_ms']:>10.3f}{stats['max_ms']:>10.3f}"
+        )
+        old = baseline.get(operation) if baseline is not None else None
+        if old is not None and old["p50_ms"] > 0:
+            line += f"{stats['p50_ms'] / old['p50_ms']:>11.2f}x"
+        print(line, file=sys.stderr)
+
+
+async def run(options: argparse.Namespace, directory: str) -> Dict[str, Dict[str, float]]:
+    store = Datastore()
+
+    # Set up the datastore by hand instead of initialize(), so the config's backend and journal aren't used
+    backend = make_backend(options, directory)
+    await backend.connect()
+    datastore.backend = backend
+    datastore.session_journal = ShardedSessionJournal(os.path.join(directory, "journal.bin"), None)
+    datastore.session_journal.open()
+    datastore.write_buffer.start(store.write_increments)
+
+    tracking_queue = store.get_tracking_queue()
+
+    sizes = guild_sizes(options)
+    seed_start = time.perf_counter()
+    members = await seed(backend, sizes)
+    print(f"Seeded {len(members):,} members in {len(sizes)} guilds in {time.perf_counter() - seed_start:.2f}s", file=sys.stderr)
+
+    in_vc: List[tuple[int, int]] = random.sample(members, max(1, int(len(members) * options.in_vc)))
+
+    def rewind(sessions: List[tuple[int, int]]) -> None:
+        # Everyone joined a minute ago, so there's time to save
+        joined_time = int(time.time()) - 60
+        for guild_id, user_id in sessions:
+            tracking_queue.add(user_id, guild_id, joined_time)
+
+    rewind(in_vc)
+
+    # Weighted by size, like the commands people actually run
+    guild_ids: List[int] = list(sizes)
+    weights: List[int] = [sizes[guild_id] for guild_id in guild_ids]
+
+    def random_member() -> tuple[int, int]:
+        guild_id = random.choices(guild_ids, weights)[0]
+        return guild_id, random.randint(1, sizes[guild_id])
+
+    results: Dict[str, Dict[str, float]] = {}
+
+    async def prepare_save_single(run: int) -> None:
+        rewind([in_vc[run % len(in_vc)]])
+
+    async def save_single(run: int) -> None:
+        guild_id, user_id = in_vc[run % len(in_vc)]
+        await store.save_single(user_id, guild_id)
+
+    results["save_single"] = summarize(await time_runs(options.runs, prepare_save_single, save_single))
+
+    async def prepare_save_all(run: int) -> None:
+        rewind(in_vc)
+
+    async def save_all(run: int) -> None:
+        await store.save_all(None)
+
+    # Every run writes everyone in VC, so there are fewer of them
+    results["save_all"] = summarize(await time_runs(max(1, options.runs // 50), prepare_save_all, save_all))
+
+    async def get_user_time_and_position(run: int) -> None:
+        guild_id, user_id = random_member()
+        await store.get_user_time_and_position(user_id, guild_id)
+
+    results["get_user_time_and_position"] = summarize(await time_runs(options.runs, None, get_user_time_and_position))
+
+    async def get_leaderboard_page(run: int) -> None:
+        await store.get_leaderboard_page(random.choices(guild_ids, weights)[0], random.randrange(20) * 10, 10)
+
+    results["get_leaderboard_page"] = summarize(await time_runs(options.runs, None, get_leaderboard_page))
+
+    # Resets get their own copies of a median sized guild, so the other guilds stay intact
+    reset_size: int = sorted(sizes.values())[len(sizes) // 2]
+    reset_guild_id = FIRST_GUILD_ID + options.guilds
+
+    async def prepare_reset_guild_data(run: int) -> None:
+        await seed(backend, {reset_guild_id + run: reset_size})
+
+    async def reset_guild_data(run: int) -> None:
+        await store.reset_guild_data(reset_guild_id + run)
+
+    results["reset_guild_data"] = summarize(await time_runs(max(1, options.runs // 10), prepare_reset_guild_data, reset_guild_data))
+
+    # Clean up
+    await datastore.write_buffer.stop()
+    for guild_id in guild_ids:
+        await backend.delete_guild(guild_id)
+    datastore.session_journal.close()
+    await backend.close()
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=["memory", "valkey", "sqlite"], default="memory")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--db", type=int, default=15, help="Valkey db to write the benchmark's guilds to")
+    parser.add_argument("--guilds", type=int, default=200)
+    parser.add_argument("--max-members", type=int, default=20000)
+    parser.add_argument("--skew", type=float, default=1.0)
+    parser.add_argument("--in-vc", type=float, default=0.05, help="Share of members that are in VC")
+    parser.add_argument("--runs", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    options = parser.parse_args()
+
+    random.seed(options.seed)
+
+    # The datastore prints as it goes, which would end up in the middle of the JSON
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(sys.stderr):
+        results = asyncio.run(run(options, directory))
+
+    baseline: Optional[Dict[str, Dict[str, float]]] = None
+    if options.compare:
+        with open(options.compare) as file:
+            baseline = json.load(file)["operations"]
+
+    print_table(results, baseline)
+
+    report = {
+        "commit": git_commit(),
+        "backend": options.backend,
+        "parameters": {
+            "guilds": options.guilds,
+            "max_members": options.max_members,
+            "skew": options.skew,
+            "in_vc": options.in_vc,
+            "runs": options.runs,
+            "seed": options.seed,
+        },
+        "operations": results,
+    }
+
+    output = json.dumps(report, indent=2)
+    print(output)
+
+    if options.output:
+        with open(options.output, "w") as file:
+            file.write(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Compares the array-backed SessionTable against the old Dict[str, User] tracking queue.
+
+Run from the repository root:
+    python -m benchmarks.session_table_vs_dict [sessions]
+"""
+import random
+import sys
+import time
+import tracemalloc
+
+from typing import Dict, List
+from objects.session_table import SessionTable
+
+
+class OldUser:
+    """The tracking queue entry as it was before SessionTable"""
+
+    def __init__(self, user_id: int, guild_id: int, current_time_seconds: int):
+        self._user_id = user_id
+        self._guild_id = guild_id
+        self._joined_time = current_time_seconds
+
+
+def make_sessions(count: int) -> List[tuple[int, int, int]]:
+    random.seed(0)
+    now = int(time.time())
+    guild_ids = [random.getrandbits(60) for _ in range(max(1, count // 20))]
+    return [(random.getrandbits(60), random.choice(guild_ids), now - random.randint(1, 3600)) for _ in range(count)]
+
+
+def build_dict(sessions: List[tuple[int, int, int]]) -> Dict[str, OldUser]:
+    queue: Dict[str, OldUser] = {}
+    for user_id, guild_id, joined_time in sessions:
+        queue[f"{user_id}-{guild_id}"] = OldUser(user_id, guild_id, joined_time)
+    return queue
+
+
+def build_table(sessions: List[tuple[int, int, int]]) -> SessionTable:
+    table = SessionTable()
+    for user_id, guild_id, joined_time in sessions:
+        table.add(user_id, guild_id, joined_time)
+    return table
+
+
+def measure_memory(builder, sessions) -> tuple[object, int]:
+    tracemalloc.start()
+    built = builder(sessions)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return built, current
+
+
+def old_save_all(queue: Dict[str, OldUser], current_time: int) -> int:
+    # Same loop as save_all() used to run over the dict
+    user_ids: List[int] = []
+    time_differences: List[int] = []
+    server_ids: List[int] = []
+
+    for user in queue.copy().values():
+        time_difference = current_time - user._joined_time
+        if time_difference <= 0:
+            continue
+        time_differences.append(time_difference)
+        user_ids.append(user._user_id)
+        server_ids.append(user._guild_id)
+        user._joined_time = current_time
+
+    return len(user_ids)
+
+
+def best_of(runs: int, func) -> float:
+    # Every run saves one more second for everyone, like back to back save_all() calls would
+    best = float("inf")
+    for run in range(runs):
+        start = time.perf_counter()
+        func(int(time.time()) + 1 + run)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    sessions = make_sessions(count)
+
+    queue, dict_bytes = measure_memory(build_dict, sessions)
+    table, table_bytes = measure_memory(build_table, sessions)
+
+    dict_ms = best_of(5, lambda current_time: old_save_all(queue, current_time)) # type: ignore
+    table_ms = best_of(5, lambda current_time: table.take_all_time_differences(None, current_time)) # type: ignore
+
+    print(f"sessions: {count:,}")
+    print(f"{'':<24}{'memory (MiB)':>14}{'save_all (ms)':>16}")
+    print(f"{'Dict[str, User]':<24}{dict_bytes / 2**20:>14.2f}{dict_ms:>16.2f}")
+    print(f"{'SessionTable':<24}{table_bytes / 2**20:>14.2f}{table_ms:>16.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Compares the pipeline the datastore used to send for a batch against the increment script.
+Needs a running valkey-server, and uses db 15 which gets flushed.
+
+Run from the repository root:
+    python -m benchmarks.valkey_round_trips [--host localhost] [--port 6379] [--runs 200]
+"""
+import argparse
+import asyncio
+import random
+import time
+import valkey.asyncio as valkey
+
+from typing import Awaitable, Callable, List
+from storage.valkey_backend import BUCKET_TTL_SECONDS, INCREMENT_SCRIPT
+
+GUILD_KEY = "guild:1"
+BUCKET_KEY = "guild_day:1:0"
+TOTAL_KEY = "guild_total:1"
+DAY_TOTAL_KEY = "guild_day_total:1:0"
+MEMBERS = 5000
+BATCH_SIZE = 100
+
+
+async def time_runs(runs: int, func: Callable[[], Awaitable[None]]) -> List[float]:
+    timings: List[float] = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        await func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return sorted(timings)
+
+
+def describe(name: str, round_trips: int, timings: List[float]) -> str:
+    p50 = timings[len(timings) // 2]
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    return f"{name:<44}{round_trips:>12}{p50:>10.3f}{p99:>10.3f}"
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--runs", type=int, default=200)
+    options = parser.parse_args()
+
+    connection = valkey.Valkey(host=options.host, port=options.port, db=15)
+    await connection.flushdb()
+    await connection.zadd(GUILD_KEY, {str(member): random.randint(0, 10**6) for member in range(MEMBERS)})
+
+    increment_script = connection.register_script(INCREMENT_SCRIPT)
+
+    def random_batch() -> List[tuple[str, int]]:
+        return [(str(random.randrange(MEMBERS)), random.randint(1, 600)) for _ in range(BATCH_SIZE)]
+
+    # save_all batch: PING, then a pipeline of ZADD INCR
+    async def old_batch() -> None:
+        await connection.ping()
+        async with connection.pipeline(transaction=False) as pipe:
+            for member, increment in random_batch():
+                pipe.zadd(GUILD_KEY, {member: increment}, incr=True)
+            await pipe.execute()
+
+    async def script_batch() -> None:
+        args: List[str | int] = [BUCKET_TTL_SECONDS, 0]
+        for member, increment in random_batch():
+            args.extend((member, increment))
+        await increment_script(keys=[GUILD_KEY] * BATCH_SIZE + [BUCKET_KEY] * BATCH_SIZE + [TOTAL_KEY] * BATCH_SIZE + [DAY_TOTAL_KEY] * BATCH_SIZE, args=args)
+
+    rows = [
+        describe("save_all batch of 100 (ping + pipeline)", 2, await time_runs(options.runs, old_batch)),
+        describe("save_all batch of 100 (script)", 1, await time_runs(options.runs, script_batch)),
+    ]
+
+    print(f"{'':<44}{'round trips':>12}{'p50 ms':>10}{'p99 ms':>10}")
+    print("\n".join(rows))
+
+    await connection.flushdb()
+    await connection.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
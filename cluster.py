@@ -0,0 +1,346 @@
+"""
+Runs the bot as several worker processes, so it isn't limited to one core. Every worker connects to its own
+range of shards and has its own tracking queue and write buffer. The guilds of a shard always land on the same
+worker as long as the shard count stays the same, and each shard has its own session journal, so its sessions
+follow it to another worker when CLUSTER_PROCESSES changes.
+
+This process is the coordinator: it starts the workers and restarts any that exit, and the workers send it
+their stats so the daily summary and reconciliation status cover the whole cluster. It also watches each
+worker's CPU and memory, which are exported on the metrics endpoint and included in the summary.
+
+Uses config.SHARD_COUNT, or the shard count Discord recommends, and config.CLUSTER_PROCESSES workers
+(default: one per core). Run from the repository root instead of vcstats.py:
+    python cluster.py
+"""
+import asyncio
+import json
+import os
+import signal
+import sys
+import time
+
+import config
+import psutil
+
+from typing import Any, Dict, List, Optional
+from cluster_worker import COORDINATOR_ENV, REPORT_INTERVAL_SECONDS, SHARD_COUNT_ENV, SHARD_IDS_ENV, WORKER_ID_ENV
+from metrics import registry, start_metrics_server, stop_metrics_server
+
+VCSTATS_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vcstats.py")
+
+# How long to wait before starting a worker that exited again
+RESTART_DELAY_SECONDS = 5
+
+# How long a worker gets to save everyone and shut down before it's killed
+STOP_TIMEOUT_SECONDS = 60
+
+# Discord allows one identify per 5 seconds per bucket, so workers further along the shards start later
+IDENTIFY_INTERVAL_SECONDS = 5
+
+# A worker that hasn't reported for this long is shown as down
+REPORT_STALE_SECONDS = REPORT_INTERVAL_SECONDS * 3
+
+
+def shard_ranges(shard_count: int, processes: int) -> List[List[int]]:
+    """Splits the shards into contiguous ranges of (nearly) the same size, one per process"""
+    processes = max(1, min(processes, shard_count))
+
+    ranges: List[List[int]] = []
+    start = 0
+    for i in range(processes):
+        size = shard_count // processes + (1 if i < shard_count % processes else 0)
+        ranges.append(list(range(start, start + size)))
+        start += size
+
+    return ranges
+
+
+async def fetch_gateway_limits() -> tuple[int, int]:
+    """The shard count Discord recommends and how many shards may identify at the same time"""
+    import hikari
+
+    rest = hikari.RESTApp()
+    await rest.start()
+    try:
+        async with rest.acquire(config.BOT_TOKEN, hikari.TokenType.BOT) as client:
+            info = await client.fetch_gateway_bot_info()
+            return info.shard_count, info.session_start_limit.max_concurrency
+    finally:
+        await rest.close()
+
+
+class WorkerProcess:
+    """One vcstats.py process and the shards it owns"""
+
+    def __init__(self, worker_id: int, shard_ids: List[int], shard_count: int, coordinator_address: str, start_delay_seconds: float):
+        self.worker_id = worker_id
+        self.shard_ids = shard_ids
+        self._shard_count = shard_count
+        self._coordinator_address = coordinator_address
+        self._start_delay_seconds = start_delay_seconds
+
+        self._process: Optional[asyncio.subprocess.Process] = None
+        self._usage: Optional[psutil.Process] = None
+        self._stopping: bool = False
+
+        self.restarts: int = 0
+        self.cpu_percent: float = 0.0
+        self.memory_bytes: int = 0
+
+        # The last stats the worker sent, and its counters from before it was restarted
+        self.last_report: Optional[Dict[str, Any]] = None
+        self.last_report_at: float = 0.0
+        self.carried_counters: Dict[str, Dict[str, float]] = {}
+        self.carried_stale_sessions_removed: int = 0
+
+
+    def pid(self) -> Optional[int]:
+        return self._process.pid if self._process is not None else None
+
+
+    def is_up(self) -> bool:
+        return self.last_report is not None and time.monotonic() - self.last_report_at <= REPORT_STALE_SECONDS
+
+
+    async def run(self) -> None:
+        """Runs the worker, starting it again whenever it exits, until stop() is called"""
+        await asyncio.sleep(self._start_delay_seconds)
+
+        while not self._stopping:
+            environment = dict(os.environ)
+            environment[WORKER_ID_ENV] = str(self.worker_id)
+            environment[SHARD_IDS_ENV] = ",".join(str(shard_id) for shard_id in self.shard_ids)
+            environment[SHARD_COUNT_ENV] = str(self._shard_count)
+            environment[COORDINATOR_ENV] = self._coordinator_address
+
+            self._process = await asyncio.create_subprocess_exec(sys.executable, VCSTATS_SCRIPT, env=environment)
+            print(f"Started worker {self.worker_id} (pid {self._process.pid}) with shards {self.shard_ids[0]}-{self.shard_ids[-1]}")
+
+            try:
+                self._usage = psutil.Process(self._process.pid)
+                # The first call only starts the measurement
+                self._usage.cpu_percent(None)
+            except psutil.Error:
+                self._usage = None
+
+            return_code: int = await self._process.wait()
+            self._usage = None
+
+            if self._stopping:
+                return
+
+            self.restarts += 1
+            print(f"Worker {self.worker_id} exited with code {return_code}, restarting in {RESTART_DELAY_SECONDS}s")
+            await asyncio.sleep(RESTART_DELAY_SECONDS)
+
+
+    async def stop(self) -> None:
+        """Lets the worker shut down like it would on its own, saving everyone first"""
+        self._stopping = True
+
+        if self._process is None or self._process.returncode is not None:
+            return
+
+        self._process.terminate()
+        try:
+            await asyncio.wait_for(self._process.wait(), timeout=STOP_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            print(f"Worker {self.worker_id} didn't stop in {STOP_TIMEOUT_SECONDS}s, killing it")
+            self._process.kill()
+            await self._process.wait()
+
+
+    def sample_usage(self) -> None:
+        """CPU use since the last sample, as a percentage of one core, and the resident memory"""
+        if self._usage is None:
+            self.cpu_percent = 0.0
+            self.memory_bytes = 0
+            return
+
+        try:
+            self.cpu_percent = self._usage.cpu_percent(None)
+            self.memory_bytes = self._usage.memory_info().rss
+        except psutil.Error:
+            self.cpu_percent = 0.0
+            self.memory_bytes = 0
+
+
+    def record_report(self, report: Dict[str, Any]) -> None:
+        # A restarted worker counts from zero again, so keep what the old process had counted
+        if self.last_report is not None and self.last_report.get("pid") != report.get("pid"):
+            for name, values in self.last_report.get("counters", {}).items():
+                carried = self.carried_counters.setdefault(name, {})
+                for label, value in values.items():
+                    carried[label] = carried.get(label, 0) + value
+            self.carried_stale_sessions_removed += self.last_report.get("reconciliation", {}).get("stale_sessions_removed", 0)
+
+        self.last_report = report
+        self.last_report_at = time.monotonic()
+
+
+class Coordinator:
+    """Collects the stats of every worker and hands the merged view back to them"""
+
+    def __init__(self, workers: List[WorkerProcess]):
+        self._workers: Dict[int, WorkerProcess] = {worker.worker_id: worker for worker in workers}
+        # The merged counters as of the last daily summary. Kept here rather than by the worker that posts it,
+        # so a restart of that worker doesn't report everything counted so far as the last 24 hours
+        self.summary_counts: Dict[str, Dict[str, float]] = {}
+
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            line: bytes = await asyncio.wait_for(reader.readline(), timeout=5)
+            report: Dict[str, Any] = json.loads(line)
+
+            worker: Optional[WorkerProcess] = self._workers.get(report.get("worker_id", -1))
+            if worker is not None:
+                worker.record_report(report)
+            if "summary_counts" in report:
+                self.summary_counts = report["summary_counts"]
+
+            writer.write(json.dumps(self.merged()).encode() + b"\n")
+            await writer.drain()
+        except Exception as error:
+            print(f"Error handling a worker report: {error}")
+        finally:
+            writer.close()
+
+
+    def merged(self) -> Dict[str, Any]:
+        """Everything the workers reported, added up, with each worker's own numbers next to it"""
+        guilds: Dict[str, int] = {}
+        sessions: int = 0
+        counters: Dict[str, Dict[str, float]] = {}
+        stale_sessions_removed: int = 0
+        sweep_passes: List[int] = []
+        slowest_sweep_pass_seconds: float = 0.0
+        workers: List[Dict[str, Any]] = []
+
+        for worker in self._workers.values():
+            for name, values in worker.carried_counters.items():
+                merged_values = counters.setdefault(name, {})
+                for label, value in values.items():
+                    merged_values[label] = merged_values.get(label, 0) + value
+
+            report: Dict[str, Any] = worker.last_report or {}
+
+            worker_guilds: Dict[str, int] = report.get("guilds", {})
+            guilds.update(worker_guilds)
+            sessions += report.get("sessions", 0)
+
+            for name, values in report.get("counters", {}).items():
+                merged_values = counters.setdefault(name, {})
+                for label, value in values.items():
+                    merged_values[label] = merged_values.get(label, 0) + value
+
+            reconciliation: Dict[str, Any] = report.get("reconciliation", {})
+            stale_sessions_removed += worker.carried_stale_sessions_removed + reconciliation.get("stale_sessions_removed", 0)
+            if reconciliation:
+                sweep_passes.append(reconciliation.get("sweep_passes_completed", 0))
+                slowest_sweep_pass_seconds = max(slowest_sweep_pass_seconds, reconciliation.get("last_sweep_pass_seconds", 0.0))
+
+            workers.append({
+                "worker_id": worker.worker_id,
+                "shard_ids": worker.shard_ids,
+                "pid": worker.pid(),
+                "up": worker.is_up(),
+                "restarts": worker.restarts,
+                "cpu_percent": worker.cpu_percent,
+                "memory_bytes": worker.memory_bytes,
+                "guilds": sum(worker_guilds.values()),
+                "sessions": report.get("sessions", 0),
+            })
+
+        return {
+            "guilds": guilds,
+            "total_guilds": sum(guilds.values()),
+            "sessions": sessions,
+            "counters": counters,
+            "reconciliation": {
+                "stale_sessions_removed": stale_sessions_removed,
+                # A sweep of the whole cluster is only as far along as its slowest worker
+                "sweep_passes_completed": min(sweep_passes) if sweep_passes else 0,
+                "last_sweep_pass_seconds": slowest_sweep_pass_seconds,
+            },
+            "workers": workers,
+            "summary_counts": self.summary_counts,
+        }
+
+
+    def register_metrics(self) -> None:
+        workers = self._workers.values()
+
+        registry.gauge_callback("vcstats_cluster_worker_up", "Whether the worker reported recently", lambda: {(str(worker.worker_id),): int(worker.is_up()) for worker in workers}, ("worker",))
+        registry.gauge_callback("vcstats_cluster_worker_cpu_percent", "CPU use of the worker, as a percentage of one core", lambda: {(str(worker.worker_id),): worker.cpu_percent for worker in workers}, ("worker",))
+        registry.gauge_callback("vcstats_cluster_worker_memory_bytes", "Resident memory of the worker", lambda: {(str(worker.worker_id),): worker.memory_bytes for worker in workers}, ("worker",))
+        registry.counter_callback("vcstats_cluster_worker_restarts_total", "Times the worker exited and was started again", lambda: {(str(worker.worker_id),): worker.restarts for worker in workers}, ("worker",))
+        registry.gauge_callback("vcstats_cluster_guilds_total", "Guilds across all workers", lambda: self.merged()["total_guilds"])
+        registry.gauge_callback("vcstats_cluster_tracking_queue_sessions", "Members in VC across all workers", lambda: self.merged()["sessions"])
+
+
+async def sample_usage(workers: List[WorkerProcess], interval_seconds: int) -> None:
+    while True:
+        await asyncio.sleep(interval_seconds)
+
+        for worker in workers:
+            worker.sample_usage()
+
+
+async def run_cluster() -> None:
+    shard_count: Optional[int] = getattr(config, "SHARD_COUNT", None)
+    identify_concurrency: int = getattr(config, "IDENTIFY_CONCURRENCY", 1)
+    if shard_count is None:
+        shard_count, identify_concurrency = await fetch_gateway_limits()
+
+    processes: int = getattr(config, "CLUSTER_PROCESSES", None) or os.cpu_count() or 1
+    host: str = getattr(config, "CLUSTER_COORDINATOR_HOST", "127.0.0.1")
+    port: int = getattr(config, "CLUSTER_COORDINATOR_PORT", 9200)
+
+    workers: List[WorkerProcess] = [
+        WorkerProcess(
+            worker_id,
+            shard_ids,
+            shard_count,
+            f"{host}:{port}",
+            start_delay_seconds=shard_ids[0] // identify_concurrency * IDENTIFY_INTERVAL_SECONDS
+        )
+        for worker_id, shard_ids in enumerate(shard_ranges(shard_count, processes))
+    ]
+    print(f"Running {shard_count} shards on {len(workers)} workers")
+
+    coordinator = Coordinator(workers)
+    server = await asyncio.start_server(coordinator.handle_connection, host, port)
+
+    coordinator.register_metrics()
+    try:
+        await start_metrics_server(getattr(config, "METRICS_HOST", "127.0.0.1"), getattr(config, "METRICS_PORT", 9108))
+    except Exception as error:
+        print(f"Error starting the metrics endpoint: {error}")
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stopping.set)
+
+    worker_tasks: List[asyncio.Task[None]] = [asyncio.create_task(worker.run()) for worker in workers]
+    usage_task = asyncio.create_task(sample_usage(workers, REPORT_INTERVAL_SECONDS))
+
+    await stopping.wait()
+
+    print("Stopping workers")
+    await asyncio.gather(*(worker.stop() for worker in workers))
+
+    # Every process is gone by now, the tasks can only still be waiting to start one
+    for task in worker_tasks:
+        task.cancel()
+    await asyncio.gather(*worker_tasks, return_exceptions=True)
+
+    usage_task.cancel()
+    server.close()
+    await server.wait_closed()
+    await stop_metrics_server()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_cluster())
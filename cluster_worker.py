@@ -0,0 +1,58 @@
+import asyncio
+import json
+import os
+
+from typing import Any, Dict, List, Optional
+
+# Set by cluster.py for each worker process it starts. Without them the bot runs every shard itself
+WORKER_ID_ENV = "VCSTATS_WORKER_ID"
+SHARD_IDS_ENV = "VCSTATS_SHARD_IDS"
+SHARD_COUNT_ENV = "VCSTATS_SHARD_COUNT"
+COORDINATOR_ENV = "VCSTATS_COORDINATOR"
+
+# How often each worker sends its stats to the coordinator
+REPORT_INTERVAL_SECONDS = 15
+
+
+def worker_id() -> Optional[int]:
+    """This process's worker number, or None if it isn't part of a cluster"""
+    value: Optional[str] = os.environ.get(WORKER_ID_ENV)
+    return int(value) if value else None
+
+
+def is_worker() -> bool:
+    return worker_id() is not None
+
+
+def shard_ids() -> List[int]:
+    """The shards this worker connects to, e.g. "4,5,6,7" """
+    return [int(shard_id) for shard_id in os.environ.get(SHARD_IDS_ENV, "").split(",") if shard_id]
+
+
+def shard_count() -> int:
+    """How many shards the whole cluster has"""
+    return int(os.environ[SHARD_COUNT_ENV])
+
+
+def worker_port(port: int) -> int:
+    """The coordinator listens on `port`, so each worker moves up past it"""
+    current_worker_id: Optional[int] = worker_id()
+    return port if current_worker_id is None else port + 1 + current_worker_id
+
+
+async def send_report(report: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Sends this worker's stats to the coordinator and returns the whole cluster merged together.
+    One JSON object per line each way.
+    """
+    host, port = os.environ[COORDINATOR_ENV].rsplit(":", 1)
+
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, int(port)), timeout=5)
+    try:
+        writer.write(json.dumps(report).encode() + b"\n")
+        await writer.drain()
+
+        reply: bytes = await asyncio.wait_for(reader.readline(), timeout=5)
+        return json.loads(reply)
+    finally:
+        writer.close()
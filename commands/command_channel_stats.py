@@ -0,0 +1,53 @@
+import hikari
+import lightbulb
+
+from typing import List, Optional
+from helper import seconds_to_timestamp
+from logging_stuff import increment_channel_stats_used
+from datastore import Datastore
+
+plugin = lightbulb.Plugin("command_channel_stats")
+datastore = Datastore()
+
+CHANNELS_SHOWN = 10
+
+@plugin.command
+@lightbulb.app_command_permissions(dm_enabled=False)
+@lightbulb.command("channelstats", "Shows the voice channels of this server with the most time spent in them")
+@lightbulb.implements(lightbulb.SlashCommand)
+async def channel_stats_command(e: lightbulb.Context) -> None:
+    # If bot tries to run commands, nothing will happen
+    if e.member and e.member.is_bot:
+        return
+
+    guild_id: Optional[int] = e.guild_id
+
+    if guild_id is None:
+        await e.respond("This command can only be used inside a server")
+        return
+
+    increment_channel_stats_used()
+
+    # Includes the time of everyone currently in VC, nothing gets saved here
+    channel_ids, times = await datastore.get_channel_times(guild_id, CHANNELS_SHOWN)
+
+    if not channel_ids:
+        await e.respond("Nobody has spent time in a voice channel on this server yet. Please join one to start tracking.")
+        return
+
+    lines: List[str] = [
+        f"**#{position}** <#{channel_id}>: {seconds_to_timestamp(channel_time)}"
+        for position, (channel_id, channel_time) in enumerate(zip(channel_ids, times), start=1)
+    ]
+
+    embed = hikari.Embed(
+        title="Voice Channels",
+        description="\n".join(lines),
+        color=0x3498db
+    )
+
+    await e.respond(embed=embed)
+
+
+def load(bot: lightbulb.BotApp) -> None:
+    bot.add_plugin(plugin)
@@ -24,6 +24,8 @@ def get_message() -> str:
                      
     /leaderboard - View the vc leaderboard for your server
                      
+    /channelstats - View the most used voice channels of your server
+                     
     /donate - If you wish to donate money
     ```
     **Administrator Commands**:
@@ -1,6 +1,8 @@
 import asyncio
+import config
 import random
 import textwrap
+import time
 import hikari
 import lightbulb
 
@@ -8,13 +10,28 @@ from helper import log_info_to_channel, seconds_to_timestamp
 from logging_stuff import increment_leaderboard_used
 from typing import List, Optional
 from datastore import Datastore
+from storage.backend import PERIOD_DAYS, LeaderboardWindow
+from perf_logging import record_timing
 
 plugin = lightbulb.Plugin("command_leaderboard")
 datastore = Datastore()
 
+PERIOD_TITLES = {"all": "All Time", "day": "Today", "week": "Last 7 Days", "month": "Last 30 Days"}
+
+NAMES_PER_PAGE = 10
+
+# The guilds using /leaderboard the most get their first pages rendered ahead of time, on a schedule
+HOT_GUILD_COUNT = getattr(config, "HOT_GUILD_COUNT", 20)
+HOT_GUILD_PAGES = 5
+HOT_GUILD_REFRESH_SECONDS = 15
+
+precompute_task: Optional[asyncio.Task[None]] = None
+
 @plugin.command
 @lightbulb.app_command_permissions(dm_enabled=False)
+@lightbulb.option("period", "Which time period to rank by", type=str, required=False, default="all", choices=list(PERIOD_TITLES))
 @lightbulb.option("page", "The page number to view", type=int, required=False, default=1, min_value=1)
+@lightbulb.option("mine", "Jump to the page you're on", type=bool, required=False, default=False)
 @lightbulb.command("leaderboard", "Shows your server's leaderboard")
 @lightbulb.implements(lightbulb.SlashCommand)
 async def leaderboard_command(e: lightbulb.Context) -> None:
@@ -30,109 +47,192 @@ async def leaderboard_command(e: lightbulb.Context) -> None:
     
     # Get page number from options (default to 1)
     page = e.options.page if hasattr(e.options, 'page') else 1
-    name_interval = 10  # Shows 10 names per page
+    name_interval = NAMES_PER_PAGE  # Shows 10 names per page
 
     requested_page = max(1, int(page))  # This is the page that the user wants to see. Ensure page is at least 1
 
-    all_times: Optional[List[int]] = None
-    all_members: Optional[List[int]] = None
+    period: str = getattr(e.options, "period", None) or "all"
+    if period not in PERIOD_TITLES:
+        period = "all"
 
-    try:
-        # Add timeout to prevent indefinite hanging
-        await asyncio.wait_for(
-            datastore.save_all(guild_id=guild_id), 
-            timeout=2.0  # 30 second timeout
+    # Jump to the page the user is on, wherever that is
+    if getattr(e.options, "mine", False) and e.member:
+        try:
+            _, position = await asyncio.wait_for(
+                datastore.get_user_time_and_position(e.member.id, guild_id, period if period in PERIOD_DAYS else None),
+                timeout=2.0
+            )
+        except Exception as error:
+            print(f"Error fetching leaderboard position: {error}")
+            position = None
+
+        if position is None:
+            await e.respond("You aren't on this leaderboard yet. Join a voice channel to get on it!")
+            return
+
+        requested_page = (position - 1) // name_interval + 1
+
+    hot_guilds = datastore.get_hot_guilds()
+    hot_guilds.record(guild_id, period)
+
+    # The hottest guilds have their first pages rendered already. Otherwise, serve the page
+    # straight from the cache if it was rendered recently
+    leaderboard_body: Optional[str] = hot_guilds.get_page(guild_id, requested_page, period)
+    if leaderboard_body is None:
+        leaderboard_body = datastore.get_leaderboard_cache().get(guild_id, requested_page, period)
+
+    if leaderboard_body is None:
+        leaderboard_body = await build_leaderboard_page(e, guild_id, requested_page, name_interval, period)
+
+        if leaderboard_body is None:
+            return
+
+        datastore.get_leaderboard_cache().put(guild_id, requested_page, leaderboard_body, period)
+
+    title = f"Voice Call Leaderboard [{PERIOD_TITLES[period]}]"
+
+    increment_leaderboard_used()
+
+    donateMessage = textwrap.dedent(f"""\
+        If you find this bot useful, consider
+        [buying me a coffee on ko-fi!](<https://ko-fi.com/kyrobi>) :heart:
+        """)
+    
+    # Create embed
+    randomNum = random.randint(1, 20)
+    if randomNum == 1:
+
+        embed = hikari.Embed(
+            title=title,
+            description=f"{leaderboard_body}\n\n{donateMessage}",
+            color=0x3498db
         )
-    except asyncio.TimeoutError:
-        await e.respond("The leaderboard is temporarily unavailable. Please try again later.")
-        return
-    except Exception as error:
-        print(f"Error in leaderboard save_all: {error}")
-        await e.respond("An error occurred while updating the leaderboard. Please try again later.")
-        return
+        await e.respond(embed)
+
+        # Guilds aren't cached, so the name is only there if it happens to be. Not worth a REST call for a log line
+        guild: Optional[hikari.GatewayGuild] = e.get_guild()
+        await log_info_to_channel(
+            channel_id=1301007012028743750, 
+            message=f"{guild.name if guild else guild_id}\nwas showned a donation message! /leaderboard"
+            )
+
+    else:
+        embed = hikari.Embed(
+            title=title,
+            description=leaderboard_body,
+            color=0x3498db
+        )
+        await e.respond(embed)
+
+
+async def build_leaderboard_page(e: lightbulb.Context, guild_id: int, requested_page: int, name_interval: int, period: str = "all") -> Optional[str]:
+    """
+    Fetches just the requested page of the leaderboard and renders it.
+    Responds with the error and returns None if the page can't be shown.
+    """
+    start_idx: int = (requested_page - 1) * name_interval
 
     try:
-        # Get leaderboard data with timeout
-        all_members, all_times = await asyncio.wait_for(
-            datastore.get_leaderboard_members_and_time(guild_id),
+        # Get the page with timeout. This includes the time of everyone currently in VC,
+        # without saving it first
+        page: LeaderboardWindow = await asyncio.wait_for(
+            datastore.get_leaderboard_page(guild_id, start_idx, name_interval, period if period in PERIOD_DAYS else None),
             timeout=2.0
         )
     except asyncio.TimeoutError:
         await e.respond("The leaderboard is temporarily unavailable. Please try again later.")
-        return
+        return None
     except Exception as error:
         print(f"Error fetching leaderboard data: {error}")
         await e.respond("An error occurred while updating the leaderboard. Please try again later.")
-        return
-    
-    increment_leaderboard_used()
+        return None
 
     # Validate requested page
-    pages_possible = max(1, (len(all_members) + name_interval - 1) // name_interval)
+    pages_possible = count_pages(page.member_count, name_interval)
     if requested_page > pages_possible:
         await e.respond(f"Page {requested_page} does not exist. Pages available: {pages_possible}")
-        return
-    # print(f"All members: {all_members}")
+        return None
 
-    # Get names for the requested page
-    start_idx: int = (requested_page - 1) * name_interval
-    end_idx: int = start_idx + name_interval
-    paged_members: List[int] = all_members[start_idx:end_idx]
-    paged_times: List[int] = all_times[start_idx:end_idx]
+    return render_leaderboard_page(page.entries, start_idx, requested_page, pages_possible, page.total_time, period)
+
+
+def count_pages(member_count: int, name_interval: int) -> int:
+    return max(1, (member_count + name_interval - 1) // name_interval)
 
+
+def render_leaderboard_page(entries: List[tuple[int, int]], start_idx: int, requested_page: int, pages_possible: int, total_time: int, period: str) -> str:
+    """Renders (member_id, time) starting at 0-based position start_idx as the requested page"""
     # Build the leaderboard entries
     leaderboard_entries: List[str] = []
-    for i, member_id in enumerate(paged_members):
+    for i, (member_id, member_time) in enumerate(entries):
         position = start_idx + i + 1  # Position in the overall leaderboard
-        time_spent = seconds_to_timestamp(paged_times[i])
+        time_spent = seconds_to_timestamp(member_time)
         # Format each entry with member ID and their time
         leaderboard_entries.append(f"**{position}.** <@{member_id}>: {time_spent}")
     
     leaderboard_content: str = "\n".join(leaderboard_entries)
     
-    # Sum up all the time
-    total_time: int = sum(all_times)
-    
+    # The total is kept up to date by the database, so it doesn't need every member's time
     server_total: str = f"**Server total**: {seconds_to_timestamp(total_time)}\n\n"
     
     result_suffix: str = f"Page ({requested_page}/{pages_possible})"
     next_page_notice: str = ""
     
     if requested_page < pages_possible:
-        next_page_notice = f"\nDo `/leaderboard {requested_page + 1}` for more results."
-    
-    donateMessage = textwrap.dedent(f"""\
-        If you find this bot useful, consider
-        [buying me a coffee on ko-fi!](<https://ko-fi.com/kyrobi>) :heart:
-        """)
-    
-    # Create embed
-    randomNum = random.randint(1, 20)
-    if randomNum == 1:
+        period_option = f" period:{period}" if period != "all" else ""
+        next_page_notice = f"\nDo `/leaderboard page:{requested_page + 1}{period_option}` for more results."
 
-        embed = hikari.Embed(
-            title="Voice Call Leaderboard [Top 200]",
-            description=f"{leaderboard_content}\n\n{server_total}{result_suffix}{next_page_notice}\n\n{donateMessage}",
-            color=0x3498db
-        )
-        await e.respond(embed)
+    return f"{leaderboard_content}\n\n{server_total}{result_suffix}{next_page_notice}"
 
-        guild: Optional[hikari.Guild] = await plugin.app.rest.fetch_guild(guild_id)
-        if guild:
-            await log_info_to_channel(
-                channel_id=1301007012028743750, 
-                message=f"{guild.name}\nwas showned a donation message! /leaderboard" # type: ignore
-                )
 
-    else:
-        embed = hikari.Embed(
-            title="Voice Call Leaderboard [Top 200]",
-            description=f"{leaderboard_content}\n\n{server_total}{result_suffix}{next_page_notice}",
-            color=0x3498db
-        )
-        await e.respond(embed)
+async def precompute_hot_guilds(interval_seconds: int) -> None:
+    """
+    Renders the first pages of the guilds using /leaderboard the most, so they're answered without
+    touching the database. Each guild and period is one window read, with nothing saved first.
+    Guilds that cool down fall back to building their pages when asked.
+    """
+    hot_guilds = datastore.get_hot_guilds()
+
+    while True:
+        await asyncio.sleep(interval_seconds)
+
+        start = time.perf_counter()
+
+        hot_guilds.decay(interval_seconds)
+        hottest: List[tuple[int, List[str]]] = hot_guilds.hottest(HOT_GUILD_COUNT)
+        hot_guilds.retain(hottest)
+
+        for guild_id, periods in hottest:
+            for period in periods:
+                try:
+                    page: LeaderboardWindow = await datastore.get_leaderboard_page(
+                        guild_id, 0, HOT_GUILD_PAGES * NAMES_PER_PAGE, period if period in PERIOD_DAYS else None
+                    )
+                except Exception as error:
+                    print(f"Error precomputing the leaderboard of {guild_id}: {error}")
+                    continue
+
+                pages_possible = count_pages(page.member_count, NAMES_PER_PAGE)
+                hot_guilds.set_pages(guild_id, period, {
+                    page_number: render_leaderboard_page(
+                        page.entries[(page_number - 1) * NAMES_PER_PAGE:page_number * NAMES_PER_PAGE],
+                        (page_number - 1) * NAMES_PER_PAGE, page_number, pages_possible, page.total_time, period
+                    )
+                    for page_number in range(1, min(HOT_GUILD_PAGES, pages_possible) + 1)
+                })
+
+        end = time.perf_counter()
+        elapsed_ms = (end - start) * 1000
+        record_timing("precompute_hot_guilds", elapsed_ms)
+
+
+@plugin.listener(hikari.StartedEvent)
+async def on_started(event: hikari.StartedEvent) -> None:
+    global precompute_task
+
+    if precompute_task is None:
+        precompute_task = asyncio.create_task(precompute_hot_guilds(HOT_GUILD_REFRESH_SECONDS))
 
-    
 
 def load(bot: lightbulb.BotApp) -> None:
     bot.add_plugin(plugin)
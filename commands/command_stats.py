@@ -4,7 +4,7 @@ import hikari
 import lightbulb
 
 from typing import Optional
-from helper import log_info_to_channel, make_key, seconds_to_timestamp
+from helper import log_info_to_channel, seconds_to_timestamp
 from logging_stuff import increment_stats_used
 from datastore import Datastore
 
@@ -36,12 +36,9 @@ async def status_command(e: lightbulb.Context) -> None:
     
     increment_stats_used()
     
-    # If the user is actively in the VC, we add onto the time in the database
-    dict_key = make_key(user_id, guild_id)
-    if dict_key in datastore.get_tracking_queue():
-        await datastore.save_single(user_id, guild_id)
-    
-    db_total_time, leaderboard_position = await datastore.get_user_time_and_position(user_id, guild_id) # Current time in the database
+    # If the user is actively in the VC, the time since they joined is added on top of the
+    # time in the database. Nothing gets saved here, that's left to the regular saves
+    db_total_time, leaderboard_position = await datastore.get_user_time_and_position(user_id, guild_id)
 
     # print(f"db_total_time: {db_total_time}, leaderboard_position: {leaderboard_position}")
     if leaderboard_position is not None:
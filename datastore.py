@@ -1,205 +1,663 @@
 import config
 import asyncio
-import valkey.asyncio as valkey
 import time
 
-from typing import List, Optional, Dict
-from objects.user import User
+import cluster_worker
+
+from typing import AsyncContextManager, Callable, Dict, List, Optional
+from objects.batch_sizer import BatchSizer
+from objects.flush_report import FlushReport
+from objects.guild_locks import GuildLocks
+from objects.hot_guilds import HotGuilds
+from objects.leaderboard_cache import LeaderboardCache
+from objects.session_journal import RecoveredSessions, ShardedSessionJournal
+from objects.session_snapshot import SessionSnapshot, decode_snapshot, encode_snapshot
+from objects.session_table import SessionTable
+from perf_logging import record_timing
+from storage.backend import PERIOD_DAYS, LeaderboardWindow, StorageBackend, create_backend, merge_window, period_start
+from write_buffer import ChannelIncrement, Increment, WriteBuffer
 
 DATABASE_NOT_CONNECTED_MESSAGE = "Database is not connected..."
 
-tracking_queue: Dict[str, User] = {}
-tracking_queue_lock = asyncio.Lock()
+# Discord's limit on channels per guild
+MAX_GUILD_CHANNELS = 500
 
+tracking_queue: SessionTable = SessionTable()
+tracking_queue_locks: GuildLocks = GuildLocks(stripes=64)
 
-# Define the connection pools
-connection_pool = None
+# Leave-time saves are collected here and written out in batches
+write_buffer = WriteBuffer(flush_interval_seconds=0.5, max_entries=500)
 
-# Establish the actual connections
-connection = None
+# Append-only log of session changes, so a crash doesn't lose anyone's time
+# In a cluster there's one per shard, so the sessions move along with the shard when another worker gets it
+session_journal = ShardedSessionJournal(
+    getattr(config, "SESSION_JOURNAL_PATH", "session_journal.bin"),
+    cluster_worker.shard_ids() if cluster_worker.is_worker() else None,
+    cluster_worker.shard_count() if cluster_worker.is_worker() else 1
+)
+
+# Sessions recovered from the journal on startup that haven't been matched to a voice state yet
+recovered_sessions: RecoveredSessions = RecoveredSessions()
+
+# Everyone in VC is handed over to the next process through the backend when the bot stops, since a deploy
+# may start it somewhere without this journal. Kept for as long as a restart could reasonably take
+SESSION_SNAPSHOT_TTL_SECONDS = 600
+
+# Rendered /leaderboard pages. Dropped for a guild as soon as new time is written for it
+leaderboard_cache = LeaderboardCache(max_entries=2000, max_age_seconds=30)
+
+# How often each guild uses /leaderboard, and the first pages of the hottest ones rendered ahead of time
+hot_guilds = HotGuilds(half_life_seconds=600)
+
+
+# Where the time gets stored, picked by config.STORAGE_BACKEND
+backend: Optional[StorageBackend] = None
+
+# How big the batches sent to each part of the backend are, adjusted to how long they take
+batch_sizers: Dict[str, BatchSizer] = {}
+
+# How the last write to the database went
+last_flush_report: FlushReport = FlushReport()
 
 class Datastore:
 
     async def initialize(self):
-        global connection_pool
-        global connection
-
-        # Define the connection pools
-        connection_pool = valkey.ConnectionPool(
-            host=config.VALKEY_HOST, 
-            port=config.VALKEY_PORT, 
-            db=0,
-            retry_on_timeout=True,
-            socket_timeout=30,
-            socket_connect_timeout=30,
-            max_connections=20,
-            )
-        
+        global backend
+
+        backend = create_backend()
+        await backend.connect()
+
+        write_buffer.start(self.write_increments)
 
-        # Establish the actual connections
-        connection = valkey.Valkey(connection_pool=connection_pool)
+        self.recover_from_journal()
+
+        # Before any voice states come in, so they get matched against the handed over sessions
+        await self.restore_session_snapshot()
 
 
     async def uninitialize(self):
-        # Close the clients
-        if connection:
-            await connection.aclose()
+        # Write out anything that is still waiting in the buffer
+        await write_buffer.stop()
+
+        session_journal.close()
+
+        if backend:
+            await backend.close()
 
-        # Close the connection pools
-        if connection_pool:
-            await connection_pool.aclose()
 
+    def get_storage_backend(self) -> Optional[StorageBackend]:
+        return backend
 
-    def get_tracking_queue(self) -> Dict[str, User]:
+
+    def get_tracking_queue(self) -> SessionTable:
         return tracking_queue
     
-    def get_tracking_queue_lock(self) -> asyncio.Lock:
-        return tracking_queue_lock
+    def get_tracking_queue_lock(self, guild_id: int) -> AsyncContextManager[None]:
+        """Lock for the part of the tracking queue that belongs to the guild"""
+        return tracking_queue_locks.for_guild(guild_id)
 
+    def get_tracking_queue_locks(self) -> GuildLocks:
+        return tracking_queue_locks
 
-    async def insert(self, user_id: int, time_difference: int, server_id: int):
-        """Do not call this method directly. It's used by functions liked save_single()"""
-        try:
-            if connection:
-                key = f"guild:{server_id}"
+    def get_write_buffer(self) -> WriteBuffer:
+        return write_buffer
 
-                await connection.zadd(
-                    key, 
-                    {str(user_id): time_difference}, 
-                    incr=True
-                )
-            else:
-                print(DATABASE_NOT_CONNECTED_MESSAGE)
+    def get_last_flush_report(self) -> FlushReport:
+        return last_flush_report
 
-        except Exception as error:
-            print(f"Error inserting data: {error}")
+
+    def get_leaderboard_cache(self) -> LeaderboardCache:
+        return leaderboard_cache
+
+
+    def get_hot_guilds(self) -> HotGuilds:
+        return hot_guilds
+
+
+    def start_tracking(self, user_id: int, guild_id: int, joined_time: int, channel_id: int = 0) -> None:
+        """Call while holding get_tracking_queue_lock(guild_id)"""
+        tracking_queue.add(user_id, guild_id, joined_time, channel_id)
+        session_journal.record_join(user_id, guild_id, joined_time)
+
+
+    async def start_tracking_guild(self, guild_id: int, members: List[tuple[int, int]]) -> int:
+        """
+        Starts tracking everyone in the guild who is in VC, given as (user_id, channel_id), all under a
+        single lock acquisition. Anyone recovered from the journal keeps their original join time, and
+        the recovered sessions that are no longer in VC get saved. Returns how many sessions were added.
+        """
+        current_time = int(time.time())
+
+        async with tracking_queue_locks.for_guild(guild_id):
+            recovered_guild_sessions: Dict[int, int] = recovered_sessions.sessions.get(guild_id, {})
+
+            sessions: List[tuple[int, int, int]] = [
+                (user_id, recovered_guild_sessions.pop(user_id, current_time), channel_id)
+                for user_id, channel_id in members
+                if not tracking_queue.contains(user_id, guild_id)
+            ]
+            added: List[tuple[int, int, int]] = tracking_queue.add_guild(guild_id, sessions)
+
+            for user_id, joined_time, _ in added:
+                session_journal.record_join(user_id, guild_id, joined_time)
+
+            # Anyone else recovered from the journal for this guild left while the bot was down
+            self.finish_guild_recovery(guild_id)
+
+        return len(added)
+
+
+    def stop_tracking(self, user_id: int, guild_id: int) -> None:
+        """Call while holding get_tracking_queue_lock(guild_id). Doesn't save, call save_single() first"""
+        if tracking_queue.pop(user_id, guild_id) is not None:
+            session_journal.record_leave(user_id, guild_id)
 
 
     async def save_single(self, user_id1: int, guild_id1: int) -> None:
-        from helper import make_key
+        current_time = int(time.time())
+        channel_id: Optional[int] = tracking_queue.get_channel_id(user_id1, guild_id1)
 
-        dict_key: str = make_key(user_id1, guild_id1)
+        # Also updates the join time to current so that the difference calculation doesn't break
+        time_difference: Optional[int] = tracking_queue.take_time_difference(user_id1, guild_id1, current_time)
 
-        if dict_key not in tracking_queue:
+        if time_difference is None or time_difference <= 0:
             return
 
-        user_from_tracking_queue: User = tracking_queue[dict_key]
+        # Queue the time to be saved, for the member and for the channel they were in
+        write_buffer.add(guild_id1, user_id1, time_difference)
+        write_buffer.add_channel(guild_id1, channel_id or 0, time_difference)
+        session_journal.record_save(user_id1, guild_id1, current_time)
 
-        user_id: int = user_from_tracking_queue.get_user_id()
-        time_difference: int = int(time.time() - user_from_tracking_queue.get_joined_time())
-        guild_id: int = user_from_tracking_queue.get_guild_id()
 
-        if time_difference <= 0:
+    async def switch_channel(self, user_id: int, guild_id: int, channel_id: int) -> None:
+        """
+        Closes the member's segment in their old channel and starts one in the new channel.
+        The time goes into the write buffer like any other save, so nothing is written here.
+        Call while holding get_tracking_queue_lock(guild_id).
+        """
+        if not tracking_queue.contains(user_id, guild_id):
             return
 
-        # Save the time, and then update the time to current so that
-        # the difference calculation doesn't break
-        if connection is not None:
-            try:
-                start = time.perf_counter()
-                await self.insert(user_id, time_difference, guild_id)
-                end = time.perf_counter()
-                elapsed_ms = (end - start) * 1000
-                from helper import log_info_to_channel
-                await log_info_to_channel(1377205400981602334,f"`insert` completed in {elapsed_ms:.3f}ms")
-            finally:
-                user_from_tracking_queue.set_joined_time(int(time.time()))
+        await self.save_single(user_id, guild_id)
+        tracking_queue.set_channel_id(user_id, guild_id, channel_id)
 
 
     async def save_all(self, guild_id: Optional[int]) -> None:
         """
         Pass in a guild_id if you want to only bulk save a specific guild
         """
-        if not connection:
+        if not backend:
             print(DATABASE_NOT_CONNECTED_MESSAGE)
             return
         
-        user_ids: List[int] = []
-        time_differences: List[int] = []
-        server_ids: List[int] = []
+        current_time = int(time.time())
 
+        # Computes every time difference and resets the join times in one pass.
+        # For a single guild, only that guild's members are looked at
+        guild_ids, user_ids, time_differences, channel_ids = tracking_queue.take_all_time_differences(guild_id, current_time)
 
-        current_time = int(time.time())
+        for i in range(len(user_ids)):
+            write_buffer.add(guild_ids[i], user_ids[i], time_differences[i])
+            write_buffer.add_channel(guild_ids[i], channel_ids[i], time_differences[i])
+
+        if user_ids:
+            session_journal.record_save_guild(guild_id, current_time)
+
+        start = time.perf_counter()
+
+        # Write out everything that is pending, including the leave-time saves
+        # that are already waiting in the buffer
+        await write_buffer.flush()
+
+        end = time.perf_counter()
+        elapsed_ms = (end - start) * 1000
+        record_timing("save_all", elapsed_ms)
+
+        if guild_id is None and user_ids:
+            print(f"Saved everyone: {last_flush_report.describe()}")
+
+
+    async def stop_tracking_guild(self, guild_id: int) -> None:
+        """Saves everyone in the guild and then removes them from the tracking queue"""
+        await self.save_all(guild_id)
 
-        # Iterate through a copy of the list to avoid size changing while iterating 
-        for user in tracking_queue.copy().values():
-            if guild_id is None or guild_id == user.get_guild_id():
-                time_difference: int = current_time - user.get_joined_time()
+        async with tracking_queue_locks.for_guild(guild_id):
+            if tracking_queue.pop_guild(guild_id):
+                session_journal.record_leave_guild(guild_id)
 
-                if(time_difference <= 0):
+
+    async def remove_stale_sessions(self, sessions: List[tuple[int, int]], is_stale: Callable[[int, int], bool]) -> int:
+        """
+        Saves and stops tracking (user_id, guild_id) sessions whose leave event was missed.
+        is_stale(user_id, guild_id) is asked again under the guild's lock, since the member may have
+        joined again after the sessions were picked. Those are left alone.
+        All of their time is written in one batch. Returns how many sessions were removed.
+        """
+        removed: int = 0
+
+        for user_id, guild_id in sessions:
+            async with tracking_queue_locks.for_guild(guild_id):
+                # Gone already, e.g. the leave event came in after all
+                if not tracking_queue.contains(user_id, guild_id) or not is_stale(user_id, guild_id):
                     continue
 
-                time_differences.append(time_difference)
-                user_ids.append(user.get_user_id())
-                server_ids.append(user.get_guild_id())
+                await self.save_single(user_id, guild_id)
+                self.stop_tracking(user_id, guild_id)
+                removed += 1
+
+        if removed:
+            await write_buffer.flush()
+
+        return removed
+
+
+    def recover_from_journal(self) -> None:
+        """
+        Replays the session journal. Time that never made it to the database gets queued again, and the
+        sessions of everyone who was in VC are kept until their guild becomes available again.
+        """
+        global recovered_sessions
+
+        try:
+            recovered_sessions = session_journal.open()
+        except Exception as error:
+            print(f"Error reading the session journal: {error}")
+            return
+
+        for guild_id, user_id, time_difference in recovered_sessions.unsaved:
+            write_buffer.add(guild_id, user_id, time_difference)
+
+        session_count: int = sum(len(guild_sessions) for guild_sessions in recovered_sessions.sessions.values())
+        print(f"Recovered {len(recovered_sessions.unsaved)} unsaved times and {session_count} sessions from the session journal")
+
+
+    def session_snapshot_name(self, shard_id: Optional[int]) -> str:
+        # In a cluster each shard is handed over on its own, to whichever worker owns it next
+        return "sessions" if shard_id is None else f"sessions_shard{shard_id}"
 
-                # Make sure to update the time delta once saving
-                user.set_joined_time(current_time)
 
-        # Assumes there nothing to save, so don't run the rest of the code
-        if not user_ids: 
+    async def write_session_snapshot(self) -> None:
+        """
+        Hands everyone who is in VC over to the next process, in a single write. Call after save_all(None),
+        so all of their time so far is already in the database and only the join times are needed.
+        """
+        if not backend:
+            print(DATABASE_NOT_CONNECTED_MESSAGE)
             return
 
         start = time.perf_counter()
-        
-        BATCH_SIZE = 100
 
-        for i in range(0, len(user_ids), BATCH_SIZE):
-            pipe = None
-            try:
-                await connection.ping() # type: ignore If the ping fails (i.e can't contact server), it raises and exception
-                async with asyncio.timeout(30):
-                    async with connection.pipeline(transaction=False) as pipe:
-                        for j in range(i, min(i + BATCH_SIZE, len(user_ids))):
-                            key = f"guild:{server_ids[j]}"
-                            pipe.zadd(key, {str(user_ids[j]): time_differences[j]}, incr=True)
-                        
-                        await pipe.execute()
+        sessions: List[tuple[int, int, int]] = tracking_queue.sessions_with_joined_times()
+
+        # Every shard gets one, even an empty one, so the next process knows all of them were handed over
+        shard_sessions: Dict[Optional[int], List[tuple[int, int, int]]] = {shard_id: [] for shard_id in session_journal.shard_ids()}
+        for session in sessions:
+            shard_sessions.setdefault(session_journal.shard_of(session[1]), []).append(session)
+
+        written_at = int(time.time())
+        size: int = 0
+
+        try:
+            for shard_id, snapshot_sessions in shard_sessions.items():
+                data: bytes = encode_snapshot(snapshot_sessions, written_at)
+                await backend.save_snapshot(self.session_snapshot_name(shard_id), data, SESSION_SNAPSHOT_TTL_SECONDS)
+                size += len(data)
+        except Exception as error:
+            print(f"Error writing the session snapshot: {error}")
+            return
+
+        end = time.perf_counter()
+        elapsed_ms = (end - start) * 1000
+        record_timing("write_session_snapshot", elapsed_ms)
+
+        print(f"Handed over {len(sessions)} sessions ({size} bytes) in {elapsed_ms:.1f}ms")
+
+
+    async def restore_session_snapshot(self) -> None:
+        """
+        Takes the sessions the previous process handed over. They're reconciled the same way as the ones
+        recovered from the journal: matched as the voice states come in, and saved up to when the snapshot
+        was written for anyone who left in between.
+        """
+        global recovered_sessions
+
+        if not backend:
+            return
+
+        start = time.perf_counter()
+
+        snapshots: List[SessionSnapshot] = []
+
+        try:
+            for shard_id in session_journal.shard_ids():
+                data: Optional[bytes] = await backend.take_snapshot(self.session_snapshot_name(shard_id))
+                if data is not None:
+                    snapshots.append(decode_snapshot(data))
+        except Exception as error:
+            print(f"Error reading the session snapshot: {error}")
+            return
+
+        if not snapshots:
+            return
+
+        # Only all or nothing, e.g. a worker that had some of the shards may have crashed instead of handing them over
+        if len(snapshots) < len(session_journal.shard_ids()):
+            print("Not every shard was handed over, skipping the session snapshot")
+            return
+
+        written_at: int = min(snapshot.written_at for snapshot in snapshots)
+
+        # The journal wins if it's newer, e.g. a process that took the snapshot crashed afterwards
+        if written_at < recovered_sessions.last_alive:
+            print("Session snapshot is older than the session journal, skipping it")
+            return
+
+        # Written after save_all, so it has everyone the journal has and more up to date
+        sessions: Dict[int, Dict[int, int]] = {}
+        guild_sessions: Dict[int, int] = {}
+        previous_guild_id: Optional[int] = None
+
+        # Sorted by guild, so each guild's dict only has to be looked up once
+        for snapshot in snapshots:
+            for guild_id, user_id, joined_time in zip(snapshot.guild_ids, snapshot.user_ids, snapshot.joined_times):
+                if guild_id != previous_guild_id:
+                    guild_sessions = sessions.setdefault(guild_id, {})
+                    previous_guild_id = guild_id
+                guild_sessions[user_id] = joined_time
 
+        recovered_sessions.sessions = sessions
+        recovered_sessions.last_alive = written_at
+
+        end = time.perf_counter()
+        elapsed_ms = (end - start) * 1000
+        record_timing("restore_session_snapshot", elapsed_ms)
+
+        print(f"Restored {sum(len(snapshot) for snapshot in snapshots)} sessions from the session snapshot in {elapsed_ms:.1f}ms")
+
+
+    def finish_guild_recovery(self, guild_id: Optional[int]) -> None:
+        """
+        Everyone recovered from the journal who is no longer in VC left while the bot was down.
+        Their time is saved up to the last moment the bot was known to be running.
+        Pass None to do this for every guild that's left, e.g. guilds that never became available again.
+        """
+        guild_ids: List[int] = list(recovered_sessions.sessions) if guild_id is None else [guild_id]
+
+        for recovered_guild_id in guild_ids:
+            guild_sessions = recovered_sessions.sessions.pop(recovered_guild_id, {})
+
+            for user_id, joined_time in guild_sessions.items():
+                write_buffer.add(recovered_guild_id, user_id, recovered_sessions.last_alive - joined_time)
+                session_journal.record_save(user_id, recovered_guild_id, recovered_sessions.last_alive)
+                session_journal.record_leave(user_id, recovered_guild_id)
+
+
+    def journal_heartbeat(self) -> None:
+        session_journal.record_heartbeat(int(time.time()))
+
+
+    async def compact_journal(self, min_fill_ratio: float) -> None:
+        """Rewrites the session journal from the current state once it's more than min_fill_ratio full"""
+        # Recovered sessions only live in the journal until they're matched, so keep the history until then
+        if recovered_sessions.sessions or session_journal.fill_ratio() < min_fill_ratio:
+            return
+
+        start = time.perf_counter()
+
+        # No flush can be halfway done while the state is copied
+        async with write_buffer.get_flush_lock():
+            try:
+                session_journal.compact(
+                    tracking_queue.sessions_with_joined_times(),
+                    write_buffer.pending_increments(),
+                    int(time.time())
+                )
             except Exception as error:
-                print(f"Error in batch {i//BATCH_SIZE + 1} {error}")
+                print(f"Error compacting the session journal: {error}")
 
         end = time.perf_counter()
         elapsed_ms = (end - start) * 1000
-        from helper import log_info_to_channel
-        await log_info_to_channel(1377200295389565020,f"`save_all` completed in {elapsed_ms:.3f}ms")
-        
+        record_timing("compact_journal", elapsed_ms)
+
+
+    async def write_increments(self, increments: List[Increment], channel_increments: List[ChannelIncrement]) -> tuple[List[Increment], List[ChannelIncrement]]:
+        """
+        Writes the increments in batches, with the batches of every part of the backend (e.g. every Valkey node)
+        running at the same time. The channel increments ride along with the first batch of their part.
+        Returns the increments that were not written so the write buffer can retry them. Batches that may
+        have been written are not returned.
+        Use save_single() / save_all() instead of calling this directly.
+        """
+        global last_flush_report
+
+        if not backend:
+            print(DATABASE_NOT_CONNECTED_MESSAGE)
+            return increments, channel_increments
+
+        start = time.perf_counter()
+
+        # Everything in the journal up to here is part of this write
+        journal_position: Dict[Optional[int], int] = session_journal.position()
+
+        report = FlushReport()
+        report.keys = len(increments)
+
+        try:
+            partitioned: Dict[str, List[Increment]] = backend.partition(increments)
+            partitioned_channels: Dict[str, List[ChannelIncrement]] = backend.partition(channel_increments)
+        except Exception as error:
+            # Nothing has been sent yet
+            print(f"Error writing to the database: {error}")
+            return increments, channel_increments
+
+        partition_names: List[str] = list(partitioned) + [name for name in partitioned_channels if name not in partitioned]
+
+        results: List[tuple[List[Increment], List[ChannelIncrement]]] = await asyncio.gather(*(
+            self.write_partition_increments(partition_name, partitioned.get(partition_name, []), report, partitioned_channels.get(partition_name, []))
+            for partition_name in partition_names
+        ))
+
+        failed: List[Increment] = [increment for node_failed, _ in results for increment in node_failed]
+        failed_channels: List[ChannelIncrement] = [increment for _, node_failed in results for increment in node_failed]
+
+        # Everything up to the position is settled, and what is going to be retried is queued again after it
+        session_journal.record_flushed(journal_position)
+        for guild_id, user_id, time_difference in failed:
+            session_journal.record_pending(user_id, guild_id, time_difference)
+
+        end = time.perf_counter()
+        report.wall_ms = (end - start) * 1000
+        last_flush_report = report
+
+        return failed, failed_channels
+
+
+    async def write_partition_increments(
+        self, partition_name: str, increments: List[Increment], report: FlushReport, channel_increments: List[ChannelIncrement]
+    ) -> tuple[List[Increment], List[ChannelIncrement]]:
+        """
+        Writes increments that all belong to one part of the backend. The batches are sent concurrently, up to
+        what the backend can take (e.g. a node's connection pool), and are sized by how long the previous ones took.
+        Returns the increments that could not be written.
+        """
+        assert backend is not None
+
+        failed: List[Increment] = []
+        failed_channels: List[ChannelIncrement] = []
+        sizer: BatchSizer = batch_sizers.setdefault(partition_name, BatchSizer())
+
+        # Each worker takes the next batch off the front. The batch size is read when a batch is
+        # taken, so every finished batch adjusts the ones after it
+        offset = 0
+
+        # There's only one per channel, so they all go with whichever batch is taken first
+        unsent_channels: List[ChannelIncrement] = channel_increments
+
+        async def send_batches() -> None:
+            nonlocal offset, unsent_channels
+
+            while offset < len(increments) or unsent_channels:
+                batch = increments[offset:offset + sizer.batch_size]
+                offset += len(batch)
+                batch_channels, unsent_channels = unsent_channels, []
+                report.batches += 1
+
+                start = time.perf_counter()
+                try:
+                    # A failed connection raises on its own, so there's no need to ping first
+                    async with asyncio.timeout(30):
+                        await backend.increment(batch, batch_channels)
+
+                except Exception as error:
+                    sizer.record_failure()
+
+                    if backend.write_not_sent(error):
+                        print(f"Error writing a batch of {len(batch)} to {partition_name}, retrying it: {error}")
+                        failed.extend(batch)
+                        failed_channels.extend(batch_channels)
+                        report.failed_batches += 1
+                    else:
+                        # Sending it again could count it twice
+                        print(f"Error writing a batch of {len(batch)} to {partition_name}, it may have been written: {error}")
+                        report.uncertain_batches += 1
+                        for guild_id, _, _ in batch:
+                            leaderboard_cache.invalidate_guild(guild_id)
+                    continue
+
+                end = time.perf_counter()
+                elapsed_ms = (end - start) * 1000
+                record_timing("write_batch", elapsed_ms)
+                sizer.record_success(elapsed_ms)
+
+                # The cached leaderboards of these guilds are now out of date
+                for guild_id, _, _ in batch:
+                    leaderboard_cache.invalidate_guild(guild_id)
+
+        concurrency = min(backend.max_concurrency(), max(1, -(-len(increments) // sizer.batch_size)))
+
+        await asyncio.gather(*(send_batches() for _ in range(concurrency)))
 
-    async def get_user_time_and_position(self, user_id: int, server_id: int) -> tuple[int, Optional[int]]:
+        report.concurrency += concurrency
+        report.batch_sizes[partition_name] = sizer.batch_size
+
+        return failed, failed_channels
         
+
+    def get_unsaved_times(self, guild_id: int, days: Optional[int] = None) -> Dict[int, int]:
+        """
+        Returns user_id -> time that isn't in the database yet for the guild. That's the time of everyone
+        currently in VC since their join time, plus anything still waiting in the write buffer.
+        With `days`, only the part of each session within the last `days` days counts.
+        Nothing gets written or reset, so it's safe to call from read paths.
+        """
+        unsaved_times: Dict[int, int] = write_buffer.pending_for_guild(guild_id)
+
+        current_time = int(time.time())
+        since: int = period_start(days) if days is not None else 0
+        for user_id, joined_time in tracking_queue.guild_sessions(guild_id):
+            time_difference: int = current_time - max(joined_time, since)
+            if time_difference > 0:
+                unsaved_times[user_id] = unsaved_times.get(user_id, 0) + time_difference
+
+        return unsaved_times
+
+
+    async def get_channel_times(self, guild_id: int, count: int) -> tuple[list[int], list[int]]:
+        """
+        Returns the top `count` voice channels of the guild and their times, including time that isn't saved yet.
+        This only reads from the database.
+        """
+        channel_ids: List[int] = []
+        times: List[int] = []
+
+        # Time waiting in the write buffer, plus everyone's current segment in the channel they're in
+        unsaved_times: Dict[int, int] = write_buffer.pending_channels_for_guild(guild_id)
+
+        current_time = int(time.time())
+        for channel_id, joined_time in tracking_queue.guild_channel_sessions(guild_id):
+            time_difference: int = current_time - joined_time
+            if channel_id and time_difference > 0:
+                unsaved_times[channel_id] = unsaved_times.get(channel_id, 0) + time_difference
+
+        start = time.perf_counter()
         try:
-            if connection:
+            if backend:
+                # A guild can't have more channels than this, so every channel's saved time is there to merge with
+                top: List[tuple[int, int]] = await backend.get_channel_top(guild_id, MAX_GUILD_CHANNELS)
+
+                merged_times: Dict[int, int] = dict(top)
+                for channel_id, time_difference in unsaved_times.items():
+                    merged_times[channel_id] = merged_times.get(channel_id, 0) + time_difference
+
+                ranked = sorted(merged_times.items(), key=lambda item: item[1], reverse=True)[:count]
+                channel_ids = [channel_id for channel_id, _ in ranked]
+                times = [channel_time for _, channel_time in ranked]
+
+            else:
+                print(DATABASE_NOT_CONNECTED_MESSAGE)
+
+        except Exception as error:
+            print(f"Error fetching channel times: {error}")
+
+        end = time.perf_counter()
+        elapsed_ms = (end - start) * 1000
+        record_timing("get_channel_times", elapsed_ms)
+
+        return channel_ids, times
+
+
+    async def get_user_time_and_position(self, user_id: int, server_id: int, period: Optional[str] = None) -> tuple[int, Optional[int]]:
+        """
+        Returns the user's total time and leaderboard position, including time that isn't saved yet.
+        Pass a period from PERIOD_DAYS (e.g. "week") to only count the time of the last days.
+        This only reads from the database.
+        """
+        days: Optional[int] = PERIOD_DAYS[period] if period is not None else None
+        timing_name = "get_user_time_and_position" if period is None else f"get_user_time_and_position_{period}"
+
+        try:
+            if backend:
                 start = time.perf_counter()
 
-                # Get the user's time from the sorted set (zscore returns the score, i.e., time)
-                # user_time = await asyncio.to_thread(conn_user_stats.zscore, leaderboard_key, str(user_id))
-                key = f"guild:{server_id}"
+                unsaved_times: Dict[int, int] = self.get_unsaved_times(server_id, days)
+
+                # Nobody in the guild has unsaved time, so the database has the full picture
+                if not unsaved_times:
+                    saved_time, position = await backend.get_time_and_position(server_id, user_id, days)
 
-                async with connection.pipeline(transaction=False) as pipe:
-                    pipe.zscore(key, str(user_id))
-                    pipe.zrevrank(key, str(user_id))
-                    results = await pipe.execute() # type: ignore
+                    end = time.perf_counter()
+                    elapsed_ms = (end - start) * 1000
+                    record_timing(timing_name, elapsed_ms)
 
-                user_time = results[0] # type: ignore
-                user_position = results[1] # type: ignore
-                
-                # user_time = await asyncio.to_thread(conn_user_stats.zscore, key, str(user_id))
+                    if saved_time is None:
+                        return (0, None)  # If user doesn't have time, return default values
 
-                if user_time is None:
-                    print("None user time")
+                    return (saved_time, position)
+
+                # Get the saved time of the user and of everyone with unsaved time in one go
+                other_user_ids: List[int] = [other_id for other_id in unsaved_times if other_id != user_id]
+                saved_times: List[Optional[int]] = await backend.get_times(server_id, [user_id] + other_user_ids, days)
+
+                saved_user_time: Optional[int] = saved_times[0]
+                if saved_user_time is None and user_id not in unsaved_times:
                     return (0, None)  # If user doesn't have time, return default values
 
-                # Get the user's position from the sorted set (zrank returns the 0-based index)
-                # user_position = await asyncio.to_thread(conn_user_stats.zrevrank, key, str(user_id))
-                # print(f"{user_position}")
+                user_time: int = (saved_user_time or 0) + unsaved_times.get(user_id, 0)
+
+                # Everyone whose saved time is already ahead of the user
+                ahead: int = await backend.count_above(server_id, user_time, days)
+
+                # And everyone who only gets ahead of the user once their unsaved time is added
+                for other_id, saved_other_time in zip(other_user_ids, saved_times[1:]):
+                    saved_other_time = saved_other_time or 0
+                    if saved_other_time <= user_time < saved_other_time + unsaved_times[other_id]:
+                        ahead += 1
 
                 end = time.perf_counter()
                 elapsed_ms = (end - start) * 1000
-                from helper import log_info_to_channel
-                await log_info_to_channel(1377200295389565020,f"`get_user_time_and_position` completed in {elapsed_ms:.3f}ms")
+                record_timing(timing_name, elapsed_ms)
 
-                # Return the time and position (position is 1-based)
-                return (int(user_time), user_position + 1 if user_position is not None else None) # type: ignore
+                return (user_time, ahead + 1)
 
             else:
                 print(DATABASE_NOT_CONNECTED_MESSAGE)
@@ -209,67 +667,102 @@ class Datastore:
             return (0, None)
         
         
-    async def get_leaderboard_members_and_time(self, guild_id: int) -> tuple[list[int], list[int]]:
-        users: List[int] = []
-        times: List[int] = []
+    async def get_leaderboard_page(self, guild_id: int, start: int, count: int, period: Optional[str] = None) -> LeaderboardWindow:
+        """
+        Returns the `count` members from 0-based position `start` on and their times, including time that isn't
+        saved yet, along with how many members the leaderboard has and their total time.
+        Only the window is read, plus one member above it for everyone with unsaved time, since that's as far
+        as their time can push anyone down.
+        Pass a period from PERIOD_DAYS (e.g. "week") to only count the time of the last days.
+        This only reads from the database.
+        """
+        page = LeaderboardWindow([], 0, 0)
 
-        key = f"guild:{guild_id}"
+        days: Optional[int] = PERIOD_DAYS[period] if period is not None else None
+        unsaved_times: Dict[int, int] = self.get_unsaved_times(guild_id, days)
+        unsaved_user_ids: List[int] = list(unsaved_times)
 
-        start = time.perf_counter()
+        start_time = time.perf_counter()
         try:
-            if connection:
+            if backend:
+                window_start: int = max(0, start - len(unsaved_user_ids))
+                window_count: int = start + count - window_start
+                window: LeaderboardWindow = await backend.get_window(guild_id, window_start, window_count, unsaved_user_ids, days)
 
-                # Get the top 500 users by time (scores in descending order)
-                leaderboard = await connection.zrevrange(key, 0, 199, withscores=True) # type: ignore
+                page.member_count = window.member_count + sum(1 for saved_time in window.times if saved_time is None)
+                page.total_time = window.total_time + sum(unsaved_times.values())
 
-                # Loop through the leaderboard and separate the user IDs and times
-                for user_id, score in leaderboard: # type: ignore
-                    users.append(int(user_id))  # type: ignore # Convert user_id to integer
-                    times.append(int(score))    # type: ignore # Convert score (time) to integer
+                if not unsaved_user_ids:
+                    page.entries = window.entries
+                else:
+                    page.entries = merge_window(window, window_start, window_count, start, count, unsaved_times, backend.rank_key)
 
             else:
                 print(DATABASE_NOT_CONNECTED_MESSAGE)
-                
-        except Exception as e:
-            print(f"Error fetching leaderboard data: {e}")
 
-        end = time.perf_counter()
-        elapsed_ms = (end - start) * 1000
-        from helper import log_info_to_channel
-        await log_info_to_channel(1377200295389565020,f"`get_leaderboard_members_and_time` completed in {elapsed_ms:.3f}ms")
-            
-        return users, times
+        except Exception as error:
+            print(f"Error fetching leaderboard data: {error}")
+
+        end_time = time.perf_counter()
+        elapsed_ms = (end_time - start_time) * 1000
+        record_timing("get_leaderboard_page" if period is None else f"get_leaderboard_page_{period}", elapsed_ms)
+
+        return page
 
 
     async def reset_guild_data(self, guild_id: int) -> None:
         start = time.perf_counter()
-        key = f"guild:{guild_id}"
         try:
-            if connection:
-                await connection.delete(key)
+            if backend:
+                # Holding the flush lock so no flush can write the guild's time back after it's deleted
+                async with write_buffer.get_flush_lock():
+                    await backend.delete_guild(guild_id)
+
+                    # Time from before the reset that isn't written yet doesn't count any more either
+                    async with tracking_queue_locks.for_guild(guild_id):
+                        current_time = int(time.time())
+                        _, user_ids, _, _ = tracking_queue.take_all_time_differences(guild_id, current_time)
+                        for user_id in user_ids:
+                            session_journal.record_join(user_id, guild_id, current_time)
+
+                        write_buffer.take_guild(guild_id)
+                        write_buffer.take_guild_channels(guild_id)
+
+                leaderboard_cache.invalidate_guild(guild_id)
+                hot_guilds.drop_guild(guild_id)
             else:
                 print(DATABASE_NOT_CONNECTED_MESSAGE)
         except Exception as error:
-            print(f"Error deleting Valkey data: {error}")
+            print(f"Error deleting guild data: {error}")
 
         end = time.perf_counter()
         elapsed_ms = (end - start) * 1000
-        from helper import log_info_to_channel
-        await log_info_to_channel(1377200295389565020,f"`reset_guild_data` completed in {elapsed_ms:.3f}ms")
+        record_timing("reset_guild_data", elapsed_ms)
 
 
     async def reset_user_data(self, guild_id: int, user_id: int) -> None:
         start = time.perf_counter()
-        key = f"guild:{guild_id}"
         try:
-            if connection:
-                await connection.zrem(key, str(user_id))
+            if backend:
+                # Same as reset_guild_data(), for one member. Their channel time stays, it isn't per member
+                async with write_buffer.get_flush_lock():
+                    await backend.delete_member(guild_id, user_id)
+
+                    async with tracking_queue_locks.for_guild(guild_id):
+                        current_time = int(time.time())
+                        time_difference: Optional[int] = tracking_queue.take_time_difference(user_id, guild_id, current_time)
+                        if time_difference is not None and time_difference > 0:
+                            session_journal.record_join(user_id, guild_id, current_time)
+
+                        write_buffer.take_member(guild_id, user_id)
+
+                leaderboard_cache.invalidate_guild(guild_id)
+                hot_guilds.drop_guild(guild_id)
             else:
                 print(DATABASE_NOT_CONNECTED_MESSAGE)
         except Exception as error:
-            print(f"Error deleting user from Valkey: {error}")
+            print(f"Error deleting user data: {error}")
 
         end = time.perf_counter()
         elapsed_ms = (end - start) * 1000
-        from helper import log_info_to_channel
-        await log_info_to_channel(1377200295389565020,f"`reset_specific_user` completed in {elapsed_ms:.3f}ms")
\ No newline at end of file
+        record_timing("reset_user_data", elapsed_ms)
\ No newline at end of file
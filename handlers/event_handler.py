@@ -1,10 +1,14 @@
+import config
 import lightbulb
 import hikari
+import time
 
 from typing import Optional
-from helper import make_key, start_tracking_user
+from helper import start_tracking_user
 from logging_stuff import increment_member_join, increment_member_left, increment_member_move
 from datastore import Datastore
+from perf_logging import record_timing
+from objects.voice_event_queue import VoiceEventQueue
 
 
 plugin = lightbulb.Plugin("event_handler")
@@ -12,8 +16,11 @@ datastore = Datastore()
 
 @plugin.listener(hikari.VoiceStateUpdateEvent) # type: ignore
 async def on_voice_event(e: hikari.VoiceStateUpdateEvent):
-    # user_id = e.state.user_id
+    # The storage work happens on the queue's workers, so a slow database doesn't hold up the gateway
+    await voice_event_queue.put(e.state.user_id, e)
 
+
+async def handle_voice_event(e: hikari.VoiceStateUpdateEvent):
     # Old channel state is what the previous channel is. So if a user joins a channel, 
     # their old one will be null since they haven't joined a channel before.
     # New channel state will be the one that they just joined.
@@ -25,12 +32,15 @@ async def on_voice_event(e: hikari.VoiceStateUpdateEvent):
     old_channel_id: Optional[hikari.Snowflake] = old_voice_state.channel_id if old_voice_state else None
     new_channel_id: Optional[hikari.Snowflake] = new_voice_state.channel_id if new_voice_state else None
 
+    start = time.perf_counter()
+
     ########################
     # Joined a voice channel
     ########################
     if old_channel_id is None and new_channel_id is not None:
         # print(f"User {user_id} joined voice channel {new_channel_id}")
         await handle_join(new_voice_state)
+        operation = "voice_event_join"
 
     ########################
     # Left a voice channel
@@ -39,6 +49,7 @@ async def on_voice_event(e: hikari.VoiceStateUpdateEvent):
         # print(f"User {user_id} left voice channel {old_channel_id}")
         if old_voice_state is not None:
             await handle_leave(old_voice_state)
+        operation = "voice_event_leave"
 
     ########################
     # Switched voice channels
@@ -46,7 +57,16 @@ async def on_voice_event(e: hikari.VoiceStateUpdateEvent):
     elif old_channel_id != new_channel_id:
         if old_voice_state is not None:
             await handle_switch(old_voice_state, new_voice_state)
-    
+        operation = "voice_event_switch"
+
+    # Mute, deafen, etc.
+    else:
+        return
+
+    end = time.perf_counter()
+    elapsed_ms = (end - start) * 1000
+    record_timing(operation, elapsed_ms)
+
 
 
 async def handle_join(voice_state: hikari.VoiceState):
@@ -57,7 +77,7 @@ async def handle_join(voice_state: hikari.VoiceState):
             return
 
     increment_member_join()
-    await start_tracking_user(voice_state.user_id, voice_state.guild_id)
+    await start_tracking_user(voice_state.user_id, voice_state.guild_id, voice_state.channel_id or 0)
 
 
 async def handle_leave(voice_state: hikari.VoiceState):
@@ -74,22 +94,49 @@ async def handle_leave(voice_state: hikari.VoiceState):
 
     await datastore.save_single(user_id, guild_id)
 
-    dict_key: str = make_key(user_id, guild_id)
-
-    async with datastore.get_tracking_queue_lock():
-        datastore.get_tracking_queue().pop(dict_key, None)
+    async with datastore.get_tracking_queue_lock(guild_id):
+        datastore.stop_tracking(user_id, guild_id)
 
 
 async def handle_switch(old_voice_state: hikari.VoiceState, new_voice_state: hikari.VoiceState):
-    # UPDATE: We don't actually care about if the user switch channels
-    # Since switching channels is effectively just staying in the same channel.
-    # Because of this, we only really care about if the user leaves.
+    # Switching channels doesn't end the session, the member's total keeps counting.
+    # The time spent in the old channel is credited to it and the new channel starts counting
+
+    if new_voice_state.member is not None:
+        if new_voice_state.member.is_bot:
+            return
 
-    # This function will effectively only be used for logging purposes
     # print(f"{new_voice_state.member} switched channel")
     increment_member_move()
 
+    guild_id = new_voice_state.guild_id
+
+    async with datastore.get_tracking_queue_lock(guild_id):
+        await datastore.switch_channel(new_voice_state.user_id, guild_id, new_voice_state.channel_id or 0)
+
+
+@plugin.listener(hikari.GuildLeaveEvent) # type: ignore
+async def on_guild_leave(e: hikari.GuildLeaveEvent):
+    # The bot got removed from the guild, so there won't be any leave events for its members anymore
+    await datastore.stop_tracking_guild(e.guild_id)
+
+
+voice_event_queue: VoiceEventQueue[hikari.VoiceStateUpdateEvent] = VoiceEventQueue(
+    handle_voice_event,
+    workers=getattr(config, "VOICE_EVENT_WORKERS", 8),
+    max_size=getattr(config, "VOICE_EVENT_QUEUE_SIZE", 10000)
+)
+
+
+async def drain_voice_events() -> None:
+    """Finishes every voice event that's still queued, so none of them are lost on shutdown"""
+    await voice_event_queue.drain()
+
 
 # REQUIRED FUNCTION - Lightbulb looks for this
 def load(bot: lightbulb.BotApp) -> None:
-    bot.add_plugin(plugin)
\ No newline at end of file
+    bot.add_plugin(plugin)
+
+    # Extensions are loaded from on_starting, so the event loop is already running
+    voice_event_queue.start()
+    voice_event_queue.register_metrics()
\ No newline at end of file
@@ -0,0 +1,146 @@
+import asyncio
+import time
+import hikari
+import lightbulb
+
+from typing import List, Optional, Set
+from datastore import Datastore
+from perf_logging import record_timing
+
+# Catches anyone who is no longer in VC without the bot noticing. For example, a user leaving a
+# voice channel while an API outage occurs, so the leave event on the bot is never fired.
+#
+# Whenever a guild becomes available or a shard resumes, that guild or shard is checked right away.
+# On top of that, a sweep checks a small slice of the tracking queue every tick, so every
+# session gets looked at every few minutes without ever scanning the whole queue at once.
+
+SWEEP_INTERVAL_SECONDS = 1
+SWEEP_SLICE_SIZE = 200
+
+plugin = lightbulb.Plugin("reconciliation")
+datastore = Datastore()
+
+# Guilds whose voice states are in the cache. Until a guild is available (e.g. right after a shard
+# connects) a missing voice state doesn't mean the user left, so those guilds are skipped
+available_guilds: Set[int] = set()
+
+sweep_cursor: int = 0
+sweep_task: Optional[asyncio.Task[None]] = None
+
+# Reconciliation status
+stale_sessions_removed: int = 0
+sweep_passes_completed: int = 0
+last_sweep_pass_seconds: float = 0.0
+
+
+def is_stale(bot: hikari.GatewayBot, user_id: int, guild_id: int) -> bool:
+    """Whether the session has no voice state anymore"""
+    if guild_id not in available_guilds:
+        return False
+
+    user_voice_state: Optional[hikari.VoiceState] = bot.cache.get_voice_state(guild_id, user_id)
+    return user_voice_state is None
+
+
+def find_stale_sessions(bot: hikari.GatewayBot, sessions: List[tuple[int, int]]) -> List[tuple[int, int]]:
+    """Returns the (user_id, guild_id) sessions that don't have a voice state anymore"""
+    return [(user_id, guild_id) for user_id, guild_id in sessions if is_stale(bot, user_id, guild_id)]
+
+
+async def remove_stale_sessions(bot: hikari.GatewayBot, stale: List[tuple[int, int]]) -> None:
+    global stale_sessions_removed
+
+    if not stale:
+        return
+
+    # Checked again once the guild is locked, in case a join came in since
+    stale_sessions_removed += await datastore.remove_stale_sessions(stale, lambda user_id, guild_id: is_stale(bot, user_id, guild_id))
+
+
+async def reconcile_guild(bot: hikari.GatewayBot, guild_id: int) -> None:
+    sessions: List[tuple[int, int]] = [(user_id, guild_id) for user_id, _ in datastore.get_tracking_queue().guild_sessions(guild_id)]
+    await remove_stale_sessions(bot, find_stale_sessions(bot, sessions))
+
+
+async def reconcile_shard(bot: hikari.GatewayBot, shard_id: int) -> None:
+    start = time.perf_counter()
+
+    tracking_queue = datastore.get_tracking_queue()
+
+    sessions: List[tuple[int, int]] = []
+    for guild_id in tracking_queue.guild_ids():
+        if hikari.snowflakes.calculate_shard_id(bot, guild_id) == shard_id:
+            sessions.extend((user_id, guild_id) for user_id, _ in tracking_queue.guild_sessions(guild_id))
+
+    await remove_stale_sessions(bot, find_stale_sessions(bot, sessions))
+
+    end = time.perf_counter()
+    elapsed_ms = (end - start) * 1000
+    record_timing("reconcile_shard", elapsed_ms)
+
+
+async def sweep(bot: hikari.GatewayBot) -> None:
+    global sweep_cursor
+    global sweep_passes_completed
+    global last_sweep_pass_seconds
+
+    pass_started = time.monotonic()
+
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL_SECONDS)
+
+        try:
+            sessions, sweep_cursor = datastore.get_tracking_queue().session_slice(sweep_cursor, SWEEP_SLICE_SIZE)
+            await remove_stale_sessions(bot, find_stale_sessions(bot, sessions))
+        except Exception as error:
+            print(f"Error sweeping the tracking queue: {error}")
+
+        # Back at the start, so every session has been looked at once
+        if sweep_cursor == 0:
+            sweep_passes_completed += 1
+            last_sweep_pass_seconds = time.monotonic() - pass_started
+            pass_started = time.monotonic()
+
+
+@plugin.listener(hikari.StartedEvent)
+async def on_started(event: hikari.StartedEvent) -> None:
+    global sweep_task
+
+    if sweep_task is None:
+        sweep_task = asyncio.create_task(sweep(plugin.bot))
+
+
+@plugin.listener(hikari.ShardReadyEvent)
+async def on_shard_ready(event: hikari.ShardReadyEvent) -> None:
+    # A new session, so the shard's guilds get sent again and each one is reconciled once it's available
+    available_guilds.difference_update(event.unavailable_guilds)
+
+
+@plugin.listener(hikari.ShardResumedEvent)
+async def on_shard_resumed(event: hikari.ShardResumedEvent) -> None:
+    await reconcile_shard(plugin.bot, event.shard.id)
+
+
+@plugin.listener(hikari.GuildAvailableEvent)
+async def on_guild_available(event: hikari.GuildAvailableEvent) -> None:
+    available_guilds.add(event.guild_id)
+    await reconcile_guild(plugin.bot, event.guild_id)
+
+
+@plugin.listener(hikari.GuildJoinEvent)
+async def on_guild_join(event: hikari.GuildJoinEvent) -> None:
+    available_guilds.add(event.guild_id)
+
+
+@plugin.listener(hikari.GuildUnavailableEvent)
+async def on_guild_unavailable(event: hikari.GuildUnavailableEvent) -> None:
+    available_guilds.discard(event.guild_id)
+
+
+@plugin.listener(hikari.GuildLeaveEvent)
+async def on_guild_leave(event: hikari.GuildLeaveEvent) -> None:
+    available_guilds.discard(event.guild_id)
+
+
+def load(bot: lightbulb.BotApp) -> None:
+    bot.add_plugin(plugin)
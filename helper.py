@@ -3,7 +3,8 @@ import lightbulb
 import time
 
 from datastore import Datastore
-from objects.user import User
+from logging_stuff import commands_in_flight
+from message_scheduler import LOW_PRIORITY, message_scheduler
 from typing import Optional
 
 bot_instance = None
@@ -15,24 +16,28 @@ async def initialize(bot: lightbulb.BotApp):
     global bot_instance
     bot_instance = bot
 
+    message_scheduler.start(bot.rest, commands_in_flight)
 
-async def log_info_to_channel(channel_id: int, message: str) -> None:
+
+async def stop_message_scheduler() -> None:
+    """Sends the messages that are still waiting"""
+    await message_scheduler.stop()
+
+
+async def log_info_to_channel(channel_id: int, message: str, priority: int = LOW_PRIORITY) -> None:
+    # Only queues it. Messages waiting for the same channel get merged
     if bot_instance is not None:
-        await bot_instance.rest.create_message(
-                channel_id,
-                message
-            )
+        message_scheduler.send(channel_id, message, priority)
 
 
-async def start_tracking_user(user_id: int, guild_id: int):
+async def start_tracking_user(user_id: int, guild_id: int, channel_id: int = 0):
     # Original Java code saved the time in milliseconds, so
     # we need to convert the time into milliseconds as well
     # so that it doesn't mess up existing data
     seconds: int = int(time.time())
 
-    async with datastore.get_tracking_queue_lock():
-        tracking_queue = datastore.get_tracking_queue()
-        tracking_queue[make_key(user_id, guild_id)] = User(user_id, guild_id, seconds)
+    async with datastore.get_tracking_queue_lock(guild_id):
+        datastore.start_tracking(user_id, guild_id, seconds, channel_id)
     
 
 async def if_member_has_permission(member: hikari.Member, permission: hikari.Permissions) -> bool:
@@ -82,9 +87,4 @@ def seconds_to_timestamp(seconds: int) -> str:
     minutes = (seconds % 3600) // 60
     seconds = seconds % 60
     return f"{hours:,}h {minutes}m {seconds}s"
-    # return f"{hours:,}h {minutes}m"
-
-@staticmethod
-def make_key(user_id: int, guild_id: int) -> str:
-    key: str = f"{user_id}-{guild_id}"
-    return key
\ No newline at end of file
+    # return f"{hours:,}h {minutes}m"
\ No newline at end of file
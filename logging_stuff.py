@@ -1,11 +1,20 @@
 import hikari
+import os
+import time
+
+import cluster_worker
+import psutil
 
 from textwrap import dedent
-from typing import Dict, Optional
+from typing import Any, Dict, List, Optional
 from lightbulb import BotApp
 import lightbulb
 
 from datastore import Datastore
+from message_scheduler import message_scheduler
+from metrics import LabelValues, registry
+from perf_logging import record_timing
+import handlers.reconciliation as reconciliation
 
 plugin = lightbulb.Plugin("logging")
 datastore = Datastore()
@@ -13,62 +22,176 @@ datastore = Datastore()
 shard_guild_counter: Dict[int, int] = {}
 total_guild_count: int = 0
 
-totalTimesJoined: int = 0
-totalTimesLeft: int = 0
-totalTimesMoved: int = 0
+# Everything only ever counts up. The daily summary reports the difference since its last post
+voice_events = registry.counter("vcstats_voice_events_total", "Members joining, leaving and moving between voice channels", ("event",))
+commands_used = registry.counter("vcstats_commands_total", "Slash commands used", ("command",))
+
+# The counts as of the last daily summary
+last_summary_counts: Dict[str, Dict[LabelValues, float]] = {}
+
+# When each running command started, by interaction ID, to time it
+command_start_times: Dict[int, float] = {}
 
-# Commands
-helpUsed: int = 0
-statsUsed: int = 0
-leaderboardUsed: int = 0
-resetAllUsed: int = 0
-resetUserUsed: int = 0
-donateUsed: int = 0
+# Every worker of the cluster merged together, as last sent back by the coordinator. None outside a cluster
+cluster_view: Optional[Dict[str, Any]] = None
 
 @staticmethod
 def increment_member_join() -> None:
-    global totalTimesJoined
-    totalTimesJoined += 1
+    voice_events.inc("join")
 
 @staticmethod
 def increment_member_left() -> None:
-    global totalTimesLeft
-    totalTimesLeft += 1
+    voice_events.inc("leave")
 
 @staticmethod
 def increment_member_move() -> None:
-    global totalTimesMoved
-    totalTimesMoved += 1
+    voice_events.inc("move")
 
 @staticmethod
 def increment_help_used() -> None:
-    global helpUsed
-    helpUsed += 1
+    commands_used.inc("help")
 
 @staticmethod
 def increment_stats_used() -> None:
-    global statsUsed
-    statsUsed += 1
+    commands_used.inc("stats")
 
 @staticmethod
 def increment_leaderboard_used() -> None:
-    global leaderboardUsed
-    leaderboardUsed += 1
+    commands_used.inc("leaderboard")
+
+@staticmethod
+def increment_channel_stats_used() -> None:
+    commands_used.inc("channelstats")
 
 @staticmethod
 def increment_reset_all_used() -> None:
-    global resetAllUsed
-    resetAllUsed += 1
+    commands_used.inc("resetall")
 
 @staticmethod
 def increment_reset_user_used() -> None:
-    global resetUserUsed
-    resetUserUsed += 1
+    commands_used.inc("resetuser")
 
 @staticmethod
 def increment_donate_used() -> None:
-    global donateUsed
-    donateUsed += 1
+    commands_used.inc("donate")
+
+
+def commands_in_flight() -> bool:
+    """Whether a command started recently enough that it could still be waiting to respond"""
+    now = time.perf_counter()
+    return any(now - start < 3 for start in command_start_times.values())
+
+
+def register_gauges() -> None:
+    """Things that are already counted elsewhere are read straight from there when the metrics are exported"""
+    write_buffer = datastore.get_write_buffer()
+    tracking_queue_locks = datastore.get_tracking_queue_locks()
+    leaderboard_cache = datastore.get_leaderboard_cache()
+    hot_guilds = datastore.get_hot_guilds()
+
+    registry.gauge_callback("vcstats_guilds", "Guilds per shard", lambda: {(str(shard_id),): count for shard_id, count in shard_guild_counter.items()}, ("shard",))
+    registry.gauge_callback("vcstats_guilds_total", "Guilds across all shards", lambda: total_guild_count)
+    registry.gauge_callback("vcstats_tracking_queue_sessions", "Members currently in VC being tracked", lambda: len(datastore.get_tracking_queue()))
+    registry.gauge_callback("vcstats_write_buffer_pending", "Members with time waiting to be written", write_buffer.pending_count)
+    registry.counter_callback("vcstats_write_buffer_flushes_total", "Write buffer flushes", lambda: write_buffer.total_flushes)
+    registry.counter_callback("vcstats_write_buffer_entries_flushed_total", "Entries written by the write buffer", lambda: write_buffer.total_entries_flushed)
+    registry.counter_callback("vcstats_write_buffer_failed_entries_total", "Entries the write buffer failed to write", lambda: write_buffer.total_failed_entries)
+    registry.counter_callback("vcstats_tracking_lock_acquisitions_total", "Tracking queue lock acquisitions", lambda: tracking_queue_locks.total_acquisitions)
+    registry.counter_callback("vcstats_tracking_lock_contended_total", "Tracking queue lock acquisitions that had to wait", lambda: tracking_queue_locks.contended_acquisitions)
+    registry.counter_callback("vcstats_leaderboard_cache_hits_total", "Leaderboard pages served from the cache", lambda: leaderboard_cache.hits)
+    registry.counter_callback("vcstats_leaderboard_cache_misses_total", "Leaderboard pages that had to be built", lambda: leaderboard_cache.misses)
+    registry.gauge_callback("vcstats_hot_guilds", "Guilds with leaderboard pages rendered ahead of time", hot_guilds.guild_count)
+    registry.counter_callback("vcstats_hot_guild_page_hits_total", "Leaderboard pages served from the ones rendered ahead of time", lambda: hot_guilds.hits)
+    registry.counter_callback("vcstats_hot_guild_refreshes_total", "Times a hot guild's pages were rendered again", lambda: hot_guilds.refreshes)
+    registry.gauge_callback("vcstats_scheduled_messages_pending", "Log and report messages waiting to be sent", message_scheduler.pending_count)
+    registry.counter_callback("vcstats_scheduled_messages_sent_total", "Log and report messages sent", lambda: message_scheduler.messages_sent)
+    registry.counter_callback("vcstats_scheduled_messages_failed_total", "Log and report messages that couldn't be sent", lambda: message_scheduler.messages_failed)
+    registry.counter_callback("vcstats_scheduled_messages_merged_total", "Messages merged into another one, each a request not made", lambda: message_scheduler.messages_merged)
+    registry.counter_callback("vcstats_rate_limits_avoided_total", "Sends held back so a channel's rate limit wasn't hit", lambda: message_scheduler.rate_limits_avoided)
+    registry.counter_callback("vcstats_scheduled_messages_deferred_total", "Sends held back for a command's response", lambda: message_scheduler.deferred_for_commands)
+    registry.counter_callback("vcstats_stale_sessions_removed_total", "Sessions removed because their leave event was missed", lambda: reconciliation.stale_sessions_removed)
+
+    # Per process, so each worker of a cluster shows its own
+    process = psutil.Process()
+    registry.counter_callback("process_cpu_seconds_total", "CPU time used by this process", lambda: sum(process.cpu_times()[:2]))
+    registry.gauge_callback("process_resident_memory_bytes", "Resident memory of this process", lambda: process.memory_info().rss)
+
+
+def build_worker_report() -> Dict[str, Any]:
+    """This worker's share of the stats, for the cluster coordinator to merge"""
+    report: Dict[str, Any] = {
+        "worker_id": cluster_worker.worker_id(),
+        "pid": os.getpid(),
+        "guilds": {str(shard_id): count for shard_id, count in shard_guild_counter.items()},
+        "sessions": len(datastore.get_tracking_queue()),
+        "counters": {
+            "voice_events": {label_values[0]: value for label_values, value in voice_events.values().items()},
+            "commands": {label_values[0]: value for label_values, value in commands_used.values().items()},
+        },
+        "reconciliation": {
+            "stale_sessions_removed": reconciliation.stale_sessions_removed,
+            "sweep_passes_completed": reconciliation.sweep_passes_completed,
+            "last_sweep_pass_seconds": reconciliation.last_sweep_pass_seconds,
+        },
+    }
+
+    # Only the worker that posts the daily summary has a baseline. The coordinator keeps it for when that worker restarts
+    if last_summary_counts:
+        report["summary_counts"] = {name: {label_values[0]: value for label_values, value in values.items()} for name, values in last_summary_counts.items()}
+
+    return report
+
+
+async def report_to_coordinator() -> None:
+    global cluster_view
+    cluster_view = await cluster_worker.send_report(build_worker_report())
+
+
+def describe_workers(workers: List[Dict[str, Any]]) -> str:
+    lines: List[str] = []
+    for worker in workers:
+        shard_ids: List[int] = worker["shard_ids"]
+        status = "up" if worker["up"] else "DOWN"
+        lines.append(
+            f"Worker {worker['worker_id']} (shards {shard_ids[0]}-{shard_ids[-1]}): {status}, "
+            f"{worker['cpu_percent']:.1f}% CPU, {worker['memory_bytes'] / 1024 / 1024:.0f} MB, "
+            f"{worker['guilds']} guilds, {worker['sessions']} in VC, {worker['restarts']} restarts"
+        )
+    return "\n".join(lines)
+
+
+def count_since_last_summary(counter_name: str, values: Dict[LabelValues, float], label: str) -> int:
+    last = last_summary_counts.get(counter_name, {})
+    return int(values.get((label,), 0) - last.get((label,), 0))
+
+
+def command_key(context: lightbulb.Context) -> int:
+    # Every command is a slash command, and each run has its own interaction. The context object's id() could be
+    # reused by a later one once it's freed
+    return context.interaction.id
+
+
+@plugin.listener(lightbulb.CommandInvocationEvent)
+async def on_command_invocation(event: lightbulb.CommandInvocationEvent) -> None:
+    command_start_times[command_key(event.context)] = time.perf_counter()
+
+
+@plugin.listener(lightbulb.CommandCompletionEvent)
+async def on_command_completion(event: lightbulb.CommandCompletionEvent) -> None:
+    start: Optional[float] = command_start_times.pop(command_key(event.context), None)
+    if start is None:
+        return
+
+    end = time.perf_counter()
+    elapsed_ms = (end - start) * 1000
+    record_timing(f"command_{event.command.name}", elapsed_ms)
+
+
+@plugin.listener(lightbulb.CommandErrorEvent)
+async def on_command_error(event: lightbulb.CommandErrorEvent) -> None:
+    # Commands that errored never complete. Returning nothing leaves the error to be handled as before
+    if event.context is not None:
+        command_start_times.pop(command_key(event.context), None)
 
 @plugin.listener(hikari.ShardReadyEvent)
 async def reset_guild_counter(event: hikari.ShardReadyEvent) -> None:
@@ -98,59 +221,92 @@ async def fetch_stats(bot: Optional[BotApp]) -> str:
     if bot is None:
         return "Error"
     
-    global totalTimesJoined
-    global totalTimesLeft
-    global totalTimesMoved
+    shard_count: int = 0
+    shard_count = bot.shard_count
 
-    global helpUsed
-    global statsUsed
-    global leaderboardUsed
-    global resetAllUsed
-    global resetUserUsed
-    global donateUsed
+    write_buffer = datastore.get_write_buffer()
+    tracking_queue_locks = datastore.get_tracking_queue_locks()
+    leaderboard_cache = datastore.get_leaderboard_cache()
+    hot_guilds = datastore.get_hot_guilds()
 
+    voice_event_counts = voice_events.values()
+    command_counts = commands_used.values()
 
-    shard_count: int = 0
-    shard_count = bot.shard_count
+    guild_count: int = total_guild_count
+    sessions_in_vc: int = len(datastore.get_tracking_queue())
+    shard_guild_counts: Dict[int, int] = dict(shard_guild_counter)
+    stale_sessions_removed: int = reconciliation.stale_sessions_removed
+    sweep_passes_completed: int = reconciliation.sweep_passes_completed
+    last_sweep_pass_seconds: float = reconciliation.last_sweep_pass_seconds
+    worker_message: str = ""
+
+    # In a cluster, the counts cover every worker. The datastore numbers below are this worker's own
+    if cluster_view is not None:
+        voice_event_counts = {(label,): value for label, value in cluster_view["counters"].get("voice_events", {}).items()}
+        command_counts = {(label,): value for label, value in cluster_view["counters"].get("commands", {}).items()}
+        guild_count = cluster_view["total_guilds"]
+        sessions_in_vc = cluster_view["sessions"]
+        shard_guild_counts = {int(shard_id): count for shard_id, count in cluster_view["guilds"].items()}
+        stale_sessions_removed = cluster_view["reconciliation"]["stale_sessions_removed"]
+        sweep_passes_completed = cluster_view["reconciliation"]["sweep_passes_completed"]
+        last_sweep_pass_seconds = cluster_view["reconciliation"]["last_sweep_pass_seconds"]
+        worker_message = describe_workers(cluster_view["workers"]) + "\n==========\n"
+
+        # Since this worker started it hasn't posted one, so the last summary's counts are the coordinator's
+        if not last_summary_counts:
+            for counter_name, values in cluster_view.get("summary_counts", {}).items():
+                last_summary_counts[counter_name] = {(label,): value for label, value in values.items()}
 
     shard_message: str = ""
-    for k, v in shard_guild_counter.items():
+    for k, v in sorted(shard_guild_counts.items()):
         shard_message += f"Shard ID: {k} - Guilds: {v}\n"
     
     message = dedent(f"""
 **Last 24 hours**
 ```
-Total servers: {total_guild_count}
-Total members in VC: {len(datastore.get_tracking_queue())}
+Total servers: {guild_count}
+Total members in VC: {sessions_in_vc}
 ==========
-Total times joined: {totalTimesJoined}
-Total times left: {totalTimesLeft}
-Total times moved: {totalTimesMoved}
+Total times joined: {count_since_last_summary("voice_events", voice_event_counts, "join")}
+Total times left: {count_since_last_summary("voice_events", voice_event_counts, "leave")}
+Total times moved: {count_since_last_summary("voice_events", voice_event_counts, "move")}
 ==========
-/donate used: {donateUsed}
-/resetall used: {resetAllUsed}
-/resetuser used: {resetUserUsed}
-/help used: {helpUsed}
-/stats used: {statsUsed}
-/leaderboard used: {leaderboardUsed}
+/donate used: {count_since_last_summary("commands", command_counts, "donate")}
+/resetall used: {count_since_last_summary("commands", command_counts, "resetall")}
+/resetuser used: {count_since_last_summary("commands", command_counts, "resetuser")}
+/help used: {count_since_last_summary("commands", command_counts, "help")}
+/stats used: {count_since_last_summary("commands", command_counts, "stats")}
+/leaderboard used: {count_since_last_summary("commands", command_counts, "leaderboard")}
+/channelstats used: {count_since_last_summary("commands", command_counts, "channelstats")}
 ==========
-Total Shards: {shard_count}
+Write buffer flushes: {write_buffer.total_flushes}
+Write buffer entries flushed: {write_buffer.total_entries_flushed}
+Write buffer failed entries: {write_buffer.total_failed_entries}
+Write buffer last flush: {write_buffer.last_flush_size} entries in {write_buffer.last_flush_ms:.3f}ms
+Write buffer max flush: {write_buffer.max_flush_size} entries, {write_buffer.max_flush_ms:.3f}ms
+Last database write: {datastore.get_last_flush_report().describe()}
+Tracking lock acquisitions: {tracking_queue_locks.total_acquisitions}
+Tracking lock contended: {tracking_queue_locks.contended_acquisitions}
+Tracking lock wait: {tracking_queue_locks.total_wait_ms:.3f}ms total, {tracking_queue_locks.max_wait_ms:.3f}ms max
+Leaderboard cache hits: {leaderboard_cache.hits}
+Leaderboard cache misses: {leaderboard_cache.misses}
+Leaderboard cache evictions: {leaderboard_cache.evictions}
+Leaderboard cache invalidations: {leaderboard_cache.invalidations}
+Hot guild pages served: {hot_guilds.hits} ({hot_guilds.guild_count()} hot guilds)
+Stale sessions removed: {stale_sessions_removed}
+Reconciliation sweep passes: {sweep_passes_completed} (last took {last_sweep_pass_seconds:.0f}s)
+==========
+{worker_message}Total Shards: {shard_count}
 {shard_message}
     ```
     """).strip()
 
-    totalTimesJoined = 0
-    totalTimesLeft = 0
-    totalTimesMoved = 0
-
-    helpUsed = 0
-    statsUsed = 0
-    leaderboardUsed = 0
-    resetAllUsed = 0
-    resetUserUsed = 0
-    donateUsed = 0
+    # The counters themselves keep going, so the metrics endpoint never sees them reset
+    last_summary_counts["voice_events"] = voice_event_counts
+    last_summary_counts["commands"] = command_counts
 
     return message
 
 def load(bot: lightbulb.BotApp) -> None:
+    register_gauges()
     bot.add_plugin(plugin)
\ No newline at end of file
@@ -0,0 +1,256 @@
+import asyncio
+import time
+import hikari
+
+from collections import deque
+from perf_logging import record_timing
+from typing import Callable, Deque, Dict, List, Optional
+
+# Discord's limit on the length of a message
+MAX_MESSAGE_LENGTH = 2000
+
+# Starts and ends a code block
+FENCE = "```"
+
+# Messages that go first within their channel, e.g. reports. Everything else is a log line
+HIGH_PRIORITY = 0
+LOW_PRIORITY = 1
+
+# Discord allows about 5 messages per 5 seconds in a channel. Staying under that means never getting a 429
+CHANNEL_MESSAGES_PER_WINDOW = 5
+CHANNEL_WINDOW_SECONDS = 5.0
+
+# How long a send waits for running commands to respond first, before going anyway
+MAX_DEFER_SECONDS = 2.0
+
+
+def split_message(message: str) -> List[str]:
+    """
+    Splits a message that's too long for one message at line breaks, or anywhere if a line is too long itself.
+    A code block that gets split is closed at the end of one part and opened again at the start of the next,
+    so each part shows up the same on its own.
+    """
+    parts: List[str] = []
+    current: str = ""
+    # The line that opened the code block the current line is in, e.g. "```" or "```py"
+    fence: Optional[str] = None
+
+    def finish(text: str) -> None:
+        nonlocal current
+        parts.append(f"{text}\n{FENCE}" if fence is not None else text)
+        current = fence or ""
+
+    for line in message.split("\n"):
+        is_fence: bool = line.strip().startswith(FENCE)
+        fence_after: Optional[str] = (None if fence is not None else line.strip()) if is_fence else fence
+
+        # A part that ends inside a code block needs room to close it
+        limit: int = MAX_MESSAGE_LENGTH - (len(FENCE) + 1 if fence_after is not None else 0)
+
+        while len(f"{current}\n{line}" if current else line) > limit:
+            if current and current != fence:
+                finish(current)
+                continue
+
+            # Doesn't fit even at the start of a part, so it's cut
+            cut: int = limit - (len(current) + 1 if current else 0)
+            finish(f"{current}\n{line[:cut]}" if current else line[:cut])
+            line = line[cut:]
+
+        current = f"{current}\n{line}" if current else line
+        fence = fence_after
+
+    if current and current != fence:
+        parts.append(current)
+
+    return parts
+
+
+class ChannelQueue:
+    """The messages waiting for one channel, and when the last few were sent there"""
+
+    def __init__(self):
+        self.messages: List[Deque[str]] = [deque(), deque()]
+        self.sent_at: Deque[float] = deque()
+
+        # Whether the next message is being held back for the rate limit
+        self.held: bool = False
+
+
+    def __len__(self) -> int:
+        return sum(len(messages) for messages in self.messages)
+
+
+    def ready_at(self, now: float) -> float:
+        """When the next message can go out without going over the channel's rate limit"""
+        while self.sent_at and now - self.sent_at[0] >= CHANNEL_WINDOW_SECONDS:
+            self.sent_at.popleft()
+
+        if len(self.sent_at) < CHANNEL_MESSAGES_PER_WINDOW:
+            return now
+
+        return self.sent_at[0] + CHANNEL_WINDOW_SECONDS
+
+
+    def take_message(self) -> tuple[str, int]:
+        """
+        Takes the next message, with as many of the ones after it merged in as fit in one message.
+        Higher priority ones go first. Returns the message and how many were merged into it.
+        """
+        for messages in self.messages:
+            if not messages:
+                continue
+
+            message: str = messages.popleft()
+            merged: int = 1
+
+            while messages and len(message) + 1 + len(messages[0]) <= MAX_MESSAGE_LENGTH:
+                message = f"{message}\n{messages.popleft()}"
+                merged += 1
+
+            return message, merged
+
+        raise IndexError("No messages waiting")
+
+
+class MessageScheduler:
+    """
+    Sends every log and report message the bot posts, so they don't compete with interaction responses
+    for REST requests. Each channel has its own queue, and messages waiting for the same channel are merged
+    into one as long as they fit. Each channel is paced to stay under Discord's rate limit instead of
+    running into it, and nothing is sent while a command is still waiting for its response.
+    """
+
+    def __init__(self):
+        self._rest: Optional[hikari.api.RESTClient] = None
+        self._commands_in_flight: Callable[[], bool] = lambda: False
+
+        self._channels: Dict[int, ChannelQueue] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task[None]] = None
+        self._stopping: bool = False
+
+        # Scheduler reporting
+        self.messages_queued: int = 0
+        self.messages_sent: int = 0
+        self.messages_failed: int = 0
+        # Requests not made because their message was merged into another one
+        self.messages_merged: int = 0
+        # Sends held back because they would have gone over a channel's rate limit
+        self.rate_limits_avoided: int = 0
+        # Sends held back for a command's response
+        self.deferred_for_commands: int = 0
+
+
+    def start(self, rest: hikari.api.RESTClient, commands_in_flight: Callable[[], bool]) -> None:
+        self._rest = rest
+        self._commands_in_flight = commands_in_flight
+
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+
+    async def stop(self) -> None:
+        """Sends everything that's still waiting and stops"""
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+
+
+    def send(self, channel_id: int, message: str, priority: int = LOW_PRIORITY) -> None:
+        """Queues a message for the channel. Never waits on Discord"""
+        channel = self._channels.get(channel_id)
+        if channel is None:
+            channel = self._channels[channel_id] = ChannelQueue()
+
+        for part in split_message(message):
+            channel.messages[priority].append(part)
+            self.messages_queued += 1
+
+        self._wakeup.set()
+
+
+    def pending_count(self) -> int:
+        return sum(len(channel) for channel in self._channels.values())
+
+
+    async def _run(self) -> None:
+        while True:
+            # Cleared before looking, so a message queued while this goes around isn't missed
+            self._wakeup.clear()
+
+            now = time.monotonic()
+            next_ready_at: Optional[float] = None
+
+            for channel_id, channel in list(self._channels.items()):
+                if not channel:
+                    # Forget about channels that are quiet and haven't been posted in for a while
+                    if not channel.sent_at or now - channel.sent_at[-1] >= CHANNEL_WINDOW_SECONDS:
+                        del self._channels[channel_id]
+                    continue
+
+                ready_at: float = channel.ready_at(now)
+                if ready_at > now:
+                    if not channel.held:
+                        channel.held = True
+                        self.rate_limits_avoided += 1
+                    next_ready_at = ready_at if next_ready_at is None else min(next_ready_at, ready_at)
+                    continue
+
+                await self._wait_for_commands()
+                await self._send(channel_id, channel)
+                now = time.monotonic()
+
+            if self._stopping and not self.pending_count():
+                return
+
+            if any(self._channels.values()) and next_ready_at is None:
+                # Channels that can send right away, go around again
+                continue
+
+            timeout: Optional[float] = None if next_ready_at is None else max(0.0, next_ready_at - time.monotonic())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+    async def _wait_for_commands(self) -> None:
+        if self._stopping or not self._commands_in_flight():
+            return
+
+        self.deferred_for_commands += 1
+
+        deadline = time.monotonic() + MAX_DEFER_SECONDS
+        while self._commands_in_flight() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+
+    async def _send(self, channel_id: int, channel: ChannelQueue) -> None:
+        message, merged = channel.take_message()
+        channel.sent_at.append(time.monotonic())
+        channel.held = False
+
+        start = time.perf_counter()
+        try:
+            if self._rest is None:
+                raise RuntimeError("Message scheduler is not started")
+
+            await self._rest.create_message(channel_id, message)
+            self.messages_sent += 1
+            self.messages_merged += merged - 1
+        except Exception as error:
+            # Log messages aren't worth retrying, and retrying could pile them up during an outage
+            self.messages_failed += merged
+            print(f"Error sending message to {channel_id}: {error}")
+
+        end = time.perf_counter()
+        elapsed_ms = (end - start) * 1000
+        record_timing("scheduled_message_send", elapsed_ms)
+
+
+# Every log and report message goes through here, so they don't compete with command responses
+message_scheduler = MessageScheduler()
@@ -0,0 +1,237 @@
+import asyncio
+
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+# Latency buckets, in milliseconds. Exported in seconds, as Prometheus expects
+LATENCY_BUCKETS_MS: Tuple[float, ...] = (0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+LabelValues = Tuple[str, ...]
+
+# What a callback metric returns: one value, or a value per set of label values
+CallbackValue = Union[float, Dict[LabelValues, float]]
+
+
+def format_labels(label_names: Tuple[str, ...], label_values: LabelValues, extra: str = "") -> str:
+    pairs: List[str] = []
+    for name, value in zip(label_names, label_values):
+        escaped = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f'{name}="{escaped}"')
+
+    if extra:
+        pairs.append(extra)
+
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float) -> str:
+    if value == int(value):
+        return str(int(value))
+
+    return repr(value)
+
+
+class Counter:
+    """Only ever goes up. Consumers that want "since last time" keep their own snapshot"""
+
+    def __init__(self, name: str, description: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self._values: Dict[LabelValues, float] = {}
+
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+    def value(self, *label_values: str) -> float:
+        return self._values.get(label_values, 0)
+
+
+    def values(self) -> Dict[LabelValues, float]:
+        return dict(self._values)
+
+
+    def render(self) -> List[str]:
+        lines: List[str] = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """Cumulative latency buckets per set of label values, like a Prometheus histogram"""
+
+    def __init__(self, name: str, description: str, label_names: Tuple[str, ...] = (), buckets_ms: Tuple[float, ...] = LATENCY_BUCKETS_MS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self._buckets_ms = buckets_ms
+
+        # label values -> count per bucket (the last one is +Inf), sum in ms
+        self._counts: Dict[LabelValues, List[int]] = {}
+        self._sums_ms: Dict[LabelValues, float] = {}
+
+
+    def observe(self, elapsed_ms: float, *label_values: str) -> None:
+        counts = self._counts.get(label_values)
+        if counts is None:
+            counts = self._counts[label_values] = [0] * (len(self._buckets_ms) + 1)
+            self._sums_ms[label_values] = 0.0
+
+        counts[bisect_left(self._buckets_ms, elapsed_ms)] += 1
+        self._sums_ms[label_values] += elapsed_ms
+
+
+    def render(self) -> List[str]:
+        lines: List[str] = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+
+        for label_values in sorted(self._counts):
+            counts = self._counts[label_values]
+
+            cumulative = 0
+            for bound_ms, count in zip(self._buckets_ms, counts):
+                cumulative += count
+                le = format_labels(self.label_names, label_values, f'le="{bound_ms / 1000}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+
+            cumulative += counts[-1]
+            labels = format_labels(self.label_names, label_values)
+            infinity = format_labels(self.label_names, label_values, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{infinity} {cumulative}")
+            lines.append(f"{self.name}_sum{labels} {self._sums_ms[label_values] / 1000}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+
+        return lines
+
+
+class CallbackMetric:
+    """
+    A gauge (or counter) whose value is read when it's exported, for things that are already kept
+    somewhere else, like the size of the tracking queue
+    """
+
+    def __init__(self, name: str, description: str, metric_type: str, callback: Callable[[], CallbackValue], label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.metric_type = metric_type
+        self.label_names = label_names
+        self._callback = callback
+
+
+    def values(self) -> Dict[LabelValues, float]:
+        value = self._callback()
+        if isinstance(value, dict):
+            return value
+
+        return {(): value}
+
+
+    def render(self) -> List[str]:
+        lines: List[str] = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.metric_type}"]
+        for label_values, value in sorted(self.values().items()):
+            lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Union[Counter, Histogram, CallbackMetric]] = {}
+
+
+    def counter(self, name: str, description: str, label_names: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, description, label_names)
+        self._metrics[name] = metric
+        return metric
+
+
+    def histogram(self, name: str, description: str, label_names: Tuple[str, ...] = ()) -> Histogram:
+        metric = Histogram(name, description, label_names)
+        self._metrics[name] = metric
+        return metric
+
+
+    def gauge_callback(self, name: str, description: str, callback: Callable[[], CallbackValue], label_names: Tuple[str, ...] = ()) -> CallbackMetric:
+        metric = CallbackMetric(name, description, "gauge", callback, label_names)
+        self._metrics[name] = metric
+        return metric
+
+
+    def counter_callback(self, name: str, description: str, callback: Callable[[], CallbackValue], label_names: Tuple[str, ...] = ()) -> CallbackMetric:
+        metric = CallbackMetric(name, description, "counter", callback, label_names)
+        self._metrics[name] = metric
+        return metric
+
+
+    def render(self) -> str:
+        """Everything in the Prometheus text format"""
+        lines: List[str] = []
+        for name in sorted(self._metrics):
+            try:
+                lines.extend(self._metrics[name].render())
+            except Exception as error:
+                print(f"Error exporting metric {name}: {error}")
+
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+# How long operations take, fed by perf_logging.record_timing()
+operation_latency = registry.histogram(
+    "vcstats_operation_duration_seconds",
+    "How long voice events, commands and datastore calls take",
+    ("operation",)
+)
+
+
+metrics_server: Optional[asyncio.AbstractServer] = None
+
+
+async def handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+
+        # Skip the headers, nothing in them matters here
+        while (await asyncio.wait_for(reader.readline(), timeout=5)).strip():
+            pass
+
+        parts = request_line.decode("latin-1").split()
+        path = parts[1] if len(parts) > 1 else ""
+
+        if path.split("?")[0] == "/metrics":
+            status = "200 OK"
+            body = registry.render().encode()
+        else:
+            status = "404 Not Found"
+            body = b"Not found\n"
+
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as error:
+        print(f"Error serving metrics: {error}")
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host: str, port: int) -> None:
+    """Serves GET /metrics in the Prometheus text format"""
+    global metrics_server
+
+    if metrics_server is None:
+        metrics_server = await asyncio.start_server(handle_request, host, port)
+
+
+async def stop_metrics_server() -> None:
+    global metrics_server
+
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+        metrics_server = None
@@ -0,0 +1,28 @@
+class BatchSizer:
+    """
+    Picks how many increments go into one pipeline. Grows the batches a little at a time while
+    pipelines come back within the target latency, and halves them as soon as one is slow or fails.
+    """
+
+    def __init__(self, initial_size: int = 100, min_size: int = 25, max_size: int = 2000, target_ms: float = 50.0, step: int = 25):
+        self._min_size = min_size
+        self._max_size = max_size
+        self._target_ms = target_ms
+        self._step = step
+
+        self.batch_size: int = initial_size
+
+
+    def record_success(self, elapsed_ms: float) -> None:
+        if elapsed_ms > self._target_ms:
+            self._decrease()
+        else:
+            self.batch_size = min(self._max_size, self.batch_size + self._step)
+
+
+    def record_failure(self) -> None:
+        self._decrease()
+
+
+    def _decrease(self) -> None:
+        self.batch_size = max(self._min_size, self.batch_size // 2)
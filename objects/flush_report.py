@@ -0,0 +1,24 @@
+from typing import Dict
+
+
+class FlushReport:
+    """How one write of the write buffer to the database went"""
+
+    def __init__(self):
+        self.keys: int = 0
+        self.batches: int = 0
+        self.failed_batches: int = 0
+        # Batches that errored after they were sent, so they may or may not have been written. Not retried
+        self.uncertain_batches: int = 0
+        self.concurrency: int = 0
+        self.wall_ms: float = 0.0
+        # The batch size each node ended up at
+        self.batch_sizes: Dict[str, int] = {}
+
+
+    def describe(self) -> str:
+        batch_sizes = ", ".join(f"{node_name}: {size}" for node_name, size in self.batch_sizes.items()) or "-"
+        return (
+            f"{self.keys} keys in {self.batches} batches ({self.failed_batches} failed, {self.uncertain_batches} uncertain), "
+            f"concurrency {self.concurrency}, {self.wall_ms:.3f}ms, batch sizes {batch_sizes}"
+        )
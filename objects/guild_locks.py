@@ -0,0 +1,46 @@
+import asyncio
+import time
+
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List
+from perf_logging import record_timing
+
+
+class GuildLocks:
+    """
+    A fixed set of locks shared out between guilds by guild ID, so that work in one guild
+    only waits on guilds that happen to land on the same stripe instead of on every guild.
+    Keeps track of how long each acquisition had to wait.
+    """
+
+    def __init__(self, stripes: int = 64):
+        self._locks: List[asyncio.Lock] = [asyncio.Lock() for _ in range(stripes)]
+
+        self.total_acquisitions: int = 0
+        self.contended_acquisitions: int = 0
+        self.total_wait_ms: float = 0.0
+        self.max_wait_ms: float = 0.0
+
+
+    @asynccontextmanager
+    async def for_guild(self, guild_id: int) -> AsyncIterator[None]:
+        lock = self._locks[guild_id % len(self._locks)]
+
+        if not lock.locked():
+            async with lock:
+                self.total_acquisitions += 1
+                yield
+            return
+
+        start = time.perf_counter()
+        async with lock:
+            end = time.perf_counter()
+            wait_ms = (end - start) * 1000
+
+            self.total_acquisitions += 1
+            self.contended_acquisitions += 1
+            self.total_wait_ms += wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+            record_timing("tracking_queue_lock_wait", wait_ms)
+
+            yield
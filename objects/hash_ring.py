@@ -0,0 +1,51 @@
+import hashlib
+
+from bisect import bisect, insort
+from typing import Dict, List
+
+
+class HashRing:
+    """
+    Consistent hashing of guild IDs onto node names. Every node gets `replicas` points on the
+    ring, so adding or removing a node only moves the guilds next to its points.
+    """
+
+    def __init__(self, node_names: List[str], replicas: int = 160):
+        self._replicas = replicas
+        self._points: List[int] = []
+        self._owners: Dict[int, str] = {}
+
+        for node_name in node_names:
+            self.add_node(node_name)
+
+
+    def add_node(self, node_name: str) -> None:
+        for i in range(self._replicas):
+            point = self._hash(f"{node_name}#{i}")
+            if point in self._owners:
+                continue
+
+            self._owners[point] = node_name
+            insort(self._points, point)
+
+
+    def remove_node(self, node_name: str) -> None:
+        self._points = [point for point in self._points if self._owners[point] != node_name]
+        self._owners = {point: owner for point, owner in self._owners.items() if owner != node_name}
+
+
+    def node_for(self, guild_id: int) -> str:
+        if not self._points:
+            raise LookupError("The hash ring has no nodes")
+
+        index = bisect(self._points, self._hash(str(guild_id))) % len(self._points)
+        return self._owners[self._points[index]]
+
+
+    def node_names(self) -> List[str]:
+        return sorted(set(self._owners.values()))
+
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
@@ -0,0 +1,99 @@
+from typing import Dict, List, Optional, Set
+
+
+class HotGuilds:
+    """
+    Counts how often each guild asks for its leaderboard, per period, and holds the first pages of the
+    hottest guilds rendered ahead of time so they can be answered with a single lookup.
+    The counts decay with a half-life, so a guild that stops asking cools down again.
+    Unlike the leaderboard cache, the pages aren't dropped when new time is written. They're replaced
+    by the next refresh, and only dropped early when the guild's stats get reset.
+    """
+
+    def __init__(self, half_life_seconds: float = 600):
+        self._half_life_seconds = half_life_seconds
+
+        # (guild_id, period) -> decayed number of requests
+        self._counts: Dict[tuple[int, str], float] = {}
+
+        # (guild_id, period, page) -> rendered page
+        self._pages: Dict[tuple[int, str, int], str] = {}
+        self._guild_pages: Dict[int, Set[tuple[str, int]]] = {}
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.refreshes: int = 0
+
+
+    def record(self, guild_id: int, period: str = "all") -> None:
+        key = (guild_id, period)
+        self._counts[key] = self._counts.get(key, 0.0) + 1
+
+
+    def decay(self, elapsed_seconds: float) -> None:
+        factor: float = 0.5 ** (elapsed_seconds / self._half_life_seconds)
+
+        # Anything that has decayed to almost nothing is forgotten, so the counts don't grow forever
+        self._counts = {key: count * factor for key, count in self._counts.items() if count * factor >= 0.1}
+
+
+    def hottest(self, count: int) -> List[tuple[int, List[str]]]:
+        """The `count` guilds asking most often, hottest first, each with the periods they ask for"""
+        guild_counts: Dict[int, float] = {}
+        guild_periods: Dict[int, List[str]] = {}
+
+        for (guild_id, period), period_count in self._counts.items():
+            guild_counts[guild_id] = guild_counts.get(guild_id, 0.0) + period_count
+            guild_periods.setdefault(guild_id, []).append(period)
+
+        hottest_guild_ids = sorted(guild_counts, key=guild_counts.__getitem__, reverse=True)[:count]
+        return [(guild_id, guild_periods[guild_id]) for guild_id in hottest_guild_ids]
+
+
+    def get_page(self, guild_id: int, page: int, period: str = "all") -> Optional[str]:
+        rendered: Optional[str] = self._pages.get((guild_id, period, page))
+
+        if rendered is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return rendered
+
+
+    def set_pages(self, guild_id: int, period: str, pages: Dict[int, str]) -> None:
+        """Replaces the guild's rendered pages of the period with page number -> rendered page"""
+        guild_pages = self._guild_pages.setdefault(guild_id, set())
+
+        for old_period, page in [key for key in guild_pages if key[0] == period and key[1] not in pages]:
+            self._pages.pop((guild_id, old_period, page), None)
+            guild_pages.discard((old_period, page))
+
+        for page, rendered in pages.items():
+            self._pages[(guild_id, period, page)] = rendered
+            guild_pages.add((period, page))
+
+        self.refreshes += 1
+
+
+    def drop_guild(self, guild_id: int) -> None:
+        for period, page in self._guild_pages.pop(guild_id, ()):
+            self._pages.pop((guild_id, period, page), None)
+
+
+    def retain(self, hot: List[tuple[int, List[str]]]) -> None:
+        """Drops the pages of every guild and period that isn't in `hot` anymore, as returned by hottest()"""
+        keep: Set[tuple[int, str]] = {(guild_id, period) for guild_id, periods in hot for period in periods}
+
+        for guild_id, guild_pages in list(self._guild_pages.items()):
+            for period, page in [key for key in guild_pages if (guild_id, key[0]) not in keep]:
+                self._pages.pop((guild_id, period, page), None)
+                guild_pages.discard((period, page))
+
+            if not guild_pages:
+                del self._guild_pages[guild_id]
+
+
+    def guild_count(self) -> int:
+        """How many guilds have pages rendered ahead of time"""
+        return len(self._guild_pages)
@@ -0,0 +1,83 @@
+import time
+
+from collections import OrderedDict
+from typing import Dict, Optional, Set
+
+
+class LeaderboardCache:
+    """
+    Rendered leaderboard pages keyed by (guild_id, period, page), least recently used first.
+    A page is served for at most `max_age_seconds`, and all of a guild's pages are
+    dropped whenever new time is written for that guild or its stats get reset.
+    """
+
+    def __init__(self, max_entries: int = 2000, max_age_seconds: float = 30):
+        self._max_entries = max_entries
+        self._max_age_seconds = max_age_seconds
+
+        # (guild_id, period, page) -> (created at, rendered page)
+        self._pages: OrderedDict[tuple[int, str, int], tuple[float, str]] = OrderedDict()
+        self._guild_pages: Dict[int, Set[tuple[str, int]]] = {}
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.invalidations: int = 0
+
+
+    def get(self, guild_id: int, page: int, period: str = "all") -> Optional[str]:
+        key = (guild_id, period, page)
+        entry = self._pages.get(key)
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        created_at, rendered = entry
+        if time.monotonic() - created_at > self._max_age_seconds:
+            self._remove(key)
+            self.misses += 1
+            return None
+
+        self._pages.move_to_end(key)
+        self.hits += 1
+        return rendered
+
+
+    def put(self, guild_id: int, page: int, rendered: str, period: str = "all") -> None:
+        key = (guild_id, period, page)
+
+        self._pages[key] = (time.monotonic(), rendered)
+        self._pages.move_to_end(key)
+        self._guild_pages.setdefault(guild_id, set()).add((period, page))
+
+        while len(self._pages) > self._max_entries:
+            oldest_key = next(iter(self._pages))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+
+    def invalidate_guild(self, guild_id: int) -> None:
+        pages = self._guild_pages.pop(guild_id, None)
+        if not pages:
+            return
+
+        for period, page in pages:
+            self._pages.pop((guild_id, period, page), None)
+
+        self.invalidations += 1
+
+
+    def __len__(self) -> int:
+        return len(self._pages)
+
+
+    def _remove(self, key: tuple[int, str, int]) -> None:
+        self._pages.pop(key, None)
+
+        guild_id, period, page = key
+        pages = self._guild_pages.get(guild_id)
+        if pages is not None:
+            pages.discard((period, page))
+            if not pages:
+                del self._guild_pages[guild_id]
@@ -0,0 +1,440 @@
+import glob
+import mmap
+import os
+import re
+import struct
+
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional
+
+# File layout: a header, followed by fixed size records
+HEADER = struct.Struct("<8sQ")  # magic, number of records
+RECORD = struct.Struct("<B7xqqq")  # kind, user_id, guild_id, value
+MAGIC = b"VCSJRNL1"
+
+# Session started (or had its join time set) at `value`
+JOIN = 1
+# Session's time up to `value` was queued to be saved
+SAVE = 2
+# Every session in the guild (or everyone, if guild_id is 0) had its time up to `value` queued to be saved
+SAVE_GUILD = 3
+# Session ended
+LEAVE = 4
+# Every session in the guild ended
+LEAVE_GUILD = 5
+# `value` seconds were queued to be saved for the member, but not written yet. Written by compaction, and for
+# what a flush couldn't write and is going to retry
+PENDING = 6
+# Everything queued before record number `value` has been written to the database
+FLUSHED = 7
+# The bot was still running at `value`
+HEARTBEAT = 8
+
+
+class RecoveredSessions:
+    """What was left in the journal when the bot last stopped"""
+
+    def __init__(self):
+        # (guild_id, user_id, time_difference) that never made it to the database
+        self.unsaved: List[tuple[int, int, int]] = []
+        # guild_id -> user_id -> joined_time of everyone who was still in VC
+        self.sessions: Dict[int, Dict[int, int]] = {}
+        # Last time the bot was known to be running
+        self.last_alive: int = 0
+
+
+class SessionJournal:
+    """
+    Append-only, memory-mapped log of session changes. Writing a record is just a copy into the
+    mapped file, and the OS keeps the pages even if the process gets killed, so a crash loses nothing.
+
+    The file only ever contains enough to rebuild the sessions, and compact() rewrites it
+    from the current state once it gets too full.
+    """
+
+    def __init__(self, path: str, initial_records: int = 65536):
+        self._path = path
+        self._initial_records = initial_records
+
+        self._file = None
+        self._map: Optional[mmap.mmap] = None
+        self._capacity: int = 0
+        self._count: int = 0
+
+
+    def open(self) -> RecoveredSessions:
+        """Opens the journal, creating it if needed, and returns what was recovered from it"""
+        if not os.path.exists(self._path):
+            self._create(self._path, self._initial_records)
+
+        self._map_file()
+
+        return self._replay()
+
+
+    def close(self) -> None:
+        if self._map is not None:
+            self._map.flush()
+            self._map.close()
+            self._map = None
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+    def position(self) -> int:
+        return self._count
+
+
+    def fill_ratio(self) -> float:
+        if self._capacity == 0:
+            return 0.0
+
+        return self._count / self._capacity
+
+
+    def record_join(self, user_id: int, guild_id: int, joined_time: int) -> None:
+        self._append(JOIN, user_id, guild_id, joined_time)
+
+
+    def record_save(self, user_id: int, guild_id: int, saved_until: int) -> None:
+        self._append(SAVE, user_id, guild_id, saved_until)
+
+
+    def record_save_guild(self, guild_id: Optional[int], saved_until: int) -> None:
+        self._append(SAVE_GUILD, 0, guild_id or 0, saved_until)
+
+
+    def record_leave(self, user_id: int, guild_id: int) -> None:
+        self._append(LEAVE, user_id, guild_id, 0)
+
+
+    def record_leave_guild(self, guild_id: int) -> None:
+        self._append(LEAVE_GUILD, 0, guild_id, 0)
+
+
+    def record_flushed(self, position: int) -> None:
+        self._append(FLUSHED, 0, 0, position)
+
+
+    def record_pending(self, user_id: int, guild_id: int, time_difference: int) -> None:
+        self._append(PENDING, user_id, guild_id, time_difference)
+
+
+    def record_heartbeat(self, current_time: int) -> None:
+        self._append(HEARTBEAT, 0, 0, current_time)
+
+
+    def compact(self, sessions: Iterable[tuple[int, int, int]], pending: Iterable[tuple[int, int, int]], current_time: int) -> None:
+        """
+        Replaces the journal with just the current state.
+        sessions are (user_id, guild_id, joined_time), pending are (guild_id, user_id, time_difference)
+        """
+        records: List[bytes] = [RECORD.pack(JOIN, user_id, guild_id, joined_time) for user_id, guild_id, joined_time in sessions]
+        records.extend(RECORD.pack(PENDING, user_id, guild_id, time_difference) for guild_id, user_id, time_difference in pending)
+        records.append(RECORD.pack(HEARTBEAT, 0, 0, current_time))
+
+        capacity = self._initial_records
+        while capacity < len(records) * 2:
+            capacity *= 2
+
+        temporary_path = self._path + ".tmp"
+        self._create(temporary_path, capacity, records)
+
+        self.close()
+        os.replace(temporary_path, self._path)
+        self._map_file()
+
+
+    def _create(self, path: str, capacity: int, records: Optional[List[bytes]] = None) -> None:
+        records = records or []
+
+        with open(path, "wb") as file:
+            file.truncate(HEADER.size + capacity * RECORD.size)
+            file.write(HEADER.pack(MAGIC, len(records)))
+            file.write(b"".join(records))
+            file.flush()
+            os.fsync(file.fileno())
+
+
+    def _map_file(self) -> None:
+        self._file = open(self._path, "r+b")
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+        magic, count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{self._path} is not a session journal")
+
+        self._capacity = (len(self._map) - HEADER.size) // RECORD.size
+        self._count = min(count, self._capacity)
+
+
+    def _append(self, kind: int, user_id: int, guild_id: int, value: int) -> None:
+        if self._map is None:
+            return
+
+        # Compaction normally keeps it from filling up, but never drop a record if it does
+        if self._count >= self._capacity:
+            self._grow()
+
+        RECORD.pack_into(self._map, HEADER.size + self._count * RECORD.size, kind, user_id, guild_id, value)
+        self._count += 1
+        HEADER.pack_into(self._map, 0, MAGIC, self._count)
+
+
+    def _grow(self) -> None:
+        assert self._map is not None and self._file is not None
+
+        self._capacity *= 2
+        self._map.flush()
+        self._map.close()
+        self._file.truncate(HEADER.size + self._capacity * RECORD.size)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+
+    def _replay(self) -> RecoveredSessions:
+        assert self._map is not None
+
+        recovered = RecoveredSessions()
+
+        # guild_id -> user_id -> time up to which the session's time was queued to be saved
+        sessions: Dict[int, Dict[int, int]] = {}
+        # (position, guild_id, user_id, time_difference) queued but not known to be written yet
+        unflushed: Deque[tuple[int, int, int, int]] = deque()
+
+        def queue_save(position: int, guild_id: int, user_id: int, saved_until: int) -> None:
+            joined_time = sessions[guild_id][user_id]
+            if saved_until > joined_time:
+                unflushed.append((position, guild_id, user_id, saved_until - joined_time))
+                sessions[guild_id][user_id] = saved_until
+
+        for position in range(self._count):
+            kind, user_id, guild_id, value = RECORD.unpack_from(self._map, HEADER.size + position * RECORD.size)
+
+            if kind == JOIN:
+                sessions.setdefault(guild_id, {})[user_id] = value
+                recovered.last_alive = max(recovered.last_alive, value)
+
+            elif kind == SAVE:
+                if user_id in sessions.get(guild_id, {}):
+                    queue_save(position, guild_id, user_id, value)
+                recovered.last_alive = max(recovered.last_alive, value)
+
+            elif kind == SAVE_GUILD:
+                guild_ids = list(sessions) if guild_id == 0 else [guild_id]
+                for saved_guild_id in guild_ids:
+                    for saved_user_id in list(sessions.get(saved_guild_id, {})):
+                        queue_save(position, saved_guild_id, saved_user_id, value)
+                recovered.last_alive = max(recovered.last_alive, value)
+
+            elif kind == LEAVE:
+                guild_sessions = sessions.get(guild_id)
+                if guild_sessions is not None:
+                    guild_sessions.pop(user_id, None)
+
+            elif kind == LEAVE_GUILD:
+                sessions.pop(guild_id, None)
+
+            elif kind == PENDING:
+                unflushed.append((position, guild_id, user_id, value))
+
+            elif kind == FLUSHED:
+                while unflushed and unflushed[0][0] < value:
+                    unflushed.popleft()
+
+            elif kind == HEARTBEAT:
+                recovered.last_alive = max(recovered.last_alive, value)
+
+        merged: Dict[tuple[int, int], int] = {}
+        for _, guild_id, user_id, time_difference in unflushed:
+            merged[(guild_id, user_id)] = merged.get((guild_id, user_id), 0) + time_difference
+
+        recovered.unsaved = [(guild_id, user_id, time_difference) for (guild_id, user_id), time_difference in merged.items()]
+        recovered.sessions = {guild_id: guild_sessions for guild_id, guild_sessions in sessions.items() if guild_sessions}
+
+        return recovered
+
+
+def merge_recovered(into: RecoveredSessions, recovered: RecoveredSessions) -> None:
+    into.unsaved.extend(recovered.unsaved)
+    for guild_id, guild_sessions in recovered.sessions.items():
+        into.sessions.setdefault(guild_id, {}).update(guild_sessions)
+
+    # Each journal only knows when its own sessions were last seen, so the earliest is the one that's safe for all
+    if recovered.last_alive:
+        into.last_alive = min(into.last_alive, recovered.last_alive) if into.last_alive else recovered.last_alive
+
+
+class ShardedSessionJournal:
+    """
+    One SessionJournal per shard, so a shard's sessions follow it to whichever worker of the cluster owns
+    it next, e.g. after CLUSTER_PROCESSES changes. Records go to the journal of the guild's shard.
+    Outside a cluster (shard_ids is None) it's a single journal at `path`.
+
+    Journals no current shard owns, e.g. after the shard count went down, are replayed by the owner of
+    shard 0 (or the single journal), written into its own journals and removed.
+    """
+
+    def __init__(self, path: str, shard_ids: Optional[List[int]], shard_count: int = 1):
+        self._path = path
+        self._shard_count = shard_count
+
+        self._journals: Dict[Optional[int], SessionJournal] = {}
+        if shard_ids is None:
+            self._journals[None] = SessionJournal(path)
+        else:
+            for shard_id in shard_ids:
+                self._journals[shard_id] = SessionJournal(self.shard_path(shard_id))
+
+        # Records of guilds on shards this process doesn't own, e.g. recovered ones being saved, go here
+        self._fallback: SessionJournal = next(iter(self._journals.values()))
+
+
+    def shard_path(self, shard_id: int) -> str:
+        root, extension = os.path.splitext(self._path)
+        return f"{root}.shard{shard_id}{extension}"
+
+
+    def shard_of(self, guild_id: int) -> Optional[int]:
+        """The shard Discord puts the guild on, or None outside a cluster"""
+        if None in self._journals:
+            return None
+
+        return (guild_id >> 22) % self._shard_count
+
+
+    def shard_ids(self) -> List[Optional[int]]:
+        return list(self._journals)
+
+
+    def open(self) -> RecoveredSessions:
+        """Opens every journal, creating them if needed, and returns what was recovered from all of them"""
+        recovered = RecoveredSessions()
+        for journal in self._journals.values():
+            merge_recovered(recovered, journal.open())
+
+        if None in self._journals or 0 in self._journals:
+            self._adopt_orphans(recovered)
+
+        return recovered
+
+
+    def close(self) -> None:
+        for journal in self._journals.values():
+            journal.close()
+
+
+    def position(self) -> Dict[Optional[int], int]:
+        return {shard_id: journal.position() for shard_id, journal in self._journals.items()}
+
+
+    def fill_ratio(self) -> float:
+        return max(journal.fill_ratio() for journal in self._journals.values())
+
+
+    def record_join(self, user_id: int, guild_id: int, joined_time: int) -> None:
+        self._journal_for(guild_id).record_join(user_id, guild_id, joined_time)
+
+
+    def record_save(self, user_id: int, guild_id: int, saved_until: int) -> None:
+        self._journal_for(guild_id).record_save(user_id, guild_id, saved_until)
+
+
+    def record_save_guild(self, guild_id: Optional[int], saved_until: int) -> None:
+        if guild_id is None:
+            for journal in self._journals.values():
+                journal.record_save_guild(None, saved_until)
+        else:
+            self._journal_for(guild_id).record_save_guild(guild_id, saved_until)
+
+
+    def record_leave(self, user_id: int, guild_id: int) -> None:
+        self._journal_for(guild_id).record_leave(user_id, guild_id)
+
+
+    def record_leave_guild(self, guild_id: int) -> None:
+        self._journal_for(guild_id).record_leave_guild(guild_id)
+
+
+    def record_flushed(self, positions: Dict[Optional[int], int]) -> None:
+        for shard_id, position in positions.items():
+            self._journals[shard_id].record_flushed(position)
+
+
+    def record_pending(self, user_id: int, guild_id: int, time_difference: int) -> None:
+        self._journal_for(guild_id).record_pending(user_id, guild_id, time_difference)
+
+
+    def record_heartbeat(self, current_time: int) -> None:
+        for journal in self._journals.values():
+            journal.record_heartbeat(current_time)
+
+
+    def compact(self, sessions: Iterable[tuple[int, int, int]], pending: Iterable[tuple[int, int, int]], current_time: int) -> None:
+        """Same as SessionJournal.compact(), with each journal getting the sessions and pending time of its shard"""
+        shard_sessions: Dict[Optional[int], List[tuple[int, int, int]]] = {shard_id: [] for shard_id in self._journals}
+        shard_pending: Dict[Optional[int], List[tuple[int, int, int]]] = {shard_id: [] for shard_id in self._journals}
+
+        for session in sessions:
+            shard_sessions[self._shard_id_for(session[1])].append(session)
+        for increment in pending:
+            shard_pending[self._shard_id_for(increment[0])].append(increment)
+
+        for shard_id, journal in self._journals.items():
+            journal.compact(shard_sessions[shard_id], shard_pending[shard_id], current_time)
+
+
+    def _shard_id_for(self, guild_id: int) -> Optional[int]:
+        shard_id = self.shard_of(guild_id)
+        if shard_id not in self._journals:
+            return next(iter(self._journals))
+
+        return shard_id
+
+
+    def _journal_for(self, guild_id: int) -> SessionJournal:
+        return self._journals.get(self.shard_of(guild_id), self._fallback)
+
+
+    def _is_orphan(self, path: str) -> bool:
+        """Whether the file is a journal of an earlier layout that no shard of this one owns"""
+        root, extension = os.path.splitext(self._path)
+        match = re.fullmatch(re.escape(root) + r"\.(shard|worker)(\d+)" + re.escape(extension), path)
+
+        if None in self._journals:
+            return match is not None
+        if path == self._path:
+            return True
+        if match is None:
+            return False
+
+        # The shards that still exist belong to whichever worker owns them now
+        return match.group(1) == "worker" or int(match.group(2)) >= self._shard_count
+
+
+    def _adopt_orphans(self, recovered: RecoveredSessions) -> None:
+        """Takes over the journals that no shard of the current layout owns"""
+        root, extension = os.path.splitext(self._path)
+        candidates: List[str] = glob.glob(glob.escape(root) + ".*" + glob.escape(extension)) + [self._path]
+
+        for path in sorted(set(candidates)):
+            if not os.path.isfile(path) or not self._is_orphan(path):
+                continue
+
+            orphan = SessionJournal(path)
+            try:
+                orphaned = orphan.open()
+            finally:
+                orphan.close()
+
+            # Into our own journals first, so nothing is lost if the process stops before the orphan is gone
+            for guild_id, guild_sessions in orphaned.sessions.items():
+                for user_id, joined_time in guild_sessions.items():
+                    self.record_join(user_id, guild_id, joined_time)
+            for guild_id, user_id, time_difference in orphaned.unsaved:
+                self.record_pending(user_id, guild_id, time_difference)
+
+            merge_recovered(recovered, orphaned)
+            os.remove(path)
+            print(f"Took over the session journal {path}, which no shard owns any more")
@@ -0,0 +1,59 @@
+import struct
+import sys
+import zlib
+
+from array import array
+from typing import List
+
+# A header, followed by the zlib compressed guild IDs, user IDs and join times, each as a column of int64s
+HEADER = struct.Struct("<8sqQ")  # magic, written at, number of sessions
+MAGIC = b"VCSSNAP1"
+
+
+class SessionSnapshot:
+    """Everyone who was in VC when the bot stopped, handed over to the next process"""
+
+    def __init__(self, written_at: int, guild_ids: "array[int]", user_ids: "array[int]", joined_times: "array[int]"):
+        self.written_at = written_at
+        self.guild_ids = guild_ids
+        self.user_ids = user_ids
+        self.joined_times = joined_times
+
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+
+def encode_snapshot(sessions: List[tuple[int, int, int]], written_at: int) -> bytes:
+    """
+    Packs (user_id, guild_id, joined_time) into one blob. Sorted by guild, so the guild column is long runs
+    of the same ID and the join times, which save_all just set, are mostly the same too. Both compress to
+    almost nothing.
+    """
+    sessions = sorted(sessions, key=lambda session: (session[1], session[0]))
+
+    columns = bytearray()
+    for column in (array("q", [session[1] for session in sessions]), array("q", [session[0] for session in sessions]), array("q", [session[2] for session in sessions])):
+        if sys.byteorder == "big":
+            column.byteswap()
+        columns += column.tobytes()
+
+    return HEADER.pack(MAGIC, written_at, len(sessions)) + zlib.compress(bytes(columns), 1)
+
+
+def decode_snapshot(data: bytes) -> SessionSnapshot:
+    magic, written_at, count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a session snapshot")
+
+    columns: bytes = zlib.decompress(data[HEADER.size:])
+    if len(columns) != count * 8 * 3:
+        raise ValueError("Session snapshot is truncated")
+
+    guild_ids, user_ids, joined_times = array("q"), array("q"), array("q")
+    for i, column in enumerate((guild_ids, user_ids, joined_times)):
+        column.frombytes(columns[i * count * 8:(i + 1) * count * 8])
+        if sys.byteorder == "big":
+            column.byteswap()
+
+    return SessionSnapshot(written_at, guild_ids, user_ids, joined_times)
@@ -0,0 +1,290 @@
+from array import array
+from typing import Dict, List, Optional
+
+
+def make_session_key(user_id: int, guild_id: int) -> int:
+    # Snowflakes fit in 64 bits, so both IDs can be packed into one integer
+    return (user_id << 64) | guild_id
+
+
+class SessionTable:
+    """
+    Everyone currently in a voice channel. The user IDs, guild IDs, join times and channel IDs
+    are kept in contiguous int64 arrays, and each session lives in a slot of those arrays.
+    A session key -> slot index finds a single session, and a guild -> slots array
+    keeps anything scoped to one guild down to the members of that guild.
+
+    Removing a session moves the last slot into the freed one, so the arrays never have holes. The guild's
+    slots array is kept the same way, with each slot's position in it stored alongside, so a removal
+    never has to search it.
+    """
+
+    def __init__(self):
+        self._user_ids: array[int] = array("q")
+        self._guild_ids: array[int] = array("q")
+        self._joined_times: array[int] = array("q")
+        # 0 if the channel isn't known, e.g. for sessions recovered from the journal
+        self._channel_ids: array[int] = array("q")
+
+        self._slots: Dict[int, int] = {}
+        self._guild_slots: Dict[int, array[int]] = {}
+        # Where each slot is in its guild's slots array
+        self._guild_slot_index: array[int] = array("q")
+
+
+    def __len__(self) -> int:
+        return len(self._user_ids)
+
+
+    def contains(self, user_id: int, guild_id: int) -> bool:
+        return make_session_key(user_id, guild_id) in self._slots
+
+
+    def get_joined_time(self, user_id: int, guild_id: int) -> Optional[int]:
+        slot = self._slots.get(make_session_key(user_id, guild_id))
+        if slot is None:
+            return None
+
+        return self._joined_times[slot]
+
+
+    def get_channel_id(self, user_id: int, guild_id: int) -> Optional[int]:
+        slot = self._slots.get(make_session_key(user_id, guild_id))
+        if slot is None:
+            return None
+
+        return self._channel_ids[slot]
+
+
+    def set_channel_id(self, user_id: int, guild_id: int, channel_id: int) -> None:
+        slot = self._slots.get(make_session_key(user_id, guild_id))
+        if slot is not None:
+            self._channel_ids[slot] = channel_id
+
+
+    def add(self, user_id: int, guild_id: int, joined_time: int, channel_id: int = 0) -> None:
+        key = make_session_key(user_id, guild_id)
+
+        slot = self._slots.get(key)
+        if slot is not None:
+            self._joined_times[slot] = joined_time
+            if channel_id:
+                self._channel_ids[slot] = channel_id
+            return
+
+        slot = len(self._user_ids)
+        self._user_ids.append(user_id)
+        self._guild_ids.append(guild_id)
+        self._joined_times.append(joined_time)
+        self._channel_ids.append(channel_id)
+
+        self._slots[key] = slot
+        guild_slots = self._guild_slots.get(guild_id)
+        if guild_slots is None:
+            guild_slots = self._guild_slots[guild_id] = array("q")
+
+        self._guild_slot_index.append(len(guild_slots))
+        guild_slots.append(slot)
+
+
+    def add_guild(self, guild_id: int, sessions: List[tuple[int, int, int]]) -> List[tuple[int, int, int]]:
+        """
+        Adds (user_id, joined_time, channel_id) sessions to one guild in bulk. Anyone who is already tracked
+        is left alone. Returns the sessions that were actually added.
+        """
+        added: List[tuple[int, int, int]] = []
+        slots = self._slots
+
+        first_slot = len(self._user_ids)
+        for session in sessions:
+            key = make_session_key(session[0], guild_id)
+            if key in slots:
+                continue
+
+            slots[key] = first_slot + len(added)
+            added.append(session)
+
+        if not added:
+            return added
+
+        self._user_ids.extend(user_id for user_id, _, _ in added)
+        self._guild_ids.extend(array("q", [guild_id]) * len(added))
+        self._joined_times.extend(joined_time for _, joined_time, _ in added)
+        self._channel_ids.extend(channel_id for _, _, channel_id in added)
+
+        guild_slots = self._guild_slots.get(guild_id)
+        if guild_slots is None:
+            guild_slots = self._guild_slots[guild_id] = array("q")
+
+        self._guild_slot_index.extend(range(len(guild_slots), len(guild_slots) + len(added)))
+        guild_slots.extend(range(first_slot, first_slot + len(added)))
+
+        return added
+
+
+    def pop(self, user_id: int, guild_id: int) -> Optional[int]:
+        """Removes the session and returns its join time"""
+        slot = self._slots.pop(make_session_key(user_id, guild_id), None)
+        if slot is None:
+            return None
+
+        joined_time = self._joined_times[slot]
+        self._remove_slot(slot)
+
+        return joined_time
+
+
+    def pop_guild(self, guild_id: int) -> List[tuple[int, int]]:
+        """Removes everyone in the guild and returns their (user_id, joined_time)"""
+        removed: List[tuple[int, int]] = []
+
+        # Highest slots first, so the slot that gets moved into a freed one is never one we still have to remove
+        for slot in sorted(self._guild_slots.get(guild_id, ()), reverse=True):
+            user_id = self._user_ids[slot]
+            removed.append((user_id, self._joined_times[slot]))
+
+            del self._slots[make_session_key(user_id, guild_id)]
+            self._remove_slot(slot)
+
+        return removed
+
+
+    def take_time_difference(self, user_id: int, guild_id: int, current_time: int) -> Optional[int]:
+        """
+        Returns how long the user has been in VC since their join time, and moves their join time
+        to current_time so the same time doesn't get saved twice. Returns None if they're not tracked.
+        """
+        slot = self._slots.get(make_session_key(user_id, guild_id))
+        if slot is None:
+            return None
+
+        time_difference = current_time - self._joined_times[slot]
+        if time_difference > 0:
+            self._joined_times[slot] = current_time
+
+        return time_difference
+
+
+    def take_all_time_differences(self, guild_id: Optional[int], current_time: int) -> tuple[List[int], List[int], List[int], List[int]]:
+        """
+        Same as take_time_difference(), but for everyone (guild_id is None) or everyone in one guild.
+        Returns (guild_ids, user_ids, time_differences, channel_ids), leaving out anyone with nothing to save.
+        """
+        if guild_id is None:
+            # Whole table in one pass over the arrays, and every join time is reset in one go
+            time_differences = [current_time - joined_time for joined_time in self._joined_times]
+            guild_ids = self._guild_ids.tolist()
+            user_ids = self._user_ids.tolist()
+            channel_ids = self._channel_ids.tolist()
+
+            if any(time_difference <= 0 for time_difference in time_differences):
+                keep = [i for i, time_difference in enumerate(time_differences) if time_difference > 0]
+                guild_ids = [guild_ids[i] for i in keep]
+                user_ids = [user_ids[i] for i in keep]
+                time_differences = [time_differences[i] for i in keep]
+                channel_ids = [channel_ids[i] for i in keep]
+
+                # Anyone with a join time in the future keeps it
+                self._joined_times = array("q", (max(joined_time, current_time) for joined_time in self._joined_times))
+            else:
+                self._joined_times = array("q", [current_time]) * len(self._joined_times)
+
+            return guild_ids, user_ids, time_differences, channel_ids
+
+        guild_ids: List[int] = []
+        user_ids: List[int] = []
+        time_differences: List[int] = []
+        channel_ids: List[int] = []
+
+        joined_times = self._joined_times
+        for slot in self._guild_slots.get(guild_id, ()):
+            time_difference = current_time - joined_times[slot]
+            if time_difference <= 0:
+                continue
+
+            guild_ids.append(guild_id)
+            user_ids.append(self._user_ids[slot])
+            time_differences.append(time_difference)
+            channel_ids.append(self._channel_ids[slot])
+            joined_times[slot] = current_time
+
+        return guild_ids, user_ids, time_differences, channel_ids
+
+
+    def sessions(self) -> List[tuple[int, int]]:
+        """Returns (user_id, guild_id) for everyone. It's a copy, so it's safe to use while the table changes"""
+        return list(zip(self._user_ids, self._guild_ids))
+
+
+    def sessions_with_joined_times(self) -> List[tuple[int, int, int]]:
+        """Returns (user_id, guild_id, joined_time) for everyone. It's a copy, so it's safe to use while the table changes"""
+        return list(zip(self._user_ids, self._guild_ids, self._joined_times))
+
+
+    def guild_sessions(self, guild_id: int) -> List[tuple[int, int]]:
+        """Returns (user_id, joined_time) for everyone in the guild. It's a copy, so it's safe to use while the table changes"""
+        return [(self._user_ids[slot], self._joined_times[slot]) for slot in self._guild_slots.get(guild_id, ())]
+
+
+    def guild_channel_sessions(self, guild_id: int) -> List[tuple[int, int]]:
+        """Returns (channel_id, joined_time) for everyone in the guild"""
+        return [(self._channel_ids[slot], self._joined_times[slot]) for slot in self._guild_slots.get(guild_id, ())]
+
+
+    def session_slice(self, cursor: int, count: int) -> tuple[List[tuple[int, int]], int]:
+        """
+        Returns (user_id, guild_id) for up to `count` sessions starting at slot `cursor`, and the cursor
+        to continue from, which wraps back to 0 at the end. Sessions that get moved around by removals
+        in the meantime can be missed or seen twice in one pass, but never for more than one pass.
+        """
+        if cursor >= len(self._user_ids):
+            cursor = 0
+
+        end = min(cursor + count, len(self._user_ids))
+        sessions = list(zip(self._user_ids[cursor:end], self._guild_ids[cursor:end]))
+
+        return sessions, end if end < len(self._user_ids) else 0
+
+
+    def guild_ids(self) -> List[int]:
+        """Every guild with at least one session"""
+        return list(self._guild_slots)
+
+
+    def guild_count(self, guild_id: int) -> int:
+        return len(self._guild_slots.get(guild_id, ()))
+
+
+    def _remove_slot(self, slot: int) -> None:
+        """Frees the slot by moving the last session into it. The slot must already be out of _slots"""
+        guild_id = self._guild_ids[slot]
+        guild_slot_index = self._guild_slot_index
+
+        # Out of the guild's slots the same way, by moving the guild's last slot into its place
+        guild_slots = self._guild_slots[guild_id]
+        last_guild_slot = guild_slots[-1]
+        guild_slots[guild_slot_index[slot]] = last_guild_slot
+        guild_slot_index[last_guild_slot] = guild_slot_index[slot]
+        guild_slots.pop()
+        if not guild_slots:
+            del self._guild_slots[guild_id]
+
+        last_slot = len(self._user_ids) - 1
+        if slot != last_slot:
+            moved_user_id = self._user_ids[last_slot]
+            moved_guild_id = self._guild_ids[last_slot]
+
+            self._user_ids[slot] = moved_user_id
+            self._guild_ids[slot] = moved_guild_id
+            self._joined_times[slot] = self._joined_times[last_slot]
+            self._channel_ids[slot] = self._channel_ids[last_slot]
+            guild_slot_index[slot] = guild_slot_index[last_slot]
+
+            self._slots[make_session_key(moved_user_id, moved_guild_id)] = slot
+            self._guild_slots[moved_guild_id][guild_slot_index[slot]] = slot
+
+        self._user_ids.pop()
+        self._guild_ids.pop()
+        self._joined_times.pop()
+        self._channel_ids.pop()
+        guild_slot_index.pop()
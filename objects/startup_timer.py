@@ -0,0 +1,71 @@
+import time
+
+from typing import Iterable, Optional, Set
+
+
+class StartupTimer:
+    """
+    Times how long it takes after startup until every guild of every shard has had its
+    voice states ingested into the tracking queue.
+    """
+
+    def __init__(self):
+        self._started_at: float = time.monotonic()
+        self._first_guild_at: Optional[float] = None
+        self._finished_at: Optional[float] = None
+
+        self._shards_ready: Set[int] = set()
+        self._pending_guilds: Set[int] = set()
+
+        self.guilds_ingested: int = 0
+        self.sessions_ingested: int = 0
+        self.ingest_seconds: float = 0.0
+
+
+    def shard_ready(self, shard_id: int, guild_ids: Iterable[int]) -> None:
+        self._shards_ready.add(shard_id)
+        self._pending_guilds.update(guild_ids)
+
+
+    def guild_ingested(self, guild_id: int, sessions: int, elapsed_seconds: float) -> None:
+        if self._first_guild_at is None:
+            self._first_guild_at = time.monotonic()
+
+        self._pending_guilds.discard(guild_id)
+        self.guilds_ingested += 1
+        self.sessions_ingested += sessions
+        self.ingest_seconds += elapsed_seconds
+
+
+    def is_finished(self) -> bool:
+        return self._finished_at is not None
+
+
+    def check_finished(self, shard_count: int) -> bool:
+        """Returns True exactly once, when the last guild of the last shard got ingested"""
+        if self._finished_at is not None:
+            return False
+
+        if len(self._shards_ready) < shard_count or self._pending_guilds:
+            return False
+
+        self._finished_at = time.monotonic()
+        return True
+
+
+    def build_report(self) -> str:
+        finished_at = self._finished_at if self._finished_at is not None else time.monotonic()
+        total_seconds = finished_at - self._started_at
+        ingest_window = finished_at - (self._first_guild_at or finished_at)
+
+        guilds_per_second = self.guilds_ingested / ingest_window if ingest_window > 0 else 0.0
+        sessions_per_second = self.sessions_ingested / ingest_window if ingest_window > 0 else 0.0
+
+        return (
+            "**Startup**\n```\n"
+            f"All shards tracked after: {total_seconds:.2f}s\n"
+            f"Guilds ingested: {self.guilds_ingested} ({guilds_per_second:.1f}/s)\n"
+            f"Sessions ingested: {self.sessions_ingested} ({sessions_per_second:.1f}/s)\n"
+            f"Time spent ingesting: {self.ingest_seconds * 1000:.1f}ms\n"
+            "```"
+        )
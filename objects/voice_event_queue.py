@@ -0,0 +1,170 @@
+import asyncio
+import time
+
+from typing import Awaitable, Callable, Generic, List, Optional, TypeVar
+from metrics import registry
+from perf_logging import record_timing
+
+Event = TypeVar("Event")
+
+
+class VoiceEventQueue(Generic[Event]):
+    """
+    Takes voice events off the gateway listener and hands them to a fixed pool of workers, so a slow
+    database only holds up the queue and not event dispatch.
+    Every member always lands on the same worker, which keeps their events in the order they came in.
+    Each worker has its own bounded queue. When one is full, new events for it wait for room instead
+    of being dropped, and are counted as overflowed.
+    """
+
+    def __init__(self, handler: Callable[[Event], Awaitable[None]], workers: int = 8, max_size: int = 10000):
+        self._handler = handler
+        self._max_size_per_worker: int = max(1, max_size // workers)
+
+        # (event, when it was queued)
+        self._queues: List[asyncio.Queue[tuple[Event, float]]] = []
+        self._worker_count: int = workers
+
+        # Only one event per worker waits for room at a time, so the ones behind it can't jump ahead
+        self._put_locks: List[asyncio.Lock] = []
+
+        self._tasks: List[asyncio.Task[None]] = []
+
+        # Set while draining. New events are handled right away then, instead of going on a queue
+        self._draining: bool = False
+
+        # Queue reporting
+        self.total_queued: int = 0
+        self.total_handled: int = 0
+        self.total_failed: int = 0
+        self.total_overflowed: int = 0
+        self.total_backpressure_ms: float = 0.0
+        self.last_lag_ms: float = 0.0
+        self.max_lag_ms: float = 0.0
+
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+
+        # Created here rather than in __init__ so they belong to the running event loop
+        self._queues = [asyncio.Queue(self._max_size_per_worker) for _ in range(self._worker_count)]
+        self._put_locks = [asyncio.Lock() for _ in range(self._worker_count)]
+        self._tasks = [asyncio.create_task(self._run(queue)) for queue in self._queues]
+
+
+    async def put(self, user_id: int, event: Event) -> None:
+        """
+        Queues the event on the member's worker. While draining, once the workers are stopped, or if they were
+        never started, the event is handled right away instead.
+        """
+        if not self._tasks:
+            await self._handle(event, time.perf_counter())
+            return
+
+        index = user_id % len(self._queues)
+        queue = self._queues[index]
+        put_lock = self._put_locks[index]
+
+        if self._draining:
+            # After whatever of the member's is still queued, so their events stay in order
+            await queue.join()
+            await self._handle(event, time.perf_counter())
+            return
+
+        self.total_queued += 1
+
+        if not put_lock.locked() and not queue.full():
+            queue.put_nowait((event, time.perf_counter()))
+            return
+
+        # Full, or someone is already waiting for room
+        self.total_overflowed += 1
+
+        start = time.perf_counter()
+        async with put_lock:
+            await queue.put((event, start))
+        end = time.perf_counter()
+
+        wait_ms = (end - start) * 1000
+        self.total_backpressure_ms += wait_ms
+        record_timing("voice_event_queue_backpressure", wait_ms)
+
+
+    async def drain(self) -> None:
+        """
+        Handles everything that's still queued and stops the workers. Events that come in from here on are
+        handled right away, once the member's queued ones are done. Only then are the workers stopped, so
+        nothing that made it onto a queue gets dropped.
+        """
+        self._draining = True
+
+        for put_lock in self._put_locks:
+            # Lets anything that was already waiting for room get in first
+            async with put_lock:
+                pass
+
+        await asyncio.gather(*(queue.join() for queue in self._queues))
+
+        for task in self._tasks:
+            task.cancel()
+
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._draining = False
+
+
+    def depth(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+
+    def worker_depths(self) -> List[int]:
+        return [queue.qsize() for queue in self._queues]
+
+
+    def oldest_lag_ms(self) -> float:
+        """How long the oldest event still in any of the queues has been waiting"""
+        now = time.perf_counter()
+        oldest: Optional[float] = None
+
+        for queue in self._queues:
+            # asyncio.Queue keeps its items in a deque, the oldest is at the front
+            if queue.qsize():
+                queued_at = queue._queue[0][1] # type: ignore
+                oldest = queued_at if oldest is None else min(oldest, queued_at)
+
+        return (now - oldest) * 1000 if oldest is not None else 0.0
+
+
+    def register_metrics(self) -> None:
+        registry.gauge_callback("vcstats_voice_event_queue_depth", "Voice events waiting for a worker", lambda: {(str(i),): depth for i, depth in enumerate(self.worker_depths())}, ("worker",))
+        registry.gauge_callback("vcstats_voice_event_queue_lag_seconds", "How long the oldest queued voice event has been waiting", lambda: self.oldest_lag_ms() / 1000)
+        registry.counter_callback("vcstats_voice_events_queued_total", "Voice events put on the queue", lambda: self.total_queued)
+        registry.counter_callback("vcstats_voice_events_handled_total", "Voice events the workers finished", lambda: self.total_handled)
+        registry.counter_callback("vcstats_voice_events_failed_total", "Voice events that raised an error", lambda: self.total_failed)
+        registry.counter_callback("vcstats_voice_events_overflowed_total", "Voice events that had to wait for room in a full queue", lambda: self.total_overflowed)
+        registry.counter_callback("vcstats_voice_event_backpressure_seconds_total", "Time spent waiting for room in a full queue", lambda: self.total_backpressure_ms / 1000)
+
+
+    async def _run(self, queue: "asyncio.Queue[tuple[Event, float]]") -> None:
+        while True:
+            event, queued_at = await queue.get()
+            try:
+                await self._handle(event, queued_at)
+            finally:
+                queue.task_done()
+
+
+    async def _handle(self, event: Event, queued_at: float) -> None:
+        lag_ms = (time.perf_counter() - queued_at) * 1000
+        self.last_lag_ms = lag_ms
+        self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+        record_timing("voice_event_queue_lag", lag_ms)
+
+        try:
+            await self._handler(event)
+            self.total_handled += 1
+        except Exception as error:
+            # One bad event shouldn't take the worker down with it
+            self.total_failed += 1
+            print(f"Error handling voice event: {error}")
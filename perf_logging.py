@@ -0,0 +1,100 @@
+import random
+
+from typing import Dict, List
+from metrics import operation_latency
+
+# How many samples each histogram keeps between digests. Past this point the
+# samples are reservoir sampled so percentiles stay representative
+MAX_SAMPLES = 4096
+
+# Discord's limit on the length of a message
+MAX_DIGEST_LENGTH = 2000
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.count: int = 0
+        self.max_ms: float = 0.0
+        self._samples: List[float] = []
+
+    def record(self, elapsed_ms: float) -> None:
+        self.count += 1
+        self.max_ms = max(self.max_ms, elapsed_ms)
+
+        if len(self._samples) < MAX_SAMPLES:
+            self._samples.append(elapsed_ms)
+        else:
+            index = random.randrange(self.count)
+            if index < MAX_SAMPLES:
+                self._samples[index] = elapsed_ms
+
+    def percentile(self, percent: float) -> float:
+        if not self._samples:
+            return 0.0
+
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(len(ordered) * percent / 100))
+        return ordered[index]
+
+
+histograms: Dict[str, LatencyHistogram] = {}
+
+
+def record_timing(operation: str, elapsed_ms: float) -> None:
+    """
+    Records how long an operation took, both for the digest and for the metrics endpoint.
+    Never touches the network, so it's safe to call on hot paths
+    """
+    operation_latency.observe(elapsed_ms, operation)
+
+    histogram = histograms.get(operation)
+    if histogram is None:
+        histogram = LatencyHistogram()
+        histograms[operation] = histogram
+
+    histogram.record(elapsed_ms)
+
+
+def build_performance_digest(interval_seconds: int, heading: str = "") -> List[str]:
+    """
+    Builds compact messages out of everything recorded since the last digest and starts a new interval.
+    Usually that's one message, but it's split between rows into as many as it takes to stay under Discord's
+    limit, each a code block of its own with the column names. Returns no messages if nothing was recorded.
+    """
+    global histograms
+
+    current = histograms
+    histograms = {}
+
+    if not current:
+        return []
+
+    title = f"{heading}**Performance (last {interval_seconds}s, ms)**"
+    columns = f"{'operation':<36}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}"
+
+    def to_message(rows: List[str]) -> str:
+        table = "\n".join([columns] + rows)
+        return f"{title}\n```\n{table}\n```"
+
+    messages: List[str] = []
+    rows: List[str] = []
+    length: int = len(to_message([]))
+
+    for operation in sorted(current):
+        histogram = current[operation]
+        row = (
+            f"{operation:<36}{histogram.count:>8}"
+            f"{histogram.percentile(50):>10.2f}{histogram.percentile(95):>10.2f}"
+            f"{histogram.percentile(99):>10.2f}{histogram.max_ms:>10.2f}"
+        )
+
+        if rows and length + 1 + len(row) > MAX_DIGEST_LENGTH:
+            messages.append(to_message(rows))
+            rows = []
+            length = len(to_message([]))
+
+        rows.append(row)
+        length += 1 + len(row)
+
+    messages.append(to_message(rows))
+    return messages
@@ -0,0 +1,232 @@
+import time
+
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Any, Callable, Dict, List, Optional, Sequence
+from write_buffer import ChannelIncrement, Increment
+
+# How many days each /leaderboard period covers, counting today
+PERIOD_DAYS: Dict[str, int] = {"day": 1, "week": 7, "month": 30}
+
+# Time is also added to a bucket per guild per day, kept a little longer than the longest period
+BUCKET_RETENTION_DAYS = max(PERIOD_DAYS.values()) + 1
+
+# How long a rolled up period leaderboard is kept after it's built from the buckets. Increments are added to it
+# while it's there, so it never falls behind them
+ROLLUP_MAX_AGE_SECONDS = 60
+
+# (user_id, time) -> what a leaderboard is sorted by, ascending. See StorageBackend.rank_key()
+RankKey = Callable[[int, int], Any]
+
+
+def day_number(timestamp: Optional[float] = None) -> int:
+    """Days since the epoch (UTC), which is what the daily buckets are numbered by"""
+    return int(time.time() if timestamp is None else timestamp) // 86400
+
+
+def period_start(days: int) -> int:
+    """The timestamp the last `days` days, counting today, start at"""
+    return (day_number() - days + 1) * 86400
+
+
+def period_day_numbers(days: int) -> List[int]:
+    """The day numbers of the last `days` days, counting today, oldest first"""
+    today = day_number()
+    return list(range(today - days + 1, today + 1))
+
+
+class LeaderboardWindow:
+    """
+    Part of a leaderboard: `entries` are the (user_id, time) at positions start..start + count - 1.
+    Also has how many members the whole leaderboard has, the time of all of them together, and
+    the time of each member that was asked for (None for members without time).
+    """
+
+    def __init__(self, entries: List[tuple[int, int]], member_count: int, total_time: int, times: Optional[List[Optional[int]]] = None):
+        self.entries = entries
+        self.member_count = member_count
+        self.total_time = total_time
+        self.times: List[Optional[int]] = times if times is not None else []
+
+
+def merge_window(window: LeaderboardWindow, window_start: int, window_count: int, start: int, count: int, unsaved_times: Dict[int, int], rank_key: RankKey) -> List[tuple[int, int]]:
+    """
+    Adds the unsaved time to a window read from window_start and returns the (user_id, time) at positions
+    start..start + count - 1 afterwards. Everyone's time only goes up, so someone without unsaved time is
+    only ever pushed down, by at most one position per member with unsaved time.
+    Positions are counted with rank_key, which has to order the members the same way the window was read,
+    ties included. Otherwise tied members can end up on two pages, or on none.
+    """
+    saved_times: Dict[int, Optional[int]] = dict(zip(unsaved_times, window.times))
+    merged_times: Dict[int, int] = {user_id: (saved_times[user_id] or 0) + unsaved_time for user_id, unsaved_time in unsaved_times.items()}
+
+    # Sorted, so how many of them are ahead of a key is a binary search
+    window_keys: List[Any] = [rank_key(user_id, saved_time) for user_id, saved_time in window.entries]
+    unsaved_saved_keys: List[Any] = sorted(rank_key(user_id, saved_time) for user_id, saved_time in saved_times.items() if saved_time is not None)
+    unsaved_merged_keys: List[Any] = sorted(rank_key(user_id, merged_time) for user_id, merged_time in merged_times.items())
+
+    # (position, user_id, time) of everyone who could end up in the page
+    positioned: List[tuple[int, int, int]] = []
+
+    for i, (user_id, saved_time) in enumerate(window.entries):
+        if user_id in unsaved_times:
+            continue
+
+        # Moves down past everyone who overtook them, the ones that were already ahead stay ahead
+        key = window_keys[i]
+        position = window_start + i - bisect_left(unsaved_saved_keys, key) + bisect_left(unsaved_merged_keys, key)
+        positioned.append((position, user_id, saved_time))
+
+    window_is_full: bool = len(window.entries) == window_count
+    for user_id, merged_time in merged_times.items():
+        key = rank_key(user_id, merged_time)
+
+        if window_keys and key < window_keys[0] and window_start > 0:
+            # Ahead of the window, so ahead of the page too
+            continue
+
+        if window_keys and key > window_keys[-1] and window_is_full:
+            # Behind the window, so behind the page too
+            continue
+
+        # Everyone in the database ahead of them is either before the window or in it
+        saved_ahead: int = window_start + bisect_left(window_keys, key)
+        others_saved_ahead: int = saved_ahead - bisect_left(unsaved_saved_keys, key)
+        position = others_saved_ahead + bisect_left(unsaved_merged_keys, key)
+        positioned.append((position, user_id, merged_time))
+
+    positioned.sort()
+    return [(user_id, user_time) for position, user_id, user_time in positioned if start <= position < start + count]
+
+
+class StorageBackend(ABC):
+    """
+    Where everyone's time gets stored. Each guild is a leaderboard of user_id -> seconds, and every
+    increment also goes into that day's bucket so leaderboards of the last PERIOD_DAYS can be served.
+    Each guild also keeps a total per voice channel, channel_id -> seconds, and the total time of all its
+    members, which is kept up to date with every increment rather than added up when it's read.
+
+    Reads that take `days` count only the time added in the last `days` days (from PERIOD_DAYS), and all-time otherwise.
+    Methods raise if the storage can't be reached; the datastore decides what to do about it.
+    """
+
+    async def connect(self) -> None:
+        pass
+
+
+    async def close(self) -> None:
+        pass
+
+
+    def partition(self, increments: List[Increment]) -> Dict[str, List[Increment]]:
+        """
+        Splits increments up by where they get written (e.g. a node), keeping their order within each part.
+        Parts can be written at the same time.
+        """
+        return {"default": increments} if increments else {}
+
+
+    def max_concurrency(self) -> int:
+        """How many batches can be written to one part at the same time"""
+        return 1
+
+
+    def write_not_sent(self, error: Exception) -> bool:
+        """
+        Whether an error raised by increment() means none of it was written, so it's safe to send again.
+        If not, some of it may have been written, and sending it again could count that twice.
+        """
+        # Raised before anything is sent
+        return isinstance(error, ConnectionError)
+
+
+    @staticmethod
+    def rank_key(user_id: int, user_time: int) -> Any:
+        """
+        What get_window() orders members by, ascending: most time first, and members with the same time
+        by user ID
+        """
+        return (-user_time, user_id)
+
+
+    @abstractmethod
+    async def increment(self, increments: List[Increment], channel_increments: Sequence[ChannelIncrement] = ()) -> None:
+        """
+        Adds the time of each (guild_id, user_id, time_difference).
+        The (guild_id, channel_id, time_difference) of channel_increments are written along with them.
+        """
+
+
+    @abstractmethod
+    async def get_time_and_position(self, guild_id: int, user_id: int, days: Optional[int] = None) -> tuple[Optional[int], Optional[int]]:
+        """The member's time and 1-based leaderboard position, or (None, None) if they have no time"""
+
+
+    @abstractmethod
+    async def get_times(self, guild_id: int, user_ids: Sequence[int], days: Optional[int] = None) -> List[Optional[int]]:
+        """The time of each member, None for members without time"""
+
+
+    @abstractmethod
+    async def count_above(self, guild_id: int, user_time: int, days: Optional[int] = None) -> int:
+        """How many members have more time than user_time"""
+
+
+    @abstractmethod
+    async def get_window(self, guild_id: int, start: int, count: int, user_ids: Sequence[int] = (), days: Optional[int] = None) -> LeaderboardWindow:
+        """
+        The `count` members from 0-based position `start` on, most time first, without reading anyone before them.
+        Also returns the time of each member in user_ids, so the window can be merged with unsaved time in one go.
+        """
+
+
+    @abstractmethod
+    async def get_channel_top(self, guild_id: int, count: int) -> List[tuple[int, int]]:
+        """The top `count` (channel_id, time) of the guild, most time first"""
+
+
+    @abstractmethod
+    async def save_snapshot(self, name: str, data: bytes, ttl_seconds: int) -> None:
+        """Stores a blob under `name` in one write, replacing any older one. It's gone after ttl_seconds"""
+
+
+    @abstractmethod
+    async def take_snapshot(self, name: str) -> Optional[bytes]:
+        """Reads and deletes the blob stored under `name`, None if there isn't one or it expired"""
+
+
+    @abstractmethod
+    async def delete_guild(self, guild_id: int) -> None:
+        pass
+
+
+    @abstractmethod
+    async def delete_member(self, guild_id: int, user_id: int) -> None:
+        pass
+
+
+def create_backend() -> StorageBackend:
+    """
+    The backend picked by config.STORAGE_BACKEND: "valkey" (default), "sqlite" or "memory".
+    Only the chosen backend's client library gets imported.
+    """
+    import config
+
+    name: str = getattr(config, "STORAGE_BACKEND", "valkey")
+
+    if name == "valkey":
+        from storage.valkey_backend import ValkeyBackend
+
+        # A list of (host, port) to partition the guilds across. Falls back to the single node
+        addresses: List[tuple[str, int]] = getattr(config, "VALKEY_NODES", None) or [(config.VALKEY_HOST, config.VALKEY_PORT)]
+        return ValkeyBackend(addresses, max_connections=20)
+
+    if name == "sqlite":
+        from storage.sqlite_backend import SqliteBackend
+        return SqliteBackend(getattr(config, "SQLITE_PATH", "vcstats.sqlite3"))
+
+    if name == "memory":
+        from storage.memory_backend import MemoryBackend
+        return MemoryBackend()
+
+    raise ValueError(f"Unknown STORAGE_BACKEND: {name}")
@@ -0,0 +1,198 @@
+import time
+
+from bisect import bisect_left, insort
+from typing import Dict, List, Optional, Sequence
+from storage.backend import BUCKET_RETENTION_DAYS, PERIOD_DAYS, ROLLUP_MAX_AGE_SECONDS, LeaderboardWindow, StorageBackend, day_number
+from write_buffer import ChannelIncrement, Increment
+
+
+class GuildLeaderboard:
+    """
+    A guild's times, plus the same entries kept sorted as (-time, user_id) so the rank of a member
+    is a binary search and any page is a slice
+    """
+
+    def __init__(self):
+        self.times: Dict[int, int] = {}
+        self.ranked: List[tuple[int, int]] = []
+        self.total: int = 0
+
+
+    def increment(self, user_id: int, time_difference: int) -> int:
+        old_time: Optional[int] = self.times.get(user_id)
+        if old_time is not None:
+            self._unrank(user_id, old_time)
+
+        new_time = (old_time or 0) + time_difference
+        self.times[user_id] = new_time
+        insort(self.ranked, (-new_time, user_id))
+        self.total += time_difference
+
+        return new_time
+
+
+    def remove(self, user_id: int) -> None:
+        old_time: Optional[int] = self.times.pop(user_id, None)
+        if old_time is not None:
+            self._unrank(user_id, old_time)
+            self.total -= old_time
+
+
+    def position(self, user_id: int) -> Optional[int]:
+        user_time: Optional[int] = self.times.get(user_id)
+        if user_time is None:
+            return None
+
+        return bisect_left(self.ranked, (-user_time, user_id)) + 1
+
+
+    def count_above(self, user_time: int) -> int:
+        # User IDs are never negative, so this lands before everyone with exactly user_time
+        return bisect_left(self.ranked, (-user_time, -1))
+
+
+    def _unrank(self, user_id: int, user_time: int) -> None:
+        del self.ranked[bisect_left(self.ranked, (-user_time, user_id))]
+
+
+class MemoryBackend(StorageBackend):
+    """Keeps everything in the process. Nothing survives a restart, so it's only meant for tests and benchmarks"""
+
+    def __init__(self):
+        self._guilds: Dict[int, GuildLeaderboard] = {}
+
+        # guild_id -> day -> user_id -> time added that day
+        self._buckets: Dict[int, Dict[int, Dict[int, int]]] = {}
+
+        # (guild_id, days) -> (the day it's up to, built at, the period rolled up into one leaderboard)
+        self._rollups: Dict[tuple[int, int], tuple[int, float, GuildLeaderboard]] = {}
+
+        # guild_id -> channel_id -> time
+        self._channels: Dict[int, Dict[int, int]] = {}
+
+        # name -> (expires at, blob)
+        self._snapshots: Dict[str, tuple[float, bytes]] = {}
+
+
+    def _guild(self, guild_id: int) -> GuildLeaderboard:
+        leaderboard: Optional[GuildLeaderboard] = self._guilds.get(guild_id)
+        if leaderboard is None:
+            leaderboard = self._guilds[guild_id] = GuildLeaderboard()
+
+        return leaderboard
+
+
+    async def increment(self, increments: List[Increment], channel_increments: Sequence[ChannelIncrement] = ()) -> None:
+        today = day_number()
+
+        for guild_id, user_id, time_difference in increments:
+            self._guild(guild_id).increment(user_id, time_difference)
+
+            bucket = self._buckets.setdefault(guild_id, {}).setdefault(today, {})
+            bucket[user_id] = bucket.get(user_id, 0) + time_difference
+
+            # Kept up to date rather than waiting to be built again
+            for days in PERIOD_DAYS.values():
+                entry = self._rollups.get((guild_id, days))
+                if entry is not None and entry[0] == today:
+                    entry[2].increment(user_id, time_difference)
+
+        for guild_id, channel_id, time_difference in channel_increments:
+            channels = self._channels.setdefault(guild_id, {})
+            channels[channel_id] = channels.get(channel_id, 0) + time_difference
+
+
+    def _rollup(self, guild_id: int, days: int) -> GuildLeaderboard:
+        today = day_number()
+
+        entry = self._rollups.get((guild_id, days))
+        if entry is not None and entry[0] == today and time.monotonic() - entry[1] <= ROLLUP_MAX_AGE_SECONDS:
+            return entry[2]
+        guild_buckets = self._buckets.get(guild_id, {})
+
+        # Buckets past the retention would have expired by now
+        for day in [day for day in guild_buckets if day <= today - BUCKET_RETENTION_DAYS]:
+            del guild_buckets[day]
+
+        rollup = GuildLeaderboard()
+        for day in range(today - days + 1, today + 1):
+            for user_id, time_difference in guild_buckets.get(day, {}).items():
+                rollup.times[user_id] = rollup.times.get(user_id, 0) + time_difference
+
+        rollup.ranked = sorted((-user_time, user_id) for user_id, user_time in rollup.times.items())
+        rollup.total = sum(rollup.times.values())
+
+        self._rollups[(guild_id, days)] = (today, time.monotonic(), rollup)
+        return rollup
+
+
+    def _leaderboard(self, guild_id: int, days: Optional[int]) -> Optional[GuildLeaderboard]:
+        return self._guilds.get(guild_id) if days is None else self._rollup(guild_id, days)
+
+
+    async def get_time_and_position(self, guild_id: int, user_id: int, days: Optional[int] = None) -> tuple[Optional[int], Optional[int]]:
+        leaderboard: Optional[GuildLeaderboard] = self._leaderboard(guild_id, days)
+        if leaderboard is None:
+            return (None, None)
+
+        return (leaderboard.times.get(user_id), leaderboard.position(user_id))
+
+
+    async def get_times(self, guild_id: int, user_ids: Sequence[int], days: Optional[int] = None) -> List[Optional[int]]:
+        leaderboard: Optional[GuildLeaderboard] = self._leaderboard(guild_id, days)
+        times: Dict[int, int] = leaderboard.times if leaderboard is not None else {}
+        return [times.get(user_id) for user_id in user_ids]
+
+
+    async def count_above(self, guild_id: int, user_time: int, days: Optional[int] = None) -> int:
+        leaderboard: Optional[GuildLeaderboard] = self._leaderboard(guild_id, days)
+        return leaderboard.count_above(user_time) if leaderboard is not None else 0
+
+
+    async def get_window(self, guild_id: int, start: int, count: int, user_ids: Sequence[int] = (), days: Optional[int] = None) -> LeaderboardWindow:
+        leaderboard: Optional[GuildLeaderboard] = self._leaderboard(guild_id, days)
+        if leaderboard is None:
+            return LeaderboardWindow([], 0, 0, [None] * len(user_ids))
+
+        return LeaderboardWindow(
+            [(user_id, -negative_time) for negative_time, user_id in leaderboard.ranked[start:start + count]],
+            len(leaderboard.times),
+            leaderboard.total,
+            [leaderboard.times.get(user_id) for user_id in user_ids]
+        )
+
+
+    async def get_channel_top(self, guild_id: int, count: int) -> List[tuple[int, int]]:
+        channels: Dict[int, int] = self._channels.get(guild_id, {})
+        return sorted(channels.items(), key=lambda item: item[1], reverse=True)[:count]
+
+
+    async def save_snapshot(self, name: str, data: bytes, ttl_seconds: int) -> None:
+        self._snapshots[name] = (time.monotonic() + ttl_seconds, data)
+
+
+    async def take_snapshot(self, name: str) -> Optional[bytes]:
+        snapshot = self._snapshots.pop(name, None)
+        if snapshot is None or time.monotonic() > snapshot[0]:
+            return None
+
+        return snapshot[1]
+
+
+    async def delete_guild(self, guild_id: int) -> None:
+        self._guilds.pop(guild_id, None)
+        self._channels.pop(guild_id, None)
+        self._buckets.pop(guild_id, None)
+        self._rollups = {key: rollup for key, rollup in self._rollups.items() if key[0] != guild_id}
+
+
+    async def delete_member(self, guild_id: int, user_id: int) -> None:
+        leaderboard: Optional[GuildLeaderboard] = self._guilds.get(guild_id)
+        if leaderboard is not None:
+            leaderboard.remove(user_id)
+
+        for bucket in self._buckets.get(guild_id, {}).values():
+            bucket.pop(user_id, None)
+
+        # Built again from the buckets on the next read
+        self._rollups = {key: rollup for key, rollup in self._rollups.items() if key[0] != guild_id}
@@ -0,0 +1,326 @@
+import asyncio
+import time
+import aiosqlite
+
+from typing import List, Optional, Sequence
+from storage.backend import BUCKET_RETENTION_DAYS, LeaderboardWindow, StorageBackend, day_number
+from write_buffer import ChannelIncrement, Increment
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS times (
+    guild_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, user_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS times_by_guild_and_time ON times (guild_id, time DESC);
+
+CREATE TABLE IF NOT EXISTS daily_times (
+    guild_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, day, user_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS guild_totals (
+    guild_id INTEGER PRIMARY KEY,
+    time INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS channel_times (
+    guild_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, channel_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS snapshots (
+    name TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    expires_at INTEGER NOT NULL
+);
+"""
+
+INCREMENT_QUERY = """
+INSERT INTO times (guild_id, user_id, time) VALUES (?, ?, ?)
+ON CONFLICT (guild_id, user_id) DO UPDATE SET time = time + excluded.time
+"""
+
+DAILY_INCREMENT_QUERY = """
+INSERT INTO daily_times (guild_id, day, user_id, time) VALUES (?, ?, ?, ?)
+ON CONFLICT (guild_id, day, user_id) DO UPDATE SET time = time + excluded.time
+"""
+
+GUILD_TOTAL_INCREMENT_QUERY = """
+INSERT INTO guild_totals (guild_id, time) VALUES (?, ?)
+ON CONFLICT (guild_id) DO UPDATE SET time = time + excluded.time
+"""
+
+# Changes to databases made by older versions, in order. Each runs once, and PRAGMA user_version keeps
+# track of how many have
+MIGRATIONS: List[str] = [
+    # The totals of guilds written before they were kept
+    "INSERT OR IGNORE INTO guild_totals (guild_id, time) SELECT guild_id, SUM(time) FROM times GROUP BY guild_id",
+]
+
+CHANNEL_INCREMENT_QUERY = """
+INSERT INTO channel_times (guild_id, channel_id, time) VALUES (?, ?, ?)
+ON CONFLICT (guild_id, channel_id) DO UPDATE SET time = time + excluded.time
+"""
+
+# Sums the buckets of the period on every read. The rendered pages are cached by the datastore already
+PERIOD_WINDOW_QUERY = """
+SELECT user_id, SUM(time) AS period_time FROM daily_times
+WHERE guild_id = ? AND day > ?
+GROUP BY user_id ORDER BY period_time DESC, user_id LIMIT ? OFFSET ?
+"""
+
+PERIOD_COUNT_AND_TOTAL_QUERY = "SELECT COUNT(DISTINCT user_id), COALESCE(SUM(time), 0) FROM daily_times WHERE guild_id = ? AND day > ?"
+
+PERIOD_TIME_QUERY = "SELECT SUM(time) FROM daily_times WHERE guild_id = ? AND day > ? AND user_id = ?"
+
+# How many members have more time in the period than the given time
+PERIOD_COUNT_ABOVE_QUERY = """
+SELECT COUNT(*) FROM (
+    SELECT SUM(time) AS period_time FROM daily_times WHERE guild_id = ? AND day > ? GROUP BY user_id
+) WHERE period_time > ?
+"""
+
+# The member's time and how many members of the guild have more
+TIME_AND_AHEAD_QUERY = """
+SELECT time, (SELECT COUNT(*) FROM times AS other WHERE other.guild_id = times.guild_id AND other.time > times.time)
+FROM times WHERE guild_id = ? AND user_id = ?
+"""
+
+
+class SqliteBackend(StorageBackend):
+    """
+    Stores everything in one SQLite file. Meant for small deployments that run on a single machine,
+    where running a Valkey server isn't worth it.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._connection: Optional[aiosqlite.Connection] = None
+        # Reads get their own connection, so they never see a write transaction that's halfway done
+        self._read_connection: Optional[aiosqlite.Connection] = None
+
+        # Only one write transaction at a time on the shared connection
+        self._write_lock = asyncio.Lock()
+
+        # Buckets past the retention get deleted once a day
+        self._pruned_day: int = 0
+
+
+    async def connect(self) -> None:
+        self._connection = await aiosqlite.connect(self._path)
+
+        # WAL lets reads carry on while a batch is being written
+        await self._connection.execute("PRAGMA journal_mode = WAL")
+        await self._connection.execute("PRAGMA synchronous = NORMAL")
+        await self._connection.executescript(SCHEMA)
+        await self.migrate()
+
+        self._read_connection = await aiosqlite.connect(self._path)
+        await self._read_connection.execute("PRAGMA query_only = ON")
+
+
+    async def migrate(self) -> None:
+        """Runs the migrations the database hasn't had yet, each in one transaction with its version bump"""
+        connection = self.connection()
+
+        async with connection.execute("PRAGMA user_version") as cursor:
+            version, = await cursor.fetchone() # type: ignore
+
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            await connection.execute(migration)
+            await connection.execute(f"PRAGMA user_version = {number}")
+            await connection.commit()
+
+
+    async def close(self) -> None:
+        if self._read_connection is not None:
+            await self._read_connection.close()
+            self._read_connection = None
+
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+
+    def connection(self) -> aiosqlite.Connection:
+        """The connection that writes go through, one transaction at a time under _write_lock"""
+        if self._connection is None:
+            raise ConnectionError("SQLite is not connected")
+
+        return self._connection
+
+
+    def read_connection(self) -> aiosqlite.Connection:
+        if self._read_connection is None:
+            raise ConnectionError("SQLite is not connected")
+
+        return self._read_connection
+
+
+    async def increment(self, increments: List[Increment], channel_increments: Sequence[ChannelIncrement] = ()) -> None:
+        connection = self.connection()
+
+        today = day_number()
+
+        async with self._write_lock:
+            try:
+                await connection.executemany(INCREMENT_QUERY, increments)
+                await connection.executemany(GUILD_TOTAL_INCREMENT_QUERY, [
+                    (guild_id, time_difference) for guild_id, _, time_difference in increments
+                ])
+                await connection.executemany(DAILY_INCREMENT_QUERY, [
+                    (guild_id, today, user_id, time_difference) for guild_id, user_id, time_difference in increments
+                ])
+                if channel_increments:
+                    await connection.executemany(CHANNEL_INCREMENT_QUERY, channel_increments)
+
+                if self._pruned_day != today:
+                    await connection.execute("DELETE FROM daily_times WHERE day <= ?", (today - BUCKET_RETENTION_DAYS,))
+                    self._pruned_day = today
+
+                await connection.commit()
+            except Exception:
+                await connection.rollback()
+                raise
+
+
+    def write_not_sent(self, error: Exception) -> bool:
+        # increment() rolls back on any database error. A timeout can cancel it halfway, and the commit may still go through
+        return isinstance(error, aiosqlite.Error) or super().write_not_sent(error)
+
+
+    async def get_time_and_position(self, guild_id: int, user_id: int, days: Optional[int] = None) -> tuple[Optional[int], Optional[int]]:
+        if days is not None:
+            async with self.read_connection().execute(PERIOD_TIME_QUERY, (guild_id, day_number() - days, user_id)) as cursor:
+                row = await cursor.fetchone()
+
+            if row is None or row[0] is None:
+                return (None, None)
+
+            return (row[0], await self.count_above(guild_id, row[0], days) + 1)
+
+        async with self.read_connection().execute(TIME_AND_AHEAD_QUERY, (guild_id, user_id)) as cursor:
+            row = await cursor.fetchone()
+
+        if row is None:
+            return (None, None)
+
+        return (row[0], row[1] + 1)
+
+
+    async def get_times(self, guild_id: int, user_ids: Sequence[int], days: Optional[int] = None) -> List[Optional[int]]:
+        if not user_ids:
+            return []
+
+        placeholders = ", ".join("?" * len(user_ids))
+        if days is None:
+            query = f"SELECT user_id, time FROM times WHERE guild_id = ? AND user_id IN ({placeholders})"
+            parameters = (guild_id, *user_ids)
+        else:
+            query = f"SELECT user_id, SUM(time) FROM daily_times WHERE guild_id = ? AND day > ? AND user_id IN ({placeholders}) GROUP BY user_id"
+            parameters = (guild_id, day_number() - days, *user_ids)
+
+        async with self.read_connection().execute(query, parameters) as cursor:
+            times = {user_id: user_time for user_id, user_time in await cursor.fetchall()}
+
+        return [times.get(user_id) for user_id in user_ids]
+
+
+    async def count_above(self, guild_id: int, user_time: int, days: Optional[int] = None) -> int:
+        if days is None:
+            query = "SELECT COUNT(*) FROM times WHERE guild_id = ? AND time > ?"
+            parameters = (guild_id, user_time)
+        else:
+            query = PERIOD_COUNT_ABOVE_QUERY
+            parameters = (guild_id, day_number() - days, user_time)
+
+        async with self.read_connection().execute(query, parameters) as cursor:
+            row = await cursor.fetchone()
+
+        return row[0] if row is not None else 0
+
+
+    async def get_window(self, guild_id: int, start: int, count: int, user_ids: Sequence[int] = (), days: Optional[int] = None) -> LeaderboardWindow:
+        connection = self.read_connection()
+
+        if days is None:
+            async with connection.execute(
+                "SELECT user_id, time FROM times WHERE guild_id = ? ORDER BY time DESC, user_id LIMIT ? OFFSET ?",
+                (guild_id, count, start)
+            ) as cursor:
+                entries: List[tuple[int, int]] = [(user_id, user_time) for user_id, user_time in await cursor.fetchall()]
+
+            async with connection.execute(
+                "SELECT (SELECT COUNT(*) FROM times WHERE guild_id = ?), (SELECT time FROM guild_totals WHERE guild_id = ?)",
+                (guild_id, guild_id)
+            ) as cursor:
+                member_count, total_time = await cursor.fetchone() # type: ignore
+        else:
+            first_excluded_day = day_number() - days
+
+            async with connection.execute(PERIOD_WINDOW_QUERY, (guild_id, first_excluded_day, count, start)) as cursor:
+                entries = [(user_id, period_time) for user_id, period_time in await cursor.fetchall()]
+
+            async with connection.execute(PERIOD_COUNT_AND_TOTAL_QUERY, (guild_id, first_excluded_day)) as cursor:
+                member_count, total_time = await cursor.fetchone() # type: ignore
+
+        return LeaderboardWindow(entries, member_count, total_time or 0, await self.get_times(guild_id, user_ids, days))
+
+
+    async def get_channel_top(self, guild_id: int, count: int) -> List[tuple[int, int]]:
+        async with self.read_connection().execute(
+            "SELECT channel_id, time FROM channel_times WHERE guild_id = ? ORDER BY time DESC LIMIT ?",
+            (guild_id, count)
+        ) as cursor:
+            return [(channel_id, channel_time) for channel_id, channel_time in await cursor.fetchall()]
+
+
+    async def save_snapshot(self, name: str, data: bytes, ttl_seconds: int) -> None:
+        async with self._write_lock:
+            await self.connection().execute(
+                "INSERT OR REPLACE INTO snapshots (name, data, expires_at) VALUES (?, ?, ?)",
+                (name, data, int(time.time()) + ttl_seconds)
+            )
+            await self.connection().commit()
+
+
+    async def take_snapshot(self, name: str) -> Optional[bytes]:
+        async with self._write_lock:
+            async with self.connection().execute("SELECT data, expires_at FROM snapshots WHERE name = ?", (name,)) as cursor:
+                row = await cursor.fetchone()
+
+            await self.connection().execute("DELETE FROM snapshots WHERE name = ?", (name,))
+            await self.connection().commit()
+
+        if row is None or time.time() > row[1]:
+            return None
+
+        return row[0]
+
+
+    async def delete_guild(self, guild_id: int) -> None:
+        async with self._write_lock:
+            await self.connection().execute("DELETE FROM times WHERE guild_id = ?", (guild_id,))
+            await self.connection().execute("DELETE FROM daily_times WHERE guild_id = ?", (guild_id,))
+            await self.connection().execute("DELETE FROM channel_times WHERE guild_id = ?", (guild_id,))
+            await self.connection().execute("DELETE FROM guild_totals WHERE guild_id = ?", (guild_id,))
+            await self.connection().commit()
+
+
+    async def delete_member(self, guild_id: int, user_id: int) -> None:
+        async with self._write_lock:
+            await self.connection().execute(
+                "UPDATE guild_totals SET time = time - COALESCE((SELECT time FROM times WHERE guild_id = ? AND user_id = ?), 0) WHERE guild_id = ?",
+                (guild_id, user_id, guild_id)
+            )
+            await self.connection().execute("DELETE FROM times WHERE guild_id = ? AND user_id = ?", (guild_id, user_id))
+            await self.connection().execute("DELETE FROM daily_times WHERE guild_id = ? AND user_id = ?", (guild_id, user_id))
+            await self.connection().commit()
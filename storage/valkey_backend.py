@@ -0,0 +1,481 @@
+import asyncio
+import valkey.asyncio as valkey
+
+from typing import Any, Dict, List, Optional, Sequence
+from storage.backend import BUCKET_RETENTION_DAYS, PERIOD_DAYS, ROLLUP_MAX_AGE_SECONDS, LeaderboardWindow, StorageBackend, day_number, period_day_numbers
+from storage.valkey_nodes import ValkeyNodes
+from valkey.exceptions import NoPermissionError, NoScriptError, WatchError
+from write_buffer import ChannelIncrement, Increment
+
+# Connections of each pool that are kept free for commands while a flush is running
+RESERVED_CONNECTIONS = 4
+
+# Applies a batch of increments to the guilds, their buckets of the day and the totals of both. The rollups
+# of the day's periods that exist get the increment too, so they stay up to date
+# KEYS: for each increment the guild key, then for each the bucket key, the guild total key, the day total key
+# and then the rollup key of each period
+# ARGV: bucket TTL, how many periods there are, then a member and increment for each guild key
+INCREMENT_SCRIPT = """
+local periods = tonumber(ARGV[2])
+local count = #KEYS / (4 + periods)
+local expiring = {}
+for i = 1, count do
+    local member = ARGV[i * 2 + 1]
+    local increment = ARGV[i * 2 + 2]
+    local bucket = KEYS[count + i]
+    local day_total = KEYS[count * 3 + i]
+    redis.call("ZINCRBY", KEYS[i], increment, member)
+    redis.call("ZINCRBY", bucket, increment, member)
+    redis.call("INCRBY", KEYS[count * 2 + i], increment)
+    redis.call("INCRBY", day_total, increment)
+    if not expiring[bucket] then
+        expiring[bucket] = true
+        redis.call("EXPIRE", bucket, ARGV[1])
+        redis.call("EXPIRE", day_total, ARGV[1])
+    end
+    for period = 1, periods do
+        local rollup = KEYS[count * (3 + period) + i]
+        if redis.call("EXISTS", rollup) == 1 then
+            redis.call("ZINCRBY", rollup, increment, member)
+        end
+    end
+end
+return count
+"""
+
+# Rolls the buckets of a period up into one sorted set, unless it's already there
+# KEYS[1]: the rollup key, then the bucket keys of the period
+# ARGV: rollup max age
+ROLLUP_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    redis.call("ZUNIONSTORE", KEYS[1], #KEYS - 1, unpack(KEYS, 2))
+    redis.call("EXPIRE", KEYS[1], ARGV[1])
+end
+return 1
+"""
+
+# Removes a member from every sorted set of the guild and takes their time off the guild total and the day totals,
+# all at once so no increment can land in between. The rollups are dropped, to be built again from the buckets
+# KEYS[1]: the guild key, KEYS[2]: the guild total key, then the bucket keys, the day total keys of the same days
+# and the rollup keys
+# ARGV[1]: the member, ARGV[2]: how many days of buckets there are
+DELETE_MEMBER_SCRIPT = """
+local member = ARGV[1]
+local days = tonumber(ARGV[2])
+local function remove(key, counter)
+    local score = redis.call("ZSCORE", key, member)
+    if score then
+        redis.call("ZREM", key, member)
+        redis.call("DECRBY", counter, string.format("%d", tonumber(score)))
+    end
+end
+remove(KEYS[1], KEYS[2])
+for i = 1, days do
+    remove(KEYS[2 + i], KEYS[2 + days + i])
+end
+for i = 3 + days * 2, #KEYS do
+    redis.call("DEL", KEYS[i])
+end
+return 1
+"""
+
+# How many times delete_member tries again without scripting, when the guild gets written to at the same time
+DELETE_MEMBER_MAX_RETRIES = 10
+
+
+def scripting_unavailable(error: Exception) -> bool:
+    """Whether a script error means it never ran, because scripting is turned off or not allowed"""
+    message = str(error).lower()
+    return isinstance(error, (NoScriptError, NoPermissionError)) or "unknown command" in message or "disabled" in message
+
+
+def guild_key(guild_id: int) -> str:
+    return f"guild:{guild_id}"
+
+
+def bucket_key(guild_id: int, day: int) -> str:
+    return f"guild_day:{guild_id}:{day}"
+
+
+def rollup_key(guild_id: int, days: int, day: int) -> str:
+    """The last `days` days up to `day`, so a rollup isn't read any more once the day is over"""
+    return f"guild_period:{guild_id}:{days}:{day}"
+
+
+def total_key(guild_id: int) -> str:
+    return f"guild_total:{guild_id}"
+
+
+def day_total_key(guild_id: int, day: int) -> str:
+    return f"guild_day_total:{guild_id}:{day}"
+
+
+def channel_key(guild_id: int) -> str:
+    return f"guild_channels:{guild_id}"
+
+
+def snapshot_key(name: str) -> str:
+    return f"snapshot:{name}"
+
+
+def period_bucket_keys(guild_id: int, days: int) -> List[str]:
+    return [bucket_key(guild_id, day) for day in period_day_numbers(days)]
+
+
+def period_total_keys(guild_id: int, days: int) -> List[str]:
+    return [day_total_key(guild_id, day) for day in period_day_numbers(days)]
+
+
+def period_rollup_keys(guild_id: int, day: int) -> List[str]:
+    """The rollup of every period up to the day"""
+    return [rollup_key(guild_id, days, day) for days in PERIOD_DAYS.values()]
+
+
+def member_keys(guild_id: int) -> List[str]:
+    """Every sorted set of the guild that has its members in it: the all-time key, every bucket that can still exist and every rollup"""
+    return (
+        [guild_key(guild_id)]
+        + period_bucket_keys(guild_id, BUCKET_RETENTION_DAYS)
+        + period_rollup_keys(guild_id, day_number())
+    )
+
+
+def all_guild_keys(guild_id: int) -> List[str]:
+    """The member keys, plus the channel totals and every counter of the guild"""
+    return (
+        member_keys(guild_id)
+        + [channel_key(guild_id), total_key(guild_id)]
+        + period_total_keys(guild_id, BUCKET_RETENTION_DAYS)
+    )
+
+
+BUCKET_TTL_SECONDS = BUCKET_RETENTION_DAYS * 86400
+
+# Flips each digit, see ValkeyBackend.rank_key()
+REVERSED_DIGITS = str.maketrans("0123456789", "9876543210")
+
+
+class ValkeyBackend(StorageBackend):
+    """
+    Each guild is a sorted set, guild:{id}, on the node the guild is hashed to. Its voice channels are
+    another sorted set next to it, guild_channels:{id}, and its total time is a counter, guild_total:{id}
+    """
+
+    def __init__(self, addresses: List[tuple[str, int]], max_connections: int = 20, db: int = 0):
+        self._addresses = addresses
+        self._max_connections = max_connections
+        self._db = db
+        self._nodes: Optional[ValkeyNodes] = None
+
+        # Set in register_scripts(). Left as None if the server doesn't allow scripting,
+        # in which case plain pipelines are used instead
+        self._increment_script = None
+        self._rollup_script = None
+        self._delete_member_script = None
+
+
+    async def connect(self) -> None:
+        self._nodes = ValkeyNodes(self._addresses, max_connections=self._max_connections, db=self._db)
+        await self.register_scripts()
+
+
+    async def close(self) -> None:
+        # Close the clients and their connection pools
+        if self._nodes:
+            await self._nodes.aclose()
+
+
+    async def register_scripts(self) -> None:
+        nodes = self.nodes()
+
+        try:
+            # Loading them up front checks that scripting is actually available on every node
+            for node_name in nodes.node_names():
+                await nodes.client(node_name).script_load(INCREMENT_SCRIPT)
+                await nodes.client(node_name).script_load(ROLLUP_SCRIPT)
+                await nodes.client(node_name).script_load(DELETE_MEMBER_SCRIPT)
+
+            # The scripts are called with the client of the node the guild lives on
+            self._increment_script = nodes.default_client().register_script(INCREMENT_SCRIPT)
+            self._rollup_script = nodes.default_client().register_script(ROLLUP_SCRIPT)
+            self._delete_member_script = nodes.default_client().register_script(DELETE_MEMBER_SCRIPT)
+        except Exception as error:
+            print(f"Scripting is not available, falling back to pipelines: {error}")
+            self.disable_scripts()
+
+
+    def disable_scripts(self) -> None:
+        self._increment_script = None
+        self._rollup_script = None
+        self._delete_member_script = None
+
+
+    def nodes(self) -> ValkeyNodes:
+        if self._nodes is None:
+            raise ConnectionError("Valkey is not connected")
+
+        return self._nodes
+
+
+    def partition(self, increments: List[Increment]) -> Dict[str, List[Increment]]:
+        return self.nodes().group_by_node(increments, lambda increment: increment[0])
+
+
+    def max_concurrency(self) -> int:
+        return max(1, self.nodes().max_connections() - RESERVED_CONNECTIONS)
+
+
+    def write_not_sent(self, error: Exception) -> bool:
+        # A connection is only sent on once it's open, and the client never sends again by itself, so failing to
+        # get one means nothing went out. Anything after that, even a timeout, may have been written
+        if isinstance(error, (valkey.ConnectionError, valkey.TimeoutError)):
+            message = str(error)
+            return "connecting to" in message or message.startswith(("Too many connections", "No connection available"))
+
+        return super().write_not_sent(error)
+
+
+    @staticmethod
+    def rank_key(user_id: int, user_time: int) -> Any:
+        # ZREVRANGE puts members with the same score in reverse lexicographic order of the member, which is
+        # the user ID as a string. With every digit flipped, and an end that sorts after any digit so an ID
+        # comes after the longer IDs it's the start of, that's ascending
+        return (-user_time, str(user_id).translate(REVERSED_DIGITS) + ":")
+
+
+    async def increment(self, increments: List[Increment], channel_increments: Sequence[ChannelIncrement] = ()) -> None:
+        nodes = self.nodes()
+
+        grouped: Dict[str, List[Increment]] = nodes.group_by_node(increments, lambda increment: increment[0])
+        grouped_channels: Dict[str, List[ChannelIncrement]] = nodes.group_by_node(channel_increments, lambda increment: increment[0])
+
+        # One round trip per node, all at the same time
+        node_names: List[str] = list(grouped) + [node_name for node_name in grouped_channels if node_name not in grouped]
+        await asyncio.gather(*(
+            self._increment_on_node(nodes.client(node_name), grouped.get(node_name, []), grouped_channels.get(node_name, []))
+            for node_name in node_names
+        ))
+
+
+    async def _increment_on_node(self, connection: valkey.Valkey, increments: List[Increment], channel_increments: Sequence[ChannelIncrement] = ()) -> None:
+        keys: List[str] = [guild_key(guild_id) for guild_id, _, _ in increments]
+
+        today = day_number()
+        bucket_keys: List[str] = [bucket_key(guild_id, today) for guild_id, _, _ in increments]
+        total_keys: List[str] = [total_key(guild_id) for guild_id, _, _ in increments]
+        day_total_keys: List[str] = [day_total_key(guild_id, today) for guild_id, _, _ in increments]
+
+        # Each period's rollup keys, one per increment
+        rollup_keys: List[List[str]] = [[rollup_key(guild_id, days, today) for guild_id, _, _ in increments] for days in PERIOD_DAYS.values()]
+
+        if self._increment_script is not None and increments:
+            args: List[str | int] = [BUCKET_TTL_SECONDS, len(PERIOD_DAYS)]
+            for _, user_id, time_difference in increments:
+                args.append(str(user_id))
+                args.append(time_difference)
+
+            # The channel totals go in the same round trip as the script
+            async with connection.pipeline(transaction=False) as pipe:
+                await self._increment_script(
+                    keys=keys + bucket_keys + total_keys + day_total_keys + [key for period_keys in rollup_keys for key in period_keys],
+                    args=args,
+                    client=pipe
+                ) # type: ignore
+                for guild_id, channel_id, time_difference in channel_increments:
+                    pipe.zincrby(channel_key(guild_id), time_difference, str(channel_id))
+                pipe_results = await pipe.execute(raise_on_error=False) # type: ignore
+
+            result = pipe_results[0] # type: ignore
+            if isinstance(result, Exception) and not scripting_unavailable(result):
+                # It may have stopped partway through, so this batch can't be sent again
+                raise result
+
+            # Raising would get the whole batch retried, even though the members were written
+            for channel_result in pipe_results[1:]: # type: ignore
+                if isinstance(channel_result, Exception):
+                    print(f"Error writing a channel total: {channel_result}")
+
+            if not isinstance(result, Exception):
+                return
+
+            # Scripting got turned off, use pipelines from now on. The script didn't run, but the
+            # channel totals were already written
+            print(f"Scripting is not available, falling back to pipelines: {result}")
+            self.disable_scripts()
+            channel_increments = ()
+
+        async with connection.pipeline(transaction=False) as pipe:
+            for key, (_, user_id, time_difference) in zip(keys, increments):
+                pipe.zincrby(key, time_difference, str(user_id))
+
+            for key, (_, user_id, time_difference) in zip(bucket_keys, increments):
+                pipe.zincrby(key, time_difference, str(user_id))
+            for key in set(bucket_keys):
+                pipe.expire(key, BUCKET_TTL_SECONDS)
+
+            for guild_id, guild_time in self._sum_by_guild(increments).items():
+                pipe.incrby(total_key(guild_id), guild_time)
+                pipe.incrby(day_total_key(guild_id, today), guild_time)
+                pipe.expire(day_total_key(guild_id, today), BUCKET_TTL_SECONDS)
+
+                # Can't add to a rollup only if it exists, so it gets built again on the next read. After the
+                # buckets, so a rollup built in between already has the increment
+                pipe.unlink(*period_rollup_keys(guild_id, today))
+
+            for guild_id, channel_id, time_difference in channel_increments:
+                pipe.zincrby(channel_key(guild_id), time_difference, str(channel_id))
+
+            await pipe.execute()
+
+
+    @staticmethod
+    def _sum_by_guild(increments: List[Increment]) -> Dict[int, int]:
+        sums: Dict[int, int] = {}
+        for guild_id, _, time_difference in increments:
+            sums[guild_id] = sums.get(guild_id, 0) + time_difference
+        return sums
+
+
+    async def _leaderboard_key(self, connection: valkey.Valkey, pipe: "valkey.client.Pipeline", guild_id: int, days: Optional[int]) -> tuple[str, int]:
+        """
+        The sorted set to read for the period: the guild key, or the rollup of the last `days` days. With
+        scripting, the rollup gets built in the same round trip, queued first on `pipe`. Returns the key and
+        how many results that puts in front of the pipeline's own.
+        """
+        if days is None:
+            return guild_key(guild_id), 0
+
+        rollup = rollup_key(guild_id, days, day_number())
+
+        if self._rollup_script is not None:
+            await self._rollup_script(keys=[rollup] + period_bucket_keys(guild_id, days), args=[ROLLUP_MAX_AGE_SECONDS], client=pipe) # type: ignore
+            return rollup, 1
+
+        if not await connection.exists(rollup):
+            async with connection.pipeline(transaction=False) as rollup_pipe:
+                rollup_pipe.zunionstore(rollup, period_bucket_keys(guild_id, days))
+                rollup_pipe.expire(rollup, ROLLUP_MAX_AGE_SECONDS)
+                await rollup_pipe.execute()
+
+        return rollup, 0
+
+
+    async def get_time_and_position(self, guild_id: int, user_id: int, days: Optional[int] = None) -> tuple[Optional[int], Optional[int]]:
+        connection: valkey.Valkey = self.nodes().client_for_guild(guild_id)
+
+        async with connection.pipeline(transaction=False) as pipe:
+            key, skip = await self._leaderboard_key(connection, pipe, guild_id, days)
+            pipe.zscore(key, str(user_id))
+            pipe.zrevrank(key, str(user_id))
+            user_time, user_rank = (await pipe.execute())[skip:] # type: ignore
+
+        if user_time is None:
+            return (None, None)
+
+        return (int(user_time), user_rank + 1 if user_rank is not None else None) # type: ignore
+
+
+    async def get_times(self, guild_id: int, user_ids: Sequence[int], days: Optional[int] = None) -> List[Optional[int]]:
+        if not user_ids:
+            return []
+
+        connection: valkey.Valkey = self.nodes().client_for_guild(guild_id)
+
+        async with connection.pipeline(transaction=False) as pipe:
+            key, skip = await self._leaderboard_key(connection, pipe, guild_id, days)
+            pipe.zmscore(key, [str(user_id) for user_id in user_ids])
+            scores = (await pipe.execute())[skip] # type: ignore
+
+        return [int(score) if score is not None else None for score in scores] # type: ignore
+
+
+    async def count_above(self, guild_id: int, user_time: int, days: Optional[int] = None) -> int:
+        connection: valkey.Valkey = self.nodes().client_for_guild(guild_id)
+
+        async with connection.pipeline(transaction=False) as pipe:
+            key, skip = await self._leaderboard_key(connection, pipe, guild_id, days)
+            pipe.zcount(key, f"({user_time}", "+inf")
+            return (await pipe.execute())[skip] # type: ignore
+
+
+    async def get_channel_top(self, guild_id: int, count: int) -> List[tuple[int, int]]:
+        top = await self.nodes().client_for_guild(guild_id).zrevrange(channel_key(guild_id), 0, count - 1, withscores=True) # type: ignore
+        return [(int(channel_id), int(score)) for channel_id, score in top] # type: ignore
+
+
+    async def get_window(self, guild_id: int, start: int, count: int, user_ids: Sequence[int] = (), days: Optional[int] = None) -> LeaderboardWindow:
+        connection: valkey.Valkey = self.nodes().client_for_guild(guild_id)
+        counter_keys: List[str] = [total_key(guild_id)] if days is None else period_total_keys(guild_id, days)
+
+        # The window, the size, the total and the scores of user_ids in one round trip
+        async with connection.pipeline(transaction=False) as pipe:
+            key, skip = await self._leaderboard_key(connection, pipe, guild_id, days)
+            pipe.zrevrange(key, start, start + count - 1, withscores=True)
+            pipe.zcard(key)
+            pipe.mget(counter_keys)
+            if user_ids:
+                pipe.zmscore(key, [str(user_id) for user_id in user_ids])
+            results = (await pipe.execute())[skip:] # type: ignore
+
+        entries: List[tuple[int, int]] = [(int(user_id), int(score)) for user_id, score in results[0]] # type: ignore
+        total_time: int = sum(int(counter) for counter in results[2] if counter is not None) # type: ignore
+        times: List[Optional[int]] = [int(score) if score is not None else None for score in results[3]] if user_ids else [] # type: ignore
+
+        return LeaderboardWindow(entries, results[1], total_time, times) # type: ignore
+
+
+    async def save_snapshot(self, name: str, data: bytes, ttl_seconds: int) -> None:
+        # Doesn't belong to a guild, so it lives on the default node
+        await self.nodes().default_client().set(snapshot_key(name), data, ex=ttl_seconds)
+
+
+    async def take_snapshot(self, name: str) -> Optional[bytes]:
+        return await self.nodes().default_client().getdel(snapshot_key(name)) # type: ignore
+
+
+    async def delete_guild(self, guild_id: int) -> None:
+        await self.nodes().client_for_guild(guild_id).delete(*all_guild_keys(guild_id))
+
+
+    async def delete_member(self, guild_id: int, user_id: int) -> None:
+        connection: valkey.Valkey = self.nodes().client_for_guild(guild_id)
+        days: List[int] = period_day_numbers(BUCKET_RETENTION_DAYS)
+
+        bucket_keys: List[str] = [bucket_key(guild_id, day) for day in days]
+        day_total_keys: List[str] = [day_total_key(guild_id, day) for day in days]
+        rollup_keys: List[str] = period_rollup_keys(guild_id, day_number())
+
+        if self._delete_member_script is not None:
+            await self._delete_member_script(
+                keys=[guild_key(guild_id), total_key(guild_id)] + bucket_keys + day_total_keys + rollup_keys,
+                args=[str(user_id), len(days)],
+                client=connection
+            ) # type: ignore
+            return
+
+        # The member's time comes off the totals too, so it's read first. The keys are watched, so if an
+        # increment lands before the update, the update doesn't go through and it's read again
+        score_keys: List[str] = [guild_key(guild_id)] + bucket_keys
+        counter_keys: List[str] = [total_key(guild_id)] + day_total_keys
+
+        async with connection.pipeline(transaction=True) as pipe:
+            for attempt in range(DELETE_MEMBER_MAX_RETRIES):
+                try:
+                    await pipe.watch(*score_keys, *counter_keys)
+
+                    # Once watching, the pipeline runs each command straight away until multi()
+                    scores: List[Optional[float]] = [await pipe.zscore(key, str(user_id)) for key in score_keys]
+
+                    pipe.multi()
+                    for key in score_keys:
+                        pipe.zrem(key, str(user_id))
+                    pipe.delete(*rollup_keys)
+                    for counter_key, score in zip(counter_keys, scores):
+                        if score is not None:
+                            pipe.decrby(counter_key, int(score))
+
+                    await pipe.execute()
+                    return
+                except WatchError:
+                    if attempt == DELETE_MEMBER_MAX_RETRIES - 1:
+                        raise
@@ -0,0 +1,170 @@
+import re
+import valkey.asyncio as valkey
+
+from typing import Callable, Dict, Iterable, List, Optional, TypeVar
+from objects.hash_ring import HashRing
+
+T = TypeVar("T")
+
+# Every key that belongs to a guild has the guild ID right after the first colon, e.g. guild:{id}
+GUILD_KEY_PATTERN = re.compile(rb"^[a-z_]+:(\d+)")
+
+MIGRATION_SCAN_COUNT = 1000
+
+# Where a key is restored on its new node before it's renamed to its own name. Doesn't match GUILD_KEY_PATTERN,
+# so a copy left behind by an interrupted move isn't mistaken for a guild key
+MIGRATING_KEY_PREFIX = b"migrating:"
+
+
+def guild_id_from_key(key: bytes) -> Optional[int]:
+    match = GUILD_KEY_PATTERN.match(key)
+    if match is None:
+        return None
+
+    return int(match.group(1))
+
+
+class ValkeyNodes:
+    """
+    A set of Valkey nodes with the guild keys partitioned between them by consistent hashing.
+    All of a guild's keys live on the same node, so anything scoped to one guild is still one round trip.
+    """
+
+    def __init__(self, addresses: List[tuple[str, int]], max_connections: int = 20, db: int = 0):
+        self._max_connections = max_connections
+        self._db = db
+        self._clients: Dict[str, valkey.Valkey] = {}
+        self._default_node: str = ""
+
+        for host, port in addresses:
+            node_name = self._connect(host, port)
+            self._default_node = self._default_node or node_name
+
+        self._ring = HashRing(list(self._clients))
+
+
+    def _connect(self, host: str, port: int) -> str:
+        node_name = f"{host}:{port}"
+
+        # Define the connection pools. Blocking, so a burst of concurrent batches waits for a
+        # free connection instead of erroring once the pool is used up
+        connection_pool = valkey.BlockingConnectionPool(
+            host=host,
+            port=port,
+            db=self._db,
+            # Not retried by the client, a write that timed out may still have been applied.
+            # The datastore decides what gets sent again
+            retry_on_timeout=False,
+            socket_timeout=30,
+            socket_connect_timeout=30,
+            max_connections=self._max_connections,
+            timeout=30,
+            )
+
+        # Establish the actual connections
+        self._clients[node_name] = valkey.Valkey(connection_pool=connection_pool)
+        return node_name
+
+
+    def max_connections(self) -> int:
+        """Size of each node's connection pool"""
+        return self._max_connections
+
+
+    def node_names(self) -> List[str]:
+        return list(self._clients)
+
+
+    def client(self, node_name: str) -> valkey.Valkey:
+        return self._clients[node_name]
+
+
+    def default_client(self) -> valkey.Valkey:
+        """For keys that don't belong to any guild"""
+        return self._clients[self._default_node]
+
+
+    def client_for_guild(self, guild_id: int) -> valkey.Valkey:
+        return self._clients[self._ring.node_for(guild_id)]
+
+
+    def group_by_node(self, items: Iterable[T], guild_id_of: Callable[[T], int]) -> Dict[str, List[T]]:
+        """Splits items up by the node their guild lives on, keeping their order within each node"""
+        grouped: Dict[str, List[T]] = {}
+
+        for item in items:
+            grouped.setdefault(self._ring.node_for(guild_id_of(item)), []).append(item)
+
+        return grouped
+
+
+    async def add_node(self, host: str, port: int) -> int:
+        """
+        Adds a node and moves the guild keys it now owns over from the other nodes. Returns how many keys were moved.
+        Only for when the bot is stopped: nothing holds writers off while a key is being moved, and reads of the
+        moved guilds would already go to the new node before their keys are all there.
+        Each key is copied whole and then deleted from where it was, so running this again after it got
+        interrupted finishes the move without counting any time twice.
+        """
+        old_node_names = self.node_names()
+
+        node_name = self._connect(host, port)
+        self._ring.add_node(node_name)
+
+        moved = 0
+        for old_node_name in old_node_names:
+            moved += await self._migrate_from(old_node_name)
+
+        return moved
+
+
+    async def _migrate_from(self, source_name: str) -> int:
+        source = self._clients[source_name]
+        moved = 0
+
+        # SCAN goes through the keyspace a little at a time, so the node never blocks
+        async for key in source.scan_iter(count=MIGRATION_SCAN_COUNT):
+            guild_id = guild_id_from_key(key)
+            if guild_id is None:
+                continue
+
+            target_name = self._ring.node_for(guild_id)
+            if target_name == source_name:
+                continue
+
+            if await self._move_key(source, self._clients[target_name], key):
+                moved += 1
+
+        return moved
+
+
+    @staticmethod
+    async def _move_key(source: valkey.Valkey, target: valkey.Valkey, key: bytes) -> bool:
+        """
+        Copies the key with DUMP and RESTORE, so it arrives as it was, TTL included. It's restored next to
+        the key first and then renamed over it, so the key is either not on the target or complete there,
+        and a copy left over from an earlier run is simply replaced. Returns False if the key was gone already.
+        """
+        async with source.pipeline(transaction=True) as pipe:
+            pipe.dump(key)
+            pipe.pttl(key)
+            dumped, ttl_ms = await pipe.execute() # type: ignore
+
+        if dumped is None:
+            return False
+
+        copy_key: bytes = MIGRATING_KEY_PREFIX + key
+
+        async with target.pipeline(transaction=True) as pipe:
+            pipe.restore(copy_key, ttl_ms if ttl_ms > 0 else 0, dumped, replace=True)
+            pipe.rename(copy_key, key)
+            await pipe.execute()
+
+        await source.unlink(key)
+        return True
+
+
+    async def aclose(self) -> None:
+        for client in self._clients.values():
+            # Also closes the connection pool
+            await client.aclose(close_connection_pool=True)
@@ -0,0 +1,52 @@
+import unittest
+
+from typing import Dict
+from objects.hash_ring import HashRing
+
+GUILD_IDS = range(10**17, 10**17 + 20000)
+
+
+class HashRingTest(unittest.TestCase):
+
+    def owners(self, ring: HashRing) -> Dict[int, str]:
+        return {guild_id: ring.node_for(guild_id) for guild_id in GUILD_IDS}
+
+
+    def test_adding_a_node_only_moves_guilds_onto_it(self):
+        ring = HashRing(["a", "b", "c"])
+        before = self.owners(ring)
+
+        ring.add_node("d")
+        after = self.owners(ring)
+
+        moved = [guild_id for guild_id in GUILD_IDS if before[guild_id] != after[guild_id]]
+        self.assertTrue(all(after[guild_id] == "d" for guild_id in moved))
+        # Roughly its share of the guilds, not a reshuffle
+        self.assertLess(abs(len(moved) / len(GUILD_IDS) - 0.25), 0.1)
+
+
+    def test_removing_a_node_only_moves_its_guilds(self):
+        ring = HashRing(["a", "b", "c", "d"])
+        before = self.owners(ring)
+
+        ring.remove_node("d")
+        after = self.owners(ring)
+
+        for guild_id in GUILD_IDS:
+            if before[guild_id] != "d":
+                self.assertEqual(after[guild_id], before[guild_id])
+        self.assertNotIn("d", after.values())
+        self.assertEqual(ring.node_names(), ["a", "b", "c"])
+
+
+    def test_same_nodes_same_owners(self):
+        self.assertEqual(self.owners(HashRing(["a", "b", "c"])), self.owners(HashRing(["c", "a", "b"])))
+
+
+    def test_empty_ring(self):
+        with self.assertRaises(LookupError):
+            HashRing([]).node_for(1)
+
+
+if __name__ == "__main__":
+    unittest.main()
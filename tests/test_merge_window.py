@@ -0,0 +1,66 @@
+import random
+import unittest
+
+from typing import Dict, List
+from storage.backend import LeaderboardWindow, RankKey, StorageBackend, merge_window
+
+try:
+    from storage.valkey_backend import ValkeyBackend
+except ImportError:
+    ValkeyBackend = None
+
+
+class MergeWindowTest(unittest.TestCase):
+
+    def check(self, saved: Dict[int, int], unsaved: Dict[int, int], start: int, count: int, rank_key: RankKey) -> None:
+        ranked: List[tuple[int, int]] = sorted(saved.items(), key=lambda entry: rank_key(*entry))
+
+        window_start = max(0, start - len(unsaved))
+        window_count = start + count - window_start
+        window = LeaderboardWindow(
+            ranked[window_start:window_start + window_count], len(saved), sum(saved.values()),
+            [saved.get(user_id) for user_id in unsaved]
+        )
+
+        merged: Dict[int, int] = dict(saved)
+        for user_id, unsaved_time in unsaved.items():
+            merged[user_id] = merged.get(user_id, 0) + unsaved_time
+        expected = sorted(merged.items(), key=lambda entry: rank_key(*entry))[start:start + count]
+
+        self.assertEqual(merge_window(window, window_start, window_count, start, count, unsaved, rank_key), expected)
+
+
+    def check_random(self, max_time: int, rank_key: RankKey) -> None:
+        rng = random.Random(max_time)
+
+        for _ in range(3000):
+            user_ids = rng.sample(range(1, 10**6), rng.randint(1, 40))
+            saved = {user_id: rng.randint(0, max_time) for user_id in user_ids if rng.random() < 0.8}
+            unsaved = {user_id: rng.randint(0, max_time) for user_id in user_ids if rng.random() < 0.3}
+
+            self.check(saved, unsaved, rng.randint(0, 45), rng.randint(1, 12), rank_key)
+
+
+    def test_distinct_times(self):
+        self.check_random(10**9, StorageBackend.rank_key)
+
+
+    def test_tied_times(self):
+        # Only a handful of different times, so most members tie with someone
+        self.check_random(3, StorageBackend.rank_key)
+
+
+    @unittest.skipIf(ValkeyBackend is None, "valkey is not installed")
+    def test_tied_times_ordered_like_valkey(self):
+        self.check_random(3, ValkeyBackend.rank_key)
+
+
+    def test_tie_with_unsaved_time(self):
+        # 2 catches up with 1 and 3, and goes between them
+        saved = {1: 10, 2: 5, 3: 10, 4: 10}
+        self.check(saved, {2: 5}, 0, 2, StorageBackend.rank_key)
+        self.check(saved, {2: 5}, 2, 2, StorageBackend.rank_key)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import tempfile
+import unittest
+
+from objects.session_journal import SessionJournal, ShardedSessionJournal
+
+
+def guild_on_shard(shard_id: int, shard_count: int) -> int:
+    return (shard_count * 1000 + shard_id) << 22
+
+
+class SessionJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "journal.bin")
+
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+    def test_replay(self):
+        journal = SessionJournal(self.path, initial_records=4)
+        journal.open()
+
+        journal.record_join(1, 10, 100)
+        journal.record_join(2, 10, 100)
+        journal.record_join(3, 20, 100)
+
+        # Queued and written
+        journal.record_save(1, 10, 130)
+        journal.record_flushed(journal.position())
+
+        # Queued but never written
+        journal.record_save_guild(10, 150)
+        journal.record_leave(2, 10)
+        journal.record_pending(4, 20, 9)
+        journal.record_heartbeat(170)
+        journal.close()
+
+        recovered = SessionJournal(self.path).open()
+
+        self.assertEqual(sorted(recovered.unsaved), [(10, 1, 20), (10, 2, 50), (20, 4, 9)])
+        self.assertEqual(recovered.sessions, {10: {1: 150}, 20: {3: 100}})
+        self.assertEqual(recovered.last_alive, 170)
+
+
+    def test_failed_flush_stays_pending(self):
+        journal = SessionJournal(self.path)
+        journal.open()
+
+        journal.record_join(1, 10, 100)
+        journal.record_save(1, 10, 160)
+        position = journal.position()
+
+        # The flush didn't get to write it, so it's queued again after the flushed record
+        journal.record_flushed(position)
+        journal.record_pending(1, 10, 60)
+        journal.close()
+
+        recovered = SessionJournal(self.path).open()
+        self.assertEqual(recovered.unsaved, [(10, 1, 60)])
+
+
+    def test_compact(self):
+        journal = SessionJournal(self.path, initial_records=4)
+        journal.open()
+        for user_id in range(10):
+            journal.record_join(user_id, 10, 100)
+        journal.record_leave_guild(10)
+
+        journal.compact([(1, 20, 120)], [(20, 2, 30)], 200)
+        self.assertEqual(journal.position(), 3)
+        journal.close()
+
+        recovered = SessionJournal(self.path).open()
+        self.assertEqual(recovered.sessions, {20: {1: 120}})
+        self.assertEqual(recovered.unsaved, [(20, 2, 30)])
+        self.assertEqual(recovered.last_alive, 200)
+
+
+    def test_sessions_follow_their_shard(self):
+        first = ShardedSessionJournal(self.path, [0, 1], 4)
+        second = ShardedSessionJournal(self.path, [2, 3], 4)
+        first.open()
+        second.open()
+
+        for shard_id, journal in ((0, first), (1, first), (2, second), (3, second)):
+            journal.record_join(shard_id, guild_on_shard(shard_id, 4), 100)
+        second.record_pending(9, guild_on_shard(3, 4), 5)
+        first.close()
+        second.close()
+
+        # Another number of workers splits the same shards differently
+        recovered = ShardedSessionJournal(self.path, [1, 2], 4).open()
+        self.assertEqual(recovered.sessions, {guild_on_shard(1, 4): {1: 100}, guild_on_shard(2, 4): {2: 100}})
+        self.assertEqual(recovered.unsaved, [])
+
+        recovered = ShardedSessionJournal(self.path, [0, 3], 4).open()
+        self.assertEqual(recovered.sessions, {guild_on_shard(0, 4): {0: 100}, guild_on_shard(3, 4): {3: 100}})
+        self.assertEqual(recovered.unsaved, [(guild_on_shard(3, 4), 9, 5)])
+
+
+    def test_journals_no_shard_owns_are_taken_over(self):
+        journal = ShardedSessionJournal(self.path, [0, 1, 2, 3], 4)
+        journal.open()
+        for shard_id in range(4):
+            journal.record_join(shard_id, guild_on_shard(shard_id, 4), 100)
+        journal.close()
+
+        # Down to 2 shards, the journals of shards 2 and 3 go to the owner of shard 0
+        other = ShardedSessionJournal(self.path, [1], 2)
+        self.assertEqual(other.open().sessions, {guild_on_shard(1, 4): {1: 100}})
+        other.close()
+
+        owner = ShardedSessionJournal(self.path, [0], 2)
+        recovered = owner.open()
+        owner.close()
+        self.assertEqual(sorted(recovered.sessions), [guild_on_shard(shard_id, 4) for shard_id in (0, 2, 3)])
+        self.assertEqual(sorted(os.listdir(self.directory.name)), ["journal.shard0.bin", "journal.shard1.bin"])
+
+        # Kept in the owner's journal until they're saved
+        self.assertEqual(sorted(ShardedSessionJournal(self.path, [0], 2).open().sessions), sorted(recovered.sessions))
+
+
+if __name__ == "__main__":
+    unittest.main()
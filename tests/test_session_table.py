@@ -0,0 +1,69 @@
+import random
+import unittest
+
+from typing import Dict
+from objects.session_table import SessionTable
+
+
+class SessionTableTest(unittest.TestCase):
+
+    def check(self, table: SessionTable, expected: Dict[tuple[int, int], int]) -> None:
+        self.assertEqual(len(table), len(expected))
+        self.assertEqual(sorted(table.sessions_with_joined_times()), sorted((user_id, guild_id, joined_time) for (user_id, guild_id), joined_time in expected.items()))
+
+        for guild_id in {guild_id for _, guild_id in expected} | set(table.guild_ids()):
+            guild_expected = sorted((user_id, joined_time) for (user_id, session_guild_id), joined_time in expected.items() if session_guild_id == guild_id)
+            self.assertEqual(sorted(table.guild_sessions(guild_id)), guild_expected)
+            self.assertEqual(table.guild_count(guild_id), len(guild_expected))
+
+        for (user_id, guild_id), joined_time in expected.items():
+            self.assertEqual(table.get_joined_time(user_id, guild_id), joined_time)
+
+
+    def test_removal_moves_the_last_slot(self):
+        table = SessionTable()
+        for user_id in range(5):
+            table.add(user_id, 1 if user_id % 2 else 2, 100 + user_id)
+
+        # From the middle, so the last slot and the last of the guild's slots both move
+        self.assertEqual(table.pop(1, 1), 101)
+        self.assertIsNone(table.pop(1, 1))
+        self.check(table, {(0, 2): 100, (2, 2): 102, (3, 1): 103, (4, 2): 104})
+
+        self.assertEqual(sorted(table.pop_guild(2)), [(0, 100), (2, 102), (4, 104)])
+        self.check(table, {(3, 1): 103})
+        self.assertEqual(table.guild_ids(), [1])
+
+
+    def test_random_operations(self):
+        rng = random.Random(1)
+        table = SessionTable()
+        expected: Dict[tuple[int, int], int] = {}
+
+        for step in range(5000):
+            user_id = rng.randint(1, 60)
+            guild_id = rng.randint(1, 6)
+            operation = rng.random()
+
+            if operation < 0.5:
+                table.add(user_id, guild_id, step)
+                expected[(user_id, guild_id)] = step
+            elif operation < 0.6:
+                sessions = [(rng.randint(1, 60), step, 0) for _ in range(rng.randint(1, 5))]
+                for added_user_id, joined_time, _ in table.add_guild(guild_id, sessions):
+                    self.assertNotIn((added_user_id, guild_id), expected)
+                    expected[(added_user_id, guild_id)] = joined_time
+            elif operation < 0.95:
+                self.assertEqual(table.pop(user_id, guild_id), expected.pop((user_id, guild_id), None))
+            else:
+                removed = table.pop_guild(guild_id)
+                self.assertEqual(sorted(removed), sorted((user_id, expected.pop((user_id, guild_id))) for user_id, session_guild_id in list(expected) if session_guild_id == guild_id))
+
+            if step % 100 == 0:
+                self.check(table, expected)
+
+        self.check(table, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
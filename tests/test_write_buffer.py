@@ -0,0 +1,73 @@
+import asyncio
+import unittest
+
+from typing import List
+from write_buffer import ChannelIncrement, Increment, WriteBuffer
+
+
+class WriteBufferTest(unittest.TestCase):
+
+    def test_failed_increments_are_put_back(self):
+        buffer = WriteBuffer()
+        written: List[List[Increment]] = []
+
+        async def writer(increments: List[Increment], channel_increments: List[ChannelIncrement]) -> tuple[List[Increment], List[ChannelIncrement]]:
+            written.append(sorted(increments))
+            # Only the first member of the first flush fails
+            if len(written) == 1:
+                return [(1, 10, 5)], [(1, 100, 5)]
+            return [], []
+
+        async def run() -> None:
+            buffer.start(writer)
+            buffer.add(1, 10, 5)
+            buffer.add(1, 11, 7)
+            buffer.add_channel(1, 100, 5)
+            await buffer.flush()
+
+            self.assertEqual(buffer.pending_for_guild(1), {10: 5})
+            self.assertEqual(buffer.pending_channels_for_guild(1), {100: 5})
+            self.assertEqual(buffer.pending_count(), 1)
+
+            # Merged with what came in since
+            buffer.add(1, 10, 3)
+            await buffer.flush()
+            await buffer.stop()
+
+        asyncio.run(run())
+
+        self.assertEqual(written, [[(1, 10, 5), (1, 11, 7)], [(1, 10, 8)]])
+        self.assertEqual(buffer.pending_count(), 0)
+        self.assertEqual(buffer.total_entries_flushed, 2)
+        self.assertEqual(buffer.total_failed_entries, 1)
+
+
+    def test_writer_error_is_not_put_back(self):
+        buffer = WriteBuffer()
+
+        async def writer(increments: List[Increment], channel_increments: List[ChannelIncrement]) -> tuple[List[Increment], List[ChannelIncrement]]:
+            raise RuntimeError("broke off halfway")
+
+        async def run() -> None:
+            buffer.start(writer)
+            buffer.add(1, 10, 5)
+            buffer.add(2, 20, 5)
+
+            with self.assertRaises(RuntimeError):
+                await buffer.flush()
+
+            # Some of it may have been written, so retrying it could count it twice
+            self.assertEqual(buffer.pending_count(), 0)
+            self.assertEqual(buffer.pending_increments(), [])
+
+            # stop() reports the error instead of raising it
+            buffer.add(1, 10, 1)
+            await buffer.stop()
+
+        asyncio.run(run())
+
+        self.assertEqual(buffer.total_failed_entries, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+"""
+Adds a Valkey node to the ones in config.VALKEY_NODES and moves the guilds it now owns onto it.
+Add the new node to config.VALKEY_NODES afterwards so the bot keeps sending those guilds there.
+
+The bot (every worker of a cluster) has to be stopped while this runs. Nothing keeps it from writing to a
+key that's being moved, and that time would be lost. Start the new node empty. If the move gets interrupted,
+run it again with the same nodes: keys that already moved aren't on the old nodes anymore, and the rest are
+copied over whatever an earlier run left behind.
+
+It can be tried against local valkey-server processes, e.g.
+    valkey-server --port 7001 & valkey-server --port 7002 & valkey-server --port 7003 &
+
+Run from the repository root:
+    python -m tools.add_valkey_node <host> <port> [--nodes localhost:7001,localhost:7002]
+"""
+import argparse
+import asyncio
+import time
+
+from typing import List
+from storage.valkey_nodes import ValkeyNodes
+
+
+def parse_nodes(value: str) -> List[tuple[str, int]]:
+    addresses: List[tuple[str, int]] = []
+    for address in value.split(","):
+        host, port = address.rsplit(":", 1)
+        addresses.append((host, int(port)))
+    return addresses
+
+
+def configured_nodes() -> List[tuple[str, int]]:
+    import config
+    return getattr(config, "VALKEY_NODES", None) or [(config.VALKEY_HOST, config.VALKEY_PORT)]
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Moves guilds onto a new Valkey node. Stop the bot first")
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--nodes", type=parse_nodes, help="host:port,... of the current nodes. Defaults to the config")
+    options = parser.parse_args()
+
+    nodes = ValkeyNodes(options.nodes or configured_nodes())
+
+    start = time.perf_counter()
+    moved = await nodes.add_node(options.host, options.port)
+    elapsed = time.perf_counter() - start
+
+    print(f"Moved {moved} keys to {options.host}:{options.port} in {elapsed:.2f}s")
+    print(f"Nodes: {', '.join(nodes.node_names())}")
+
+    await nodes.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
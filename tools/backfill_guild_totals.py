@@ -0,0 +1,121 @@
+"""
+Adds up the guild and day totals of guilds written before the totals were kept. Run it once per Valkey
+deployment after updating the bot. Until then, the server total on /leaderboard only counts time since the update.
+
+Walks the keyspace with SCAN and each leaderboard with ZSCAN, a batch at a time, so no node ever blocks.
+Each total is set while its sorted set is watched, so it's safe while the bot is running: if the bot writes
+to the guild halfway through, that guild is added up again. Guilds written to so often that they never get
+through are listed at the end. Run it again, with the bot stopped if it keeps happening.
+
+Once a node is done, guild_totals_backfilled is set on it and later runs skip it, unless given --force.
+
+Run from the repository root:
+    python -m tools.backfill_guild_totals [--nodes localhost:7001,localhost:7002] [--force]
+"""
+import argparse
+import asyncio
+import time
+import valkey.asyncio as valkey
+
+from typing import List
+from storage.backend import BUCKET_RETENTION_DAYS, period_day_numbers
+from storage.valkey_backend import bucket_key, day_total_key, guild_key, total_key
+from storage.valkey_nodes import ValkeyNodes, guild_id_from_key
+from tools.add_valkey_node import configured_nodes, parse_nodes
+from valkey.exceptions import WatchError
+
+# Set on a node once the totals of all of its guilds have been added up
+TOTALS_BACKFILLED_KEY = "guild_totals_backfilled"
+
+# How many times a total is added up again when the bot writes to it at the same time
+MAX_RETRIES = 10
+
+
+async def backfill_total(connection: valkey.Valkey, sorted_set_key: str, counter_key: str, scan_count: int) -> bool:
+    """
+    Sets the counter to the sum of the sorted set, with the sorted set's TTL. Returns False if the sorted set
+    kept getting written to while it was being added up.
+    """
+    async with connection.pipeline(transaction=True) as pipe:
+        for _ in range(MAX_RETRIES):
+            try:
+                # Once watching, the pipeline runs each command straight away until multi()
+                await pipe.watch(sorted_set_key, counter_key)
+
+                ttl_ms: int = await pipe.pttl(sorted_set_key)
+                if ttl_ms == -2:
+                    # Doesn't exist, so there's nothing to add up
+                    await pipe.reset()
+                    return True
+
+                total: float = 0
+                async for _, score in pipe.zscan_iter(sorted_set_key, count=scan_count):
+                    total += score
+
+                pipe.multi()
+                pipe.set(counter_key, int(total), px=ttl_ms if ttl_ms > 0 else None)
+                await pipe.execute()
+                return True
+            except WatchError:
+                continue
+
+    return False
+
+
+async def backfill_node(nodes: ValkeyNodes, node_name: str, options: argparse.Namespace) -> List[int]:
+    """Adds up the totals of every guild on the node. Returns the guilds that couldn't be"""
+    connection: valkey.Valkey = nodes.client(node_name)
+
+    if not options.force and await connection.exists(TOTALS_BACKFILLED_KEY):
+        print(f"{node_name}: already done")
+        return []
+
+    start = time.perf_counter()
+    guilds: int = 0
+    failed: List[int] = []
+    days: List[int] = period_day_numbers(BUCKET_RETENTION_DAYS)
+
+    async for key in connection.scan_iter(match="guild:*", count=options.scan_count):
+        guild_id = guild_id_from_key(key)
+        if guild_id is None:
+            continue
+
+        pairs: List[tuple[str, str]] = [(guild_key(guild_id), total_key(guild_id))]
+        pairs += [(bucket_key(guild_id, day), day_total_key(guild_id, day)) for day in days]
+
+        for sorted_set_key, counter_key in pairs:
+            if not await backfill_total(connection, sorted_set_key, counter_key, options.scan_count):
+                failed.append(guild_id)
+                break
+
+        guilds += 1
+
+    if not failed:
+        await connection.set(TOTALS_BACKFILLED_KEY, 1)
+
+    print(f"{node_name}: added up the totals of {guilds - len(failed)} guilds in {time.perf_counter() - start:.2f}s")
+    return failed
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=parse_nodes, help="host:port,... of the nodes. Defaults to the config")
+    parser.add_argument("--scan-count", type=int, default=500, help="COUNT hint for each SCAN and ZSCAN")
+    parser.add_argument("--force", action="store_true", help="Also add up the nodes that were done already")
+    options = parser.parse_args()
+
+    nodes = ValkeyNodes(options.nodes or configured_nodes())
+    failed: List[int] = []
+
+    try:
+        for node_name in nodes.node_names():
+            failed += await backfill_node(nodes, node_name, options)
+    finally:
+        await nodes.aclose()
+
+    if failed:
+        print(f"Kept getting written to, run again: {', '.join(str(guild_id) for guild_id in failed)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
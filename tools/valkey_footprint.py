@@ -0,0 +1,442 @@
+"""
+Reports how much Valkey memory each guild takes up, and optionally gives some of it back.
+Walks the keyspace with SCAN and every leaderboard with ZSCAN, a batch at a time, so no node ever blocks.
+
+For every guild: the memory of all its keys, the encoding of its guild:{id} sorted set (listpack while
+it's small, skiplist after that), how many members it has and how their times are spread out.
+
+--prune-below SECONDS removes members with less all-time than that from guild:{id}, and takes their time
+off the guild total. Only members whose time is still under the threshold when they're removed go, so it's
+safe while the bot is running. Their time in the daily buckets expires on its own.
+
+--archive-dead DIR writes every key of a dead guild to DIR/guild_{id}.json.gz and then deletes the keys.
+A guild is dead if it isn't in --live-guilds, a file with one guild ID per line of every guild the bot is in,
+which is required with --archive-dead. How long ago a guild last got time says nothing about whether the bot
+is still in it. If a guild is written to while it's being archived, it's left alone.
+
+--dry-run reports what would be pruned and archived without changing or writing anything.
+--cursor-file keeps the SCAN cursor of each node, so a run that got interrupted carries on where it stopped.
+
+Run from the repository root:
+    python -m tools.valkey_footprint [--nodes localhost:7001,localhost:7002] [--prune-below 60]
+        [--archive-dead archive/] [--live-guilds guilds.txt] [--dry-run] [--json report.json]
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import re
+import time
+import valkey.asyncio as valkey
+
+from typing import Any, Dict, List, Optional, Set
+from storage.valkey_backend import all_guild_keys, guild_key, total_key
+from storage.valkey_nodes import ValkeyNodes, guild_id_from_key
+from tools.add_valkey_node import configured_nodes, parse_nodes
+from valkey.exceptions import WatchError
+
+# Just the all-time leaderboard of a guild, e.g. guild:123, not guild_day:123:20000
+GUILD_KEY_PATTERN = re.compile(rb"^guild:(\d+)$")
+
+# Upper bounds of the time buckets of the score distribution, in seconds
+DISTRIBUTION_BOUNDS = [60, 3600, 36000, 360000]
+DISTRIBUTION_LABELS = ["<1m", "<1h", "<10h", "<100h", ">=100h"]
+
+# How many members are removed per transaction when pruning
+PRUNE_BATCH_SIZE = 500
+
+# How many times a prune batch is tried again when the bot writes to the guild at the same time
+PRUNE_MAX_RETRIES = 10
+
+
+def distribution_index(score: float) -> int:
+    for i, bound in enumerate(DISTRIBUTION_BOUNDS):
+        if score < bound:
+            return i
+    return len(DISTRIBUTION_BOUNDS)
+
+
+class GuildFootprint:
+    """What one guild takes up on its node"""
+
+    def __init__(self, guild_id: int, node_name: str):
+        self.guild_id = guild_id
+        self.node_name = node_name
+        self.memory_bytes: int = 0
+        self.keys: int = 0
+        self.members: int = 0
+        self.encoding: Optional[str] = None
+        self.distribution: List[int] = [0] * len(DISTRIBUTION_LABELS)
+        self.below_threshold: int = 0
+        self.dead: bool = False
+
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "guild_id": self.guild_id,
+            "node": self.node_name,
+            "memory_bytes": self.memory_bytes,
+            "keys": self.keys,
+            "members": self.members,
+            "encoding": self.encoding,
+            "distribution": dict(zip(DISTRIBUTION_LABELS, self.distribution)),
+            "below_threshold": self.below_threshold,
+            "dead": self.dead,
+        }
+
+
+class Footprint:
+    """Everything found so far, plus how fast it's going"""
+
+    def __init__(self):
+        self.guilds: Dict[int, GuildFootprint] = {}
+        self.other_memory_bytes: int = 0
+        self.other_keys: int = 0
+        self.encodings: Dict[str, int] = {}
+        self.distribution: List[int] = [0] * len(DISTRIBUTION_LABELS)
+
+        self.keys_scanned: int = 0
+        self.members_scanned: int = 0
+        self.members_pruned: int = 0
+        self.time_pruned: int = 0
+        self.guilds_archived: int = 0
+        self.keys_deleted: int = 0
+        self.memory_freed_bytes: int = 0
+        self.started_at: float = time.perf_counter()
+
+
+    def guild(self, guild_id: int, node_name: str) -> GuildFootprint:
+        footprint = self.guilds.get(guild_id)
+        if footprint is None:
+            footprint = self.guilds[guild_id] = GuildFootprint(guild_id, node_name)
+        return footprint
+
+
+    def throughput(self) -> str:
+        elapsed = max(time.perf_counter() - self.started_at, 1e-9)
+        return (
+            f"{self.keys_scanned} keys ({self.keys_scanned / elapsed:,.0f}/s), "
+            f"{self.members_scanned} members ({self.members_scanned / elapsed:,.0f}/s) in {elapsed:.1f}s"
+        )
+
+
+def load_cursors(path: Optional[str]) -> Dict[str, int]:
+    if path is None or not os.path.exists(path):
+        return {}
+
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_cursors(path: Optional[str], cursors: Dict[str, int]) -> None:
+    if path is None:
+        return
+
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as file:
+        json.dump(cursors, file)
+    os.replace(temporary_path, path)
+
+
+def load_live_guilds(path: Optional[str]) -> Optional[Set[int]]:
+    if path is None:
+        return None
+
+    with open(path) as file:
+        return {int(line) for line in file if line.strip()}
+
+
+async def scan_guild_set(connection: valkey.Valkey, key: bytes, guild: GuildFootprint, footprint: Footprint, options: argparse.Namespace) -> None:
+    """Goes through a guild's members a batch at a time for the score distribution"""
+    cursor = 0
+    while True:
+        cursor, members = await connection.zscan(key, cursor, count=options.scan_count)
+
+        for _, score in members:
+            index = distribution_index(score)
+            guild.distribution[index] += 1
+            footprint.distribution[index] += 1
+
+            if options.prune_below is not None and score < options.prune_below:
+                guild.below_threshold += 1
+
+        footprint.members_scanned += len(members)
+
+        if cursor == 0:
+            return
+
+
+async def prune_guild(connection: valkey.Valkey, guild_id: int, footprint: Footprint, threshold: int) -> None:
+    """
+    Removes the members below the threshold a batch at a time. Each batch is a transaction that only goes
+    through if the guild wasn't written to since its members were read, so nobody's new time is lost.
+    """
+    key = guild_key(guild_id)
+
+    async with connection.pipeline(transaction=True) as pipe:
+        retries = 0
+        while True:
+            try:
+                await pipe.watch(key)
+                members = await pipe.zrangebyscore(key, "-inf", f"({threshold}", start=0, num=PRUNE_BATCH_SIZE, withscores=True)
+                if not members:
+                    await pipe.reset()
+                    return
+
+                removed_time = int(sum(score for _, score in members))
+
+                pipe.multi()
+                pipe.zrem(key, *[member for member, _ in members])
+                pipe.decrby(total_key(guild_id), removed_time)
+                await pipe.execute()
+
+                footprint.members_pruned += len(members)
+                footprint.time_pruned += removed_time
+                retries = 0
+            except WatchError:
+                retries += 1
+                if retries > PRUNE_MAX_RETRIES:
+                    print(f"Gave up pruning guild {guild_id}, it's being written to constantly")
+                    return
+
+
+async def archive_guild(connection: valkey.Valkey, guild_id: int, footprint: Footprint, options: argparse.Namespace) -> None:
+    """
+    Writes every key of the guild to a compressed file, and only deletes them once the file is on disk.
+    The keys are watched while they're read, so if the bot writes to the guild in the meantime nothing gets
+    deleted and the file is removed again. The guild isn't dead after all.
+    """
+    keys: Dict[str, Any] = {}
+    guild_keys: List[str] = all_guild_keys(guild_id)
+
+    memory_bytes: int = 0
+
+    async with connection.pipeline(transaction=True) as pipe:
+        # Once watching, the pipeline runs each command straight away until multi()
+        await pipe.watch(*guild_keys)
+
+        for key in guild_keys:
+            key_type = await pipe.type(key)
+            ttl_ms = await pipe.pttl(key)
+
+            if key_type != b"none":
+                memory_bytes += await pipe.memory_usage(key) or 0
+
+            if key_type == b"zset":
+                members: List[List[Any]] = []
+                async for member, score in pipe.zscan_iter(key, count=options.scan_count):
+                    members.append([member.decode(), score])
+                keys[key] = {"type": "zset", "ttl_ms": ttl_ms, "members": members}
+
+            elif key_type == b"string":
+                value = await pipe.get(key)
+                if value is not None:
+                    keys[key] = {"type": "string", "ttl_ms": ttl_ms, "value": value.decode()}
+
+        if not keys:
+            await pipe.reset()
+            return
+
+        path = os.path.join(options.archive_dead, f"guild_{guild_id}.json.gz")
+        temporary_path = f"{path}.tmp"
+
+        with gzip.open(temporary_path, "wt") as file:
+            json.dump({"guild_id": guild_id, "archived_at": int(time.time()), "keys": keys}, file)
+        with open(temporary_path, "rb") as file:
+            os.fsync(file.fileno())
+        os.replace(temporary_path, path)
+
+        # UNLINK frees the memory in the background instead of blocking the node
+        pipe.multi()
+        pipe.unlink(*keys)
+        try:
+            deleted, = await pipe.execute()
+        except WatchError:
+            os.remove(path)
+            print(f"Left guild {guild_id} alone, it was written to while being archived")
+            return
+
+    footprint.keys_deleted += deleted
+    footprint.guilds_archived += 1
+    footprint.memory_freed_bytes += memory_bytes
+
+
+async def walk_node(nodes: ValkeyNodes, node_name: str, footprint: Footprint, cursors: Dict[str, int], live_guilds: Optional[Set[int]], options: argparse.Namespace) -> None:
+    connection: valkey.Valkey = nodes.client(node_name)
+    cursor: int = cursors.get(node_name, 0)
+    last_progress = time.perf_counter()
+
+    while True:
+        cursor, keys = await connection.scan(cursor, count=options.scan_count)
+
+        # One round trip for the memory and type of the whole batch
+        async with connection.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.memory_usage(key)
+                pipe.type(key)
+            results = await pipe.execute()
+
+        guild_sets: List[tuple[bytes, GuildFootprint]] = []
+
+        for i, key in enumerate(keys):
+            memory_bytes: int = results[i * 2] or 0
+            key_type: bytes = results[i * 2 + 1]
+
+            # Deleted since the SCAN, e.g. by archiving its guild
+            if key_type == b"none":
+                continue
+
+            guild_id: Optional[int] = guild_id_from_key(key)
+            if guild_id is None:
+                footprint.other_memory_bytes += memory_bytes
+                footprint.other_keys += 1
+                continue
+
+            guild = footprint.guild(guild_id, node_name)
+            guild.memory_bytes += memory_bytes
+            guild.keys += 1
+
+            if key_type == b"zset" and GUILD_KEY_PATTERN.match(key):
+                guild_sets.append((key, guild))
+
+        footprint.keys_scanned += len(keys)
+
+        if guild_sets:
+            async with connection.pipeline(transaction=False) as pipe:
+                for key, _ in guild_sets:
+                    pipe.object("encoding", key)
+                    pipe.zcard(key)
+                results = await pipe.execute()
+
+        for i, (key, guild) in enumerate(guild_sets):
+            encoding = results[i * 2]
+            guild.encoding = encoding.decode() if isinstance(encoding, bytes) else encoding
+            guild.members = results[i * 2 + 1]
+            footprint.encodings[guild.encoding or "unknown"] = footprint.encodings.get(guild.encoding or "unknown", 0) + 1
+
+            await scan_guild_set(connection, key, guild, footprint, options)
+
+            if options.archive_dead is not None and live_guilds is not None and guild.guild_id not in live_guilds:
+                guild.dead = True
+                if not options.dry_run:
+                    await archive_guild(connection, guild.guild_id, footprint, options)
+                continue
+
+            if options.prune_below is not None and guild.below_threshold and not options.dry_run:
+                memory_before: int = await connection.memory_usage(key) or 0
+                await prune_guild(connection, guild.guild_id, footprint, options.prune_below)
+                memory_after: int = await connection.memory_usage(key) or 0
+                footprint.memory_freed_bytes += max(0, memory_before - memory_after)
+
+        cursors[node_name] = cursor
+        save_cursors(options.cursor_file, cursors)
+
+        if time.perf_counter() - last_progress >= 10:
+            print(f"{node_name}: {footprint.throughput()}")
+            last_progress = time.perf_counter()
+
+        if cursor == 0:
+            return
+
+        if options.pause_ms:
+            await asyncio.sleep(options.pause_ms / 1000)
+
+
+def describe(footprint: Footprint, options: argparse.Namespace) -> str:
+    guilds = sorted(footprint.guilds.values(), key=lambda guild: guild.memory_bytes, reverse=True)
+    guild_memory_bytes = sum(guild.memory_bytes for guild in guilds)
+    dead_guilds = [guild for guild in guilds if guild.dead]
+
+    lines: List[str] = [
+        f"Guilds: {len(guilds)}, {guild_memory_bytes / 1024 / 1024:,.1f} MiB",
+        f"Other keys: {footprint.other_keys}, {footprint.other_memory_bytes / 1024 / 1024:,.1f} MiB",
+        f"Encodings: {', '.join(f'{encoding} {count}' for encoding, count in sorted(footprint.encodings.items()))}",
+        f"Members by time: {', '.join(f'{label} {count}' for label, count in zip(DISTRIBUTION_LABELS, footprint.distribution))}",
+        "",
+        f"{'Guild':<22}{'Node':<22}{'Memory':>12}{'Keys':>6}{'Members':>10}{'Encoding':>10}{'Below':>8}",
+    ]
+
+    for guild in guilds[:options.top]:
+        lines.append(
+            f"{guild.guild_id:<22}{guild.node_name:<22}{guild.memory_bytes / 1024:>10,.1f}Ki{guild.keys:>6}"
+            f"{guild.members:>10}{guild.encoding or '-':>10}{guild.below_threshold:>8}"
+        )
+
+    lines.append("")
+
+    if options.prune_below is not None:
+        below = sum(guild.below_threshold for guild in guilds if not guild.dead)
+        if options.dry_run:
+            lines.append(f"Would prune {below} members with less than {options.prune_below}s")
+        else:
+            lines.append(f"Pruned {footprint.members_pruned} members ({footprint.time_pruned}s of time)")
+
+    if options.archive_dead is not None:
+        if options.dry_run:
+            dead_memory_bytes = sum(guild.memory_bytes for guild in dead_guilds)
+            lines.append(f"Would archive {len(dead_guilds)} dead guilds, {dead_memory_bytes / 1024 / 1024:,.1f} MiB")
+        else:
+            lines.append(f"Archived {footprint.guilds_archived} dead guilds to {options.archive_dead}")
+
+    if not options.dry_run and (options.prune_below is not None or options.archive_dead is not None):
+        lines.append(f"Freed about {footprint.memory_freed_bytes / 1024 / 1024:,.1f} MiB, deleted {footprint.keys_deleted} keys")
+
+    lines.append(f"Scanned {footprint.throughput()}")
+    return "\n".join(lines)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=parse_nodes, help="host:port,... of the nodes. Defaults to the config")
+    parser.add_argument("--scan-count", type=int, default=500, help="COUNT hint for each SCAN and ZSCAN")
+    parser.add_argument("--pause-ms", type=int, default=0, help="Pause between SCAN batches, to go easier on the nodes")
+    parser.add_argument("--top", type=int, default=25, help="How many of the biggest guilds to list")
+    parser.add_argument("--prune-below", type=int, help="Remove members with less all-time than this many seconds")
+    parser.add_argument("--archive-dead", metavar="DIR", help="Archive dead guilds to DIR and delete them")
+    parser.add_argument("--live-guilds", metavar="FILE", help="Guild IDs the bot is in, one per line. Needed for --archive-dead")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be pruned and archived")
+    parser.add_argument("--cursor-file", help="Keeps the SCAN cursor of each node, to carry on after an interruption")
+    parser.add_argument("--json", metavar="FILE", help="Also write every guild's footprint to FILE")
+    options = parser.parse_args()
+
+    if options.archive_dead is not None and options.live_guilds is None:
+        parser.error("--archive-dead needs --live-guilds, the guilds the bot is in")
+
+    if options.archive_dead is not None and not options.dry_run:
+        os.makedirs(options.archive_dead, exist_ok=True)
+
+    nodes = ValkeyNodes(options.nodes or configured_nodes())
+    footprint = Footprint()
+    cursors: Dict[str, int] = load_cursors(options.cursor_file)
+    live_guilds: Optional[Set[int]] = load_live_guilds(options.live_guilds)
+
+    try:
+        for node_name in nodes.node_names():
+            await walk_node(nodes, node_name, footprint, cursors, live_guilds, options)
+
+        # Every node got walked to the end, so a new run starts from the beginning again
+        save_cursors(options.cursor_file, {})
+    finally:
+        await nodes.aclose()
+
+    print(describe(footprint, options))
+
+    if options.json is not None:
+        with open(options.json, "w") as file:
+            json.dump({
+                "guilds": [guild.to_json() for guild in footprint.guilds.values()],
+                "other_keys": footprint.other_keys,
+                "other_memory_bytes": footprint.other_memory_bytes,
+                "encodings": footprint.encodings,
+                "distribution": dict(zip(DISTRIBUTION_LABELS, footprint.distribution)),
+                "keys_scanned": footprint.keys_scanned,
+                "members_scanned": footprint.members_scanned,
+                "members_pruned": footprint.members_pruned,
+                "guilds_archived": footprint.guilds_archived,
+                "elapsed_seconds": time.perf_counter() - footprint.started_at,
+            }, file, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
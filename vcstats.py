@@ -2,12 +2,19 @@ import config
 import hikari
 import lightbulb
 import asyncio
+import time
 
-from helper import initialize, make_key, start_tracking_user
+import cluster_worker
+
+from helper import PERFORMANCE_LOGGING_CHANNEL, initialize, log_info_to_channel, stop_message_scheduler
+from message_scheduler import HIGH_PRIORITY
 from datastore import Datastore
-from typing import Dict, List, Mapping, Optional
-from objects.user import User
-from logging_stuff import fetch_stats
+from typing import List, Mapping, Optional
+from logging_stuff import fetch_stats, report_to_coordinator
+from perf_logging import build_performance_digest
+from metrics import start_metrics_server, stop_metrics_server
+from objects.startup_timer import StartupTimer
+from handlers.event_handler import drain_voice_events
 
 
 # Set the cache we want to enable
@@ -25,6 +32,7 @@ bot = lightbulb.BotApp(
 )
 
 datastore = Datastore()
+startup_timer = StartupTimer()
 
 # Function when the bot is starting up
 @bot.listen(hikari.StartingEvent)
@@ -35,12 +43,14 @@ async def on_starting(event: hikari.StartingEvent) -> None:
 
     # Load Eventhandlers
     bot.load_extensions("handlers.event_handler") # Handles the join and leave events
+    bot.load_extensions("handlers.reconciliation") # Catches leave events that were missed
 
     # Load Commands
     bot.load_extensions("commands.command_stats")
     bot.load_extensions("commands.command_help")
     bot.load_extensions("commands.command_donate")
     bot.load_extensions("commands.command_leaderboard")
+    bot.load_extensions("commands.command_channel_stats")
     bot.load_extensions("commands.command_reset_guild_stats")
     bot.load_extensions("commands.command_reset_user_stats")
 
@@ -55,43 +65,83 @@ async def on_started(event: hikari.StartedEvent) -> None:
     # await user_tracker.add_all_users_in_voice_channels(bot)
     print(f"Initialized tracking for {len(datastore.get_tracking_queue())} users already in voice channels")
 
-    asyncio.create_task(queue_updater(60 * 60 * 1)) # Runs every 1 hour
     asyncio.create_task(auto_save_all(60 * 10)) # Runs every 10 minutes
     asyncio.create_task(get_stats(60 * 60 * 24)) # Runs every 24 hours
+    asyncio.create_task(post_performance_digest(60 * 5)) # Runs every 5 minutes
+    asyncio.create_task(journal_maintenance(5)) # Runs every 5 seconds
+    asyncio.create_task(finish_journal_recovery(60 * 10)) # Runs once after 10 minutes
+
+    if cluster_worker.is_worker():
+        asyncio.create_task(sync_with_coordinator(cluster_worker.REPORT_INTERVAL_SECONDS)) # Runs every 15 seconds
+
+    # Prometheus scrapes GET /metrics. Only listens locally unless the config says otherwise
+    try:
+        # In a cluster, the coordinator has the configured port and each worker gets its own after it
+        await start_metrics_server(getattr(config, "METRICS_HOST", "127.0.0.1"), cluster_worker.worker_port(getattr(config, "METRICS_PORT", 9108)))
+    except Exception as error:
+        print(f"Error starting the metrics endpoint: {error}")
 
 
 # Function when the bot is shutting down
 @bot.listen(hikari.StoppingEvent)
 async def on_stopping(event: hikari.StoppingEvent) -> None:
+    # Voice events still waiting on the queue have to be tracked before everyone is saved
+    await drain_voice_events()
+
     if datastore:
+        # Also drains the write buffer, so leave-time saves that are still queued get written
         await datastore.save_all(None)
+
+        # The join times are all that's left, the next process picks them up from here
+        await datastore.write_session_snapshot()
     else:
         print("Datastore was not available...")
 
     print("Bot shutting down")
 
+    # Whatever is still waiting to be posted goes out before the REST client closes
+    await stop_message_scheduler()
+
+    await stop_metrics_server()
     await datastore.uninitialize()
 
 
+@bot.listen(hikari.ShardReadyEvent)
+async def on_shard_ready(event: hikari.ShardReadyEvent) -> None:
+    startup_timer.shard_ready(event.shard.id, event.unavailable_guilds)
+
+
 # Adds all the existing users in the voice channel into the queue if the bot were to restart
 @bot.listen(hikari.GuildAvailableEvent)
 async def on_guild_available(event: hikari.GuildAvailableEvent) -> None:
+    start = time.perf_counter()
 
     # Actually returns a mapping of user IDs to their voice channels.
     # So it doesn't return all the voice channel, but all the users that are in the voice channels
     voice_states: Mapping[hikari.Snowflake, hikari.VoiceState] = event.guild.get_voice_states()
 
-    for user_id, user_voice_state in voice_states.items(): # type: ignore
+    members: List[tuple[int, int]] = []
+    for user_id, voice_state in voice_states.items():
 
         member: Optional[hikari.Member] = bot.cache.get_member(event.guild_id, user_id)
         if member and member.is_bot:
             continue
 
-        dict_key: str = make_key(user_id, event.guild_id)
-        
-        if dict_key not in datastore.get_tracking_queue():
-            await start_tracking_user(user_id, event.guild_id)
-            # print(f"{user_voice_state.member} added to tracking queue on startup...")
+        members.append((user_id, voice_state.channel_id or 0))
+
+    # The whole guild goes in at once. If they were already in VC before a restart or crash,
+    # they keep their original join time
+    sessions_added: int = await datastore.start_tracking_guild(event.guild_id, members)
+
+    end = time.perf_counter()
+    startup_timer.guild_ingested(event.guild_id, sessions_added, end - start)
+
+    # Only the shards of this process, in case it's one worker of a cluster
+    if startup_timer.check_finished(len(bot.shards)):
+        report: str = startup_timer.build_report()
+        print(report)
+
+        await log_info_to_channel(PERFORMANCE_LOGGING_CHANNEL, report, HIGH_PRIORITY)
 
 
 async def auto_save_all(interval_seconds: int) -> None:
@@ -106,50 +156,63 @@ async def auto_save_all(interval_seconds: int) -> None:
 
 
 async def get_stats(interval_seconds: int) -> None:
+    # In a cluster, the first worker posts the stats of every worker
+    if cluster_worker.worker_id() not in (None, 0):
+        return
+
     while True:
         stats: str = await fetch_stats(bot)
-        await bot.rest.create_message(1157849921802752070, stats)
+        await log_info_to_channel(1157849921802752070, stats, HIGH_PRIORITY)
 
         await asyncio.sleep(interval_seconds)
 
 
-async def queue_updater(interval_seconds: int) -> None:
+async def sync_with_coordinator(interval_seconds: int) -> None:
+    """Sends this worker's stats to the cluster coordinator and keeps the merged stats it sends back"""
+    while True:
+        try:
+            await report_to_coordinator()
+        except Exception as error:
+            print(f"Error reporting to the cluster coordinator: {error}")
+
+        await asyncio.sleep(interval_seconds)
+
+
+async def journal_maintenance(interval_seconds: int) -> None:
     """
-    Runs through the tracking queue, and see if the user is still in the VC. If not, remove them from the 
-    queue. This is used to catch any edgecases that might happen where the user is no longer in the
-    voice channel without the bot catching it. For example, a user leaving a voice channel while an API
-    outage occurs, so the leave event on the bot is never fired.
+    Lets the session journal know the bot is still running, so after a crash the time of anyone who
+    left while the bot was down is only counted up to here. Also compacts the journal once it fills up.
     """
-    print("Starting tracking queue auto clearing scheduler")
-
     while True:
-        print("Running tracking queue auto clearing")
-        keys_to_remove: List[str] = []
-        users_to_save: List[tuple[int, int]] = []
+        await asyncio.sleep(interval_seconds)
 
+        datastore.journal_heartbeat()
+        await datastore.compact_journal(min_fill_ratio=0.5)
 
-        tracking_queue: Dict[str, User] = datastore.get_tracking_queue().copy()
 
+async def finish_journal_recovery(delay_seconds: int) -> None:
+    """Saves the recovered sessions of guilds that never became available again after startup"""
+    await asyncio.sleep(delay_seconds)
+    datastore.finish_guild_recovery(None)
 
-        for key in tracking_queue:
-            user_id, guild_id = map(int, key.split("-"))
-            # print(f"Tracking queue uid: {user_id}, gid: {guild_id}")
-            user_voice_state: Optional[hikari.VoiceState] = bot.cache.get_voice_state(guild_id, user_id)
 
-            # If the user is not in voice channel and they are still in the queue, we add it to the removal list
-            if user_voice_state is None:
-                keys_to_remove.append(key)
-                users_to_save.append((user_id, guild_id))
+async def post_performance_digest(interval_seconds: int) -> None:
+    """
+    Posts one summary of the datastore timings per interval. The timings themselves are only
+    recorded in memory, so the hot paths never wait on Discord for logging.
+    """
+    while True:
+        await asyncio.sleep(interval_seconds)
 
-        # Save users outside of the lock
-        for user_id, guild_id in users_to_save:
-            await datastore.save_single(user_id, guild_id)
+        current_worker_id = cluster_worker.worker_id()
+        heading: str = f"Worker {current_worker_id}\n" if current_worker_id is not None else ""
 
-        # Now remove it from the actual dictionary
-        async with datastore.get_tracking_queue_lock():
-            for key in keys_to_remove:
-                datastore.get_tracking_queue().pop(key, None)
+        for message in build_performance_digest(interval_seconds, heading):
+            await log_info_to_channel(PERFORMANCE_LOGGING_CHANNEL, message)
 
-        await asyncio.sleep(interval_seconds)
 
-bot.run()
\ No newline at end of file
+if cluster_worker.is_worker():
+    # Started by cluster.py, which decides the shards of each worker
+    bot.run(shard_ids=cluster_worker.shard_ids(), shard_count=cluster_worker.shard_count())
+else:
+    bot.run()
\ No newline at end of file
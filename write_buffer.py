@@ -0,0 +1,240 @@
+import asyncio
+import time
+
+from perf_logging import record_timing
+from typing import Awaitable, Callable, Dict, List, Optional
+
+# (guild_id, user_id, time_difference)
+Increment = tuple[int, int, int]
+
+# (guild_id, channel_id, time_difference)
+ChannelIncrement = tuple[int, int, int]
+
+# Writes the member and channel increments to the database and returns the ones that weren't written and
+# can be sent again
+IncrementWriter = Callable[[List[Increment], List[ChannelIncrement]], Awaitable[tuple[List[Increment], List[ChannelIncrement]]]]
+
+
+class WriteBuffer:
+    """
+    Collects time increments in memory and writes them to the database in one
+    pipelined batch every `flush_interval_seconds`, or as soon as `max_entries`
+    different members are waiting, whichever comes first.
+    Increments for the same member are merged before they are written.
+    Time per voice channel is collected the same way and goes out in the same flush.
+    """
+
+    def __init__(self, flush_interval_seconds: float = 0.5, max_entries: int = 500):
+        self._flush_interval_seconds = flush_interval_seconds
+        self._max_entries = max_entries
+
+        # guild_id -> user_id -> time waiting to be written
+        self._pending: Dict[int, Dict[int, int]] = {}
+        self._pending_count: int = 0
+
+        # guild_id -> channel_id -> time waiting to be written
+        self._pending_channels: Dict[int, Dict[int, int]] = {}
+
+        self._writer: Optional[IncrementWriter] = None
+        self._task: Optional[asyncio.Task[None]] = None
+        self._stopping: bool = False
+
+        # Only one flush at a time, so that anyone awaiting flush() knows
+        # that everything queued before the call has reached the database
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+
+        # Flush reporting
+        self.total_flushes: int = 0
+        self.total_entries_flushed: int = 0
+        self.total_failed_entries: int = 0
+        self.last_flush_size: int = 0
+        self.last_flush_ms: float = 0.0
+        self.max_flush_size: int = 0
+        self.max_flush_ms: float = 0.0
+
+
+    def start(self, writer: IncrementWriter) -> None:
+        self._writer = writer
+
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+
+    async def stop(self) -> None:
+        """Stops the background flusher and writes out whatever is still pending"""
+        if self._task is not None:
+            # Asked to stop rather than cancelled. wait_for() can swallow a cancel that lands just as
+            # the wakeup is set, which would leave this waiting on the task forever
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+
+        try:
+            await self.flush()
+        except Exception as error:
+            # Raising would keep the caller from shutting down the rest
+            print(f"Error flushing write buffer: {error}")
+
+
+    def add(self, guild_id: int, user_id: int, time_difference: int) -> None:
+        if time_difference <= 0:
+            return
+
+        guild_pending = self._pending.get(guild_id)
+        if guild_pending is None:
+            guild_pending = {}
+            self._pending[guild_id] = guild_pending
+
+        if user_id not in guild_pending:
+            self._pending_count += 1
+
+        guild_pending[user_id] = guild_pending.get(user_id, 0) + time_difference
+
+        if self._pending_count >= self._max_entries:
+            self._wakeup.set()
+
+
+    def add_channel(self, guild_id: int, channel_id: int, time_difference: int) -> None:
+        # Sessions recovered from the journal don't know their channel
+        if time_difference <= 0 or not channel_id:
+            return
+
+        guild_pending = self._pending_channels.get(guild_id)
+        if guild_pending is None:
+            guild_pending = {}
+            self._pending_channels[guild_id] = guild_pending
+
+        guild_pending[channel_id] = guild_pending.get(channel_id, 0) + time_difference
+
+
+    def pending_count(self) -> int:
+        return self._pending_count
+
+
+    def pending_increments(self) -> List[Increment]:
+        return [
+            (guild_id, user_id, time_difference)
+            for guild_id, guild_pending in self._pending.items()
+            for user_id, time_difference in guild_pending.items()
+        ]
+
+
+    def take_guild(self, guild_id: int) -> Dict[int, int]:
+        """
+        Removes and returns the user_id -> time waiting to be written for the guild, for when the
+        caller writes it itself or throws it away. Hold get_flush_lock() so it can't be halfway through a flush.
+        """
+        guild_pending = self._pending.pop(guild_id, {})
+        self._pending_count -= len(guild_pending)
+        return guild_pending
+
+
+    def take_member(self, guild_id: int, user_id: int) -> int:
+        """Same as take_guild(), for one member. Returns 0 if nothing is waiting"""
+        guild_pending = self._pending.get(guild_id)
+        if guild_pending is None or user_id not in guild_pending:
+            return 0
+
+        self._pending_count -= 1
+        time_difference = guild_pending.pop(user_id)
+        if not guild_pending:
+            del self._pending[guild_id]
+
+        return time_difference
+
+
+    def take_guild_channels(self, guild_id: int) -> Dict[int, int]:
+        """Same as take_guild(), for the channel_id -> time of the guild"""
+        return self._pending_channels.pop(guild_id, {})
+
+
+    def pending_channels_for_guild(self, guild_id: int) -> Dict[int, int]:
+        """Returns a copy of the channel_id -> time that is waiting to be written for the guild"""
+        return dict(self._pending_channels.get(guild_id, {}))
+
+
+    def get_flush_lock(self) -> asyncio.Lock:
+        """No flush is running while this is held"""
+        return self._flush_lock
+
+
+    def pending_for_guild(self, guild_id: int) -> Dict[int, int]:
+        """Returns a copy of the user_id -> time that is waiting to be written for the guild"""
+        return dict(self._pending.get(guild_id, {}))
+
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not (self._pending or self._pending_channels) or self._writer is None:
+                return
+
+            # Swap the buffer out so new increments can keep coming in while we write
+            pending = self._pending
+            self._pending = {}
+            self._pending_count = 0
+
+            pending_channels = self._pending_channels
+            self._pending_channels = {}
+
+            increments: List[Increment] = [
+                (guild_id, user_id, time_difference)
+                for guild_id, guild_pending in pending.items()
+                for user_id, time_difference in guild_pending.items()
+            ]
+            channel_increments: List[ChannelIncrement] = [
+                (guild_id, channel_id, time_difference)
+                for guild_id, guild_pending in pending_channels.items()
+                for channel_id, time_difference in guild_pending.items()
+            ]
+
+            start = time.perf_counter()
+            try:
+                failed, failed_channels = await self._writer(increments, channel_increments)
+            except Exception:
+                # Some of it may have been written before the writer broke off, and sending that again would
+                # count it twice. Only what the writer returns is known not to have been written
+                self.total_failed_entries += len(increments)
+                raise
+            end = time.perf_counter()
+            elapsed_ms = (end - start) * 1000
+            record_timing("write_buffer_flush", elapsed_ms)
+
+            # Put the failed ones back so they get retried on the next flush
+            self._put_back(failed, failed_channels)
+
+            self.total_flushes += 1
+            self.total_entries_flushed += len(increments) - len(failed)
+            self.total_failed_entries += len(failed)
+            self.last_flush_size = len(increments)
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_size = max(self.max_flush_size, len(increments))
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+
+
+    def _put_back(self, increments: List[Increment], channel_increments: List[ChannelIncrement]) -> None:
+        for guild_id, user_id, time_difference in increments:
+            self.add(guild_id, user_id, time_difference)
+        for guild_id, channel_id, time_difference in channel_increments:
+            self.add_channel(guild_id, channel_id, time_difference)
+
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self._flush_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+            self._wakeup.clear()
+
+            # stop() does the last flush itself
+            if self._stopping:
+                return
+
+            try:
+                await self.flush()
+            except Exception as error:
+                print(f"Error flushing write buffer: {error}")